@@ -0,0 +1 @@
+"""Offline benchmarks of the email bot, with a synthetic mailbox and fake Gmail / llamafile services."""
@@ -0,0 +1,229 @@
+"""In-memory replacement of the Gmail API service, serving a synthetic mailbox."""
+import random
+import threading
+import time
+from base64 import urlsafe_b64encode
+from typing import Callable, Optional
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+def get_rate_limit_error() -> HttpError:
+    """Get the error returned by the Gmail API when the quota is exceeded."""
+    return HttpError(httplib2.Response({"status": 429}), b"Rate limit exceeded")
+
+
+def get_not_found_error() -> HttpError:
+    """Get the error returned by the Gmail API for a message which does not exist (anymore)."""
+    return HttpError(httplib2.Response({"status": 404}), b"Requested entity was not found.")
+
+
+class FakeRequest:
+    """Request of the fake service, run when executed."""
+
+    def __init__(self, function: Callable):
+        self.function = function
+
+    def execute(self):
+        return self.function()
+
+
+class FakeBatch:
+    """Batch request of the fake service: one round trip, then a callback per request."""
+
+    def __init__(self, service: "FakeGmailService", callback: Callable):
+        self.service = service
+        self.callback = callback
+        self.requests: list = []
+
+    def add(self, request: FakeRequest, request_id: str):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.wait()
+        for request_id, request in self.requests:
+            try:
+                response, exception = request.execute(), None
+            except HttpError as error:
+                response, exception = None, error
+            self.callback(request_id, response, exception)
+
+
+class FakeGmailService:
+    """Fake Gmail API service, implementing the calls made by `EmailHandler`.
+
+    The latency of the round trips and the rate of quota errors can be set to mimic the real API.
+    """
+
+    def __init__(self, messages: list[dict], latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        """Initialise the service.
+
+        Args:
+            messages (list[dict]): full messages of the mailbox (see `generate_mailbox`).
+            latency (float): duration of a round trip to the API, in seconds.
+            error_rate (float): probability of a message request failing with a 429 error.
+            seed (int): seed of the random generator of the errors.
+        """
+        self.mailbox = {message["id"]: message for message in messages}
+        self.order = [message["id"] for message in messages]
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.history_id = max((int(message["historyId"]) for message in messages), default=1)
+        self.records: list[dict] = []
+        # history ids older than this one are expired, the history API answers them with a 404 error
+        self.oldest_history_id = self.history_id
+        self.calls = {"list": 0, "get": 0, "batch": 0, "history": 0, "errors": 0}
+
+    def wait(self):
+        """Simulate the latency of a round trip."""
+        if self.latency:
+            time.sleep(self.latency)
+
+    def count(self, call: str):
+        with self.lock:
+            self.calls[call] += 1
+
+    def add_message(self, message: dict):
+        """Add a message to the mailbox, recorded in its history."""
+        with self.lock:
+            self.history_id += 1
+            message["historyId"] = str(self.history_id)
+            self.mailbox[message["id"]] = message
+            self.order.insert(0, message["id"])
+            summary = {"id": message["id"], "threadId": message["threadId"], "labelIds": message["labelIds"]}
+            self.records.append({"id": str(self.history_id), "messagesAdded": [{"message": summary}]})
+
+    def delete_message(self, message_id: str):
+        """Delete a message from the mailbox, recorded in its history."""
+        with self.lock:
+            self.history_id += 1
+            del self.mailbox[message_id]
+            self.order.remove(message_id)
+            self.records.append({"id": str(self.history_id), "messagesDeleted": [{"message": {"id": message_id}}]})
+
+    def set_labels(self, message_id: str, added: tuple = (), removed: tuple = ()):
+        """Add and remove labels of a message, recorded in its history."""
+        with self.lock:
+            self.history_id += 1
+            message = self.mailbox[message_id]
+            message["labelIds"] = [label for label in message["labelIds"] if label not in removed] + list(added)
+            summary = {"id": message_id, "threadId": message["threadId"], "labelIds": list(message["labelIds"])}
+            record: dict = {"id": str(self.history_id)}
+            if added:
+                record["labelsAdded"] = [{"message": summary, "labelIds": list(added)}]
+            if removed:
+                record["labelsRemoved"] = [{"message": summary, "labelIds": list(removed)}]
+            self.records.append(record)
+
+    def expire_history(self):
+        """Drop the history recorded so far, like the Gmail API does after about a week."""
+        with self.lock:
+            self.records = []
+            self.oldest_history_id = self.history_id
+
+    def get_attachment_size(self, message_id: str, attachment_id: str) -> int:
+        """Get the size of an attachment of a message."""
+        parts = list(self.mailbox[message_id]["payload"].get("parts", []))
+        while parts:
+            part = parts.pop()
+            parts.extend(part.get("parts", []))
+            if part.get("body", {}).get("attachmentId") == attachment_id:
+                return part["body"].get("size", 0)
+        return 0
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return FakeMessages(self)
+
+    def history(self):
+        return FakeHistory(self)
+
+    def getProfile(self, userId: str):
+        return FakeRequest(lambda: {"emailAddress": "me@example.com", "historyId": str(self.history_id)})
+
+    def new_batch_http_request(self, callback: Callable):
+        self.count("batch")
+        return FakeBatch(self, callback)
+
+
+class FakeMessages:
+    """`users().messages()` resource of the fake service."""
+
+    PAGE_SIZE = 100
+
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def list(self, userId: str, q: str = "", pageToken: Optional[str] = None, **kwargs):
+        def function():
+            self.service.count("list")
+            self.service.wait()
+            start = int(pageToken or 0)
+            mailbox = self.service.mailbox
+            # the spam and the trash are not listed
+            listed = [id for id in self.service.order if {"SPAM", "TRASH"}.isdisjoint(mailbox[id]["labelIds"])]
+            page = listed[start : start + self.PAGE_SIZE]
+            result: dict = {"messages": [{"id": id, "threadId": mailbox[id]["threadId"]} for id in page]}
+            if start + self.PAGE_SIZE < len(listed):
+                result["nextPageToken"] = str(start + self.PAGE_SIZE)
+            return result
+
+        return FakeRequest(function)
+
+    def get(self, userId: str, id: str, format: str = "full"):
+        def function():
+            self.service.count("get")
+            with self.service.lock:
+                failed = self.service.random.random() < self.service.error_rate
+            if failed:
+                self.service.count("errors")
+                raise get_rate_limit_error()
+            if id not in self.service.mailbox:
+                raise get_not_found_error()
+            return self.service.mailbox[id]
+
+        return FakeRequest(function)
+
+    def attachments(self):
+        return FakeAttachments(self.service)
+
+
+class FakeAttachments:
+    """`users().messages().attachments()` resource of the fake service."""
+
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def get(self, userId: str, messageId: str, id: str):
+        def function():
+            self.service.wait()
+            size = self.service.get_attachment_size(messageId, id)
+            # blank content of the announced size, the text of the attachments is not used by the benchmarks
+            return {"attachmentId": id, "size": size, "data": urlsafe_b64encode(b" " * size).decode()}
+
+        return FakeRequest(function)
+
+
+class FakeHistory:
+    """`users().history()` resource of the fake service."""
+
+    def __init__(self, service: FakeGmailService):
+        self.service = service
+
+    def list(
+        self, userId: str, startHistoryId: str, historyTypes: Optional[list] = None, pageToken: Optional[str] = None
+    ):
+        def function():
+            self.service.count("history")
+            self.service.wait()
+            if int(startHistoryId) < self.service.oldest_history_id:
+                raise get_not_found_error()
+            records = [record for record in self.service.records if int(record["id"]) > int(startHistoryId)]
+            return {"history": records, "historyId": str(self.service.history_id)}
+
+        return FakeRequest(function)
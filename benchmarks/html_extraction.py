@@ -0,0 +1,126 @@
+"""Micro-benchmark of the HTML to text extractors.
+
+The extractors are compared on a corpus of HTML emails: a folder of `.html` files, or synthetic emails
+shaped like the real ones (newsletters with large style sheets and nested tables, receipts, Outlook
+replies with conditional comments, quoted threads):
+
+    python -m benchmarks.html_extraction --emails 2000 --processes 0 4
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from benchmarks.synthetic_mailbox import get_html, get_text
+from src.html_extractor import EXTRACTORS, get_extractor
+
+STYLE_SHEET = "\n".join(
+    f".c{number} {{ color: #{number:06x}; padding: {number % 20}px; font-family: Helvetica, Arial; }}"
+    for number in range(200)
+)
+OUTLOOK_TEMPLATE = """<html xmlns:o="urn:schemas-microsoft-com:office:office"><head>
+<!--[if gte mso 9]><xml><o:OfficeDocumentSettings><o:AllowPNG/></o:OfficeDocumentSettings></xml><![endif]-->
+<style>{style}</style></head><body lang="EN-US"><div class="WordSection1">
+<p class="MsoNormal"><span style="font-size:11.0pt">{text}</span></p>
+<div style="border:none;border-top:solid #E1E1E1 1.0pt;padding:3.0pt 0in 0in 0in">
+<p class="MsoNormal"><b>From:</b> Alice &lt;alice@acme.com&gt;<br><b>Sent:</b> Monday<br>
+<b>Subject:</b> RE: {subject}</p></div>
+<p class="MsoNormal">{quoted}</p></div></body></html>"""
+RECEIPT_TEMPLATE = """<!DOCTYPE html><html><head><meta charset="utf-8"><style>{style}</style></head><body>
+<div class="c1"><img src="https://shop.example/logo.png" alt="Shop" width="120"></div>
+<table cellpadding="0" cellspacing="0" border="0" width="600">{rows}</table>
+<p>Total: &euro;{total}&nbsp;&mdash; thank you for your order!</p>
+<img src="https://shop.example/open.gif?id={tracking}" width="1" height="1"></body></html>"""
+THREAD_TEMPLATE = """<div dir="ltr">{text}<br></div><br><div class="gmail_quote"><div dir="ltr" class="gmail_attr">
+On Mon, someone &lt;bob@globex.com&gt; wrote:<br></div>
+<blockquote class="gmail_quote" style="margin:0px 0px 0px 0.8ex;border-left:1px solid rgb(204,204,204)">
+{quoted}</blockquote></div>"""
+
+
+def generate_corpus(nb_emails: int, seed: int = 0) -> list[str]:
+    """Generate HTML emails of the shapes commonly found in a mailbox."""
+    rng = random.Random(seed)
+    corpus = []
+    for number in range(nb_emails):
+        subject = get_text(rng, 5)
+        text = get_text(rng, rng.randint(50, 400))
+        shape = number % 4
+        if shape == 0:
+            html = get_html(rng, subject, text).replace("<style>", f"<style>{STYLE_SHEET}", 1)
+        elif shape == 1:
+            html = OUTLOOK_TEMPLATE.format(style=STYLE_SHEET, text=text, subject=subject, quoted=get_text(rng, 200))
+        elif shape == 2:
+            rows = "".join(
+                f"<tr><td class='c{item}'>{get_text(rng, 4)}</td><td align='right'>&euro;{rng.randint(1, 99)}</td></tr>"
+                for item in range(rng.randint(2, 30))
+            )
+            html = RECEIPT_TEMPLATE.format(
+                style=STYLE_SHEET, rows=rows, total=rng.randint(10, 999), tracking=rng.getrandbits(64)
+            )
+        else:
+            html = THREAD_TEMPLATE.format(text=text, quoted=get_text(rng, 300).replace(". ", ".<br>"))
+        corpus.append(html)
+    return corpus
+
+
+def load_corpus(folder: str) -> list[str]:
+    """Load the HTML files of a folder."""
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(folder, "**", "*.htm*"), recursive=True)):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            corpus.append(f.read())
+    return corpus
+
+
+def run(name: str, corpus: list[str], processes: int) -> tuple[dict, list[str]]:
+    """Extract the text of a corpus with an extractor, in the main process or in a pool of processes."""
+    extractor = get_extractor(name)
+    start = time.perf_counter()
+    if processes:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            texts = list(executor.map(extractor, corpus, chunksize=32))
+    else:
+        texts = [extractor(html) for html in corpus]
+    duration = time.perf_counter() - start
+    size = sum(len(html) for html in corpus) / 1e6
+    return {
+        "extractor": name,
+        "processes": processes,
+        "seconds": duration,
+        "emails_per_second": len(corpus) / duration,
+        "mb_per_second": size / duration,
+    }, texts
+
+
+def main(args: Optional[list] = None):
+    """Compare the throughput of the HTML extractors, and their output with the BeautifulSoup one."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--corpus", help="folder of .html emails (synthetic emails when not given)")
+    parser.add_argument("--emails", type=int, default=1000, help="number of synthetic emails")
+    parser.add_argument("--extractors", nargs="+", default=sorted(EXTRACTORS))
+    parser.add_argument("--processes", type=int, nargs="+", default=[0])
+    args = parser.parse_args(args)
+
+    corpus = load_corpus(args.corpus) if args.corpus else generate_corpus(args.emails)
+    print(f"{len(corpus)} emails, {sum(len(html) for html in corpus) / 1e6:.1f} MB of HTML")
+    _, reference = run("beautifulsoup", corpus, 0)
+    results = []
+    for name in args.extractors:
+        for processes in args.processes:
+            try:
+                result, texts = run(name, corpus, processes)
+            except ImportError as e:
+                print(f"Skipping {name}: {e}")
+                break
+            result["same_text_as_beautifulsoup"] = sum(text == ref for text, ref in zip(texts, reference)) / len(corpus)
+            results.append(result)
+            print(json.dumps(result))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""End-to-end benchmark of the email bot, run offline on a synthetic mailbox.
+
+Each stage of the pipeline is measured: download and parsing of the emails (fake Gmail API), splitting,
+embedding and indexing of the chunks, retrieval latency, time to the first token of the answer (stub
+llamafile server) and peak memory. The results are saved as JSON, tagged with the git commit, so that
+a change can be compared with a previous run:
+
+    python -m benchmarks.run_benchmark --messages 2000 --compare benchmarks/results/<previous>.json
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.stub_llamafile import StubLlamafileServer
+from benchmarks.synthetic_mailbox import WORDS, generate_mailbox
+from src.email_handler import EmailHandler
+from src.llamafile_server import LlamafileServer
+from src.llm_handler import LLMHandler
+from src.metrics import configure, get_snapshot
+from src.rag_handler import RAGHandler
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+# metrics compared between runs (the others are counts), and the ones where a higher value is better
+COMPARED_SUFFIXES = ("seconds", "_ms", "per_second", "_mb")
+HIGHER_IS_BETTER = {"messages_per_second", "chunks_per_second"}
+
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic embeddings of the words of a text, to benchmark the pipeline without a model."""
+
+    def __init__(self, dimension: int = 384):
+        self.dimension = dimension
+        self.nb_chunks = 0
+        self.duration = 0.0
+
+    def embed_text(self, text: str) -> list[float]:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode()).hexdigest()[:8], 16) % self.dimension] += 1
+        return (vector / (np.linalg.norm(vector) or 1)).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        start = time.perf_counter()
+        embeddings = [self.embed_text(text) for text in texts]
+        self.nb_chunks += len(texts)
+        self.duration += time.perf_counter() - start
+        return embeddings
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_text(text)
+
+    def get_stats(self) -> dict:
+        return {
+            "chunks": self.nb_chunks,
+            "seconds": self.duration,
+            "chunks_per_second": self.nb_chunks / self.duration if self.duration else 0.0,
+        }
+
+
+def get_percentiles(durations: list[float]) -> dict:
+    """Get the percentiles of durations, in milliseconds."""
+    values = np.asarray(durations) * 1000
+    return {f"p{q}_ms": float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def get_peak_rss() -> float:
+    """Get the peak resident memory of the process, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** (2 if platform.system() == "Darwin" else 1)
+
+
+def get_git_commit() -> Optional[str]:
+    """Get the commit of the benchmarked code."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_queries(nb_queries: int, seed: int = 1) -> list[str]:
+    """Get random queries made of the words of the synthetic mailbox, some of them with filters."""
+    rng = np.random.default_rng(seed)
+    queries = []
+    for number in range(nb_queries):
+        query = " ".join(rng.choice(WORDS, size=rng.integers(2, 6)))
+        if number % 4 == 1:
+            query += " from:acme"
+        elif number % 4 == 2:
+            query += " after:2020/02/01"
+        queries.append(query)
+    return queries
+
+
+def benchmark_ingestion(args, workdir: str) -> tuple[dict, RAGHandler]:
+    """Measure the download, parsing and indexing of the synthetic mailbox."""
+    results: dict = {}
+    messages = generate_mailbox(
+        args.messages, nb_words=args.words, newsletter_ratio=args.newsletter_ratio, seed=args.seed
+    )
+    service = FakeGmailService(messages, latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    email_handler = EmailHandler(
+        "",
+        "",
+        [],
+        batch_size=args.batch_size,
+        max_workers=args.workers,
+        sync_state_path=os.path.join(workdir, "sync_state.json"),
+        html_extractor=args.html_extractor,
+    )
+    email_handler.service = service
+
+    start = time.perf_counter()
+    listing = email_handler.search_messages("")
+    fetched = list(email_handler.fetch_messages(listing))
+    duration = time.perf_counter() - start
+    results["fetch"] = {
+        "messages": len(fetched),
+        "seconds": duration,
+        "messages_per_second": len(fetched) / duration,
+        "api_calls": dict(service.calls),
+    }
+
+    start = time.perf_counter()
+    documents = [document for document in map(email_handler.parse_message, fetched) if document is not None]
+    duration = time.perf_counter() - start
+    results["parse"] = {
+        "documents": len(documents),
+        "seconds": duration,
+        "messages_per_second": len(fetched) / duration,
+    }
+
+    rag = RAGHandler(
+        model=args.model or "hashing",
+        index_dir=os.path.join(workdir, "faiss_index"),
+        index={"type": args.index},
+        hybrid=not args.dense_only,
+        embedding_batch_size=args.embedding_batch_size,
+        dedup=None if args.no_dedup else {},
+    )
+    if not args.model:
+        rag.engine = HashingEmbeddings()
+    rag.set_embeddings()
+
+    start = time.perf_counter()
+    chunks = list(rag.iter_chunks(documents))
+    results["split"] = {"chunks": len(chunks), "seconds": time.perf_counter() - start}
+
+    start = time.perf_counter()
+    rag.reset_vectorestore()
+    with contextlib.redirect_stdout(sys.stderr):
+        rag.ingest(documents)
+    duration = time.perf_counter() - start
+    results["embed"] = rag.engine.get_stats()
+    if rag.deduplicator is not None:
+        results["dedup"] = {"duplicates": rag.deduplicator.get_nb_duplicates()}
+    results["index"] = {
+        "seconds": duration - results["embed"]["seconds"] - results["split"]["seconds"],
+        "ingest_seconds": duration,
+        "chunks_per_second": len(chunks) / duration,
+    }
+
+    start = time.perf_counter()
+    rag.save_vectorestore()
+    results["save"] = {"seconds": time.perf_counter() - start}
+    start = time.perf_counter()
+    rag.load_vectorestore()
+    results["load"] = {"seconds": time.perf_counter() - start}
+    return results, rag
+
+
+def benchmark_queries(args, rag: RAGHandler) -> dict:
+    """Measure the latency of the retrieval, without and with the query caches."""
+    queries = get_queries(args.queries, seed=args.seed + 1)
+    results = {}
+    for name in ("cold", "cached"):
+        durations = []
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for query in queries:
+                start = time.perf_counter()
+                rag.get_context(query)
+                durations.append(time.perf_counter() - start)
+        results[name] = {"queries": len(queries), **get_percentiles(durations)}
+    return results
+
+
+def benchmark_llm(args, rag: RAGHandler) -> dict:
+    """Measure the time to the first token and the duration of the answers of a stub llamafile server."""
+    stub = StubLlamafileServer(prompt_latency=args.prompt_latency, token_latency=args.token_latency)
+    stub.start()
+    try:
+        llm_handler = LLMHandler("", "")
+        host, port = stub.server_address[:2]
+        llm_handler.server = LlamafileServer("", host=host, port=port)
+        llm_handler.set_llm(streaming=True)
+        first_tokens, totals = [], []
+        for query in get_queries(args.llm_queries, seed=args.seed + 2):
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                context = rag.get_context(
+                    query,
+                    llm_handler.count_tokens,
+                    llm_handler.truncate_tokens,
+                    llm_handler.get_context_budget(query),
+                )
+                prompt = llm_handler.prepare_prompt(query, context)
+            start = time.perf_counter()
+            first_token = None
+            for _ in llm_handler.llm_stream(prompt):
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+            first_tokens.append(first_token or 0.0)
+            totals.append(time.perf_counter() - start)
+    finally:
+        stub.stop()
+    return {
+        "queries": len(totals),
+        "first_token": get_percentiles(first_tokens),
+        "answer": get_percentiles(totals),
+    }
+
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    """Flatten nested results to `stage.metric` keys."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(results: dict, previous: dict):
+    """Print the change of each metric compared with a previous run."""
+    current, before = flatten(results["metrics"]), flatten(previous["metrics"])
+    print(f"\nComparison with {previous.get('commit')} ({previous.get('date')}):")
+    for key, value in current.items():
+        if not key.endswith(COMPARED_SUFFIXES) or not before.get(key):
+            continue
+        change = (value - before[key]) / before[key] * 100
+        better = change > 0 if key.split(".")[-1] in HIGHER_IS_BETTER else change < 0
+        flag = "" if abs(change) < 5 else (" (better)" if better else " (worse)")
+        print(f"  {key:45} {before[key]:12.3f} -> {value:12.3f} {change:+7.1f}%{flag}")
+
+
+def main(args: Optional[list] = None):
+    """Run the benchmark and save its results."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--messages", type=int, default=1000, help="number of emails of the synthetic mailbox")
+    parser.add_argument("--words", type=int, default=300, help="average number of words of an email")
+    parser.add_argument("--queries", type=int, default=200, help="number of retrieval queries")
+    parser.add_argument("--llm-queries", type=int, default=10, help="number of questions asked to the stub LLM")
+    parser.add_argument("--model", help="embedding model (deterministic hashing embeddings when not given)")
+    parser.add_argument("--index", default="flat", choices=["flat", "ivf", "hnsw", "ivfpq"])
+    parser.add_argument("--dense-only", action="store_true", help="disable the lexical (BM25) search")
+    parser.add_argument("--no-dedup", action="store_true", help="embed the quoted replies and duplicate chunks")
+    parser.add_argument("--newsletter-ratio", type=float, default=0.0, help="proportion of weekly newsletters")
+    parser.add_argument("--embedding-batch-size", type=int, default=256)
+    parser.add_argument("--html-extractor", default="fast", choices=["fast", "lxml", "beautifulsoup"])
+    parser.add_argument("--batch-size", type=int, default=50, help="messages per Gmail batch request")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent Gmail batch requests")
+    parser.add_argument("--latency", type=float, default=0.05, help="latency of the fake Gmail API, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="rate of 429 errors of the fake Gmail API")
+    parser.add_argument("--prompt-latency", type=float, default=0.0001, help="stub LLM time per prompt token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="stub LLM time per generated token")
+    parser.add_argument("--metrics", action="store_true", help="add the metrics of the instrumented stages")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="path of the JSON results (in benchmarks/results when not given)")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    args = parser.parse_args(args)
+
+    configure(enabled=args.metrics)
+    with tempfile.TemporaryDirectory() as workdir:
+        metrics, rag = benchmark_ingestion(args, workdir)
+        metrics["query"] = benchmark_queries(args, rag)
+        metrics["llm"] = benchmark_llm(args, rag)
+    metrics["memory"] = {"peak_rss_mb": get_peak_rss()}
+    if args.metrics:
+        metrics["stages"] = get_snapshot()
+
+    results = {
+        "commit": get_git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "metrics": metrics,
+    }
+    print(json.dumps(results, indent=2))
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{results['commit'] or 'unknown'}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved in {output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
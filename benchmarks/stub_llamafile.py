@@ -0,0 +1,131 @@
+"""Stub of the llamafile server, streaming canned tokens with a configurable latency."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = "The meeting about the project budget is scheduled next week, as confirmed in the last email."
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Handler of the endpoints of the llamafile server used by the app."""
+
+    server: "StubLlamafileServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body: dict):
+        content = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json({"status": "ok"})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/tokenize":
+            self.send_json({"tokens": self.server.tokenize(body.get("content", ""))})
+        elif self.path == "/detokenize":
+            self.send_json({"content": self.server.detokenize(body.get("tokens", []))})
+        elif self.path == "/completion":
+            self.complete(body)
+        else:
+            self.send_error(404)
+
+    def complete(self, body: dict):
+        # prompt processing, proportional to the length of the prompt
+        time.sleep(self.server.prompt_latency * len(body.get("prompt", "")) / 4)
+        tokens = [word + " " for word in ANSWER.split()]
+        if body.get("n_predict", -1) > 0:
+            tokens = tokens[: body["n_predict"]]
+        if not body.get("stream"):
+            time.sleep(self.server.token_latency * len(tokens))
+            self.send_json({"content": "".join(tokens), "stop": True})
+            return
+        # chunked like the llamafile server, one chunk per token
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for token in tokens:
+                time.sleep(self.server.token_latency)
+                self.write_chunk({"content": token, "stop": False})
+            self.write_chunk({"content": "", "stop": True})
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client closed the stream, the generation is cancelled
+            self.close_connection = True
+
+    def write_chunk(self, body: dict):
+        content = f"data: {json.dumps(body)}\n\n".encode()
+        self.wfile.write(f"{len(content):x}\r\n".encode() + content + b"\r\n")
+        self.wfile.flush()
+
+
+class StubLlamafileServer(ThreadingHTTPServer):
+    """Stub llamafile server, run in a background thread."""
+
+    daemon_threads = True
+
+    def __init__(
+        self, host: str = "127.0.0.1", port: int = 0, prompt_latency: float = 0.0, token_latency: float = 0.01
+    ):
+        """Initialise the server.
+
+        Args:
+            host (str): host the server listens on.
+            port (int): port the server listens on (0 for a free port).
+            prompt_latency (float): time to process a token of the prompt, in seconds.
+            token_latency (float): time to generate a token, in seconds.
+        """
+        super().__init__((host, port), StubHandler)
+        self.prompt_latency = prompt_latency
+        self.token_latency = token_latency
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        # tokens of 4 characters, numbered in the order they are seen
+        self.vocabulary: list[str] = []
+        self.token_ids: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        """Get the URL of the server."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def tokenize(self, text: str) -> list[int]:
+        """Split a text into tokens of 4 characters."""
+        with self.lock:
+            tokens = []
+            for start in range(0, len(text), 4):
+                piece = text[start : start + 4]
+                if piece not in self.token_ids:
+                    self.token_ids[piece] = len(self.vocabulary)
+                    self.vocabulary.append(piece)
+                tokens.append(self.token_ids[piece])
+            return tokens
+
+    def detokenize(self, tokens: list[int]) -> str:
+        """Get the text of tokens."""
+        with self.lock:
+            return "".join(self.vocabulary[token] for token in tokens)
+
+    def start(self):
+        """Start serving in the background."""
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
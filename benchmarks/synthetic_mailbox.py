@@ -0,0 +1,127 @@
+"""Generate a synthetic mailbox, as returned by the Gmail API."""
+import random
+import string
+from base64 import urlsafe_b64encode
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+WORDS = (
+    "meeting invoice project update report budget review deadline contract proposal client team schedule "
+    "payment order delivery shipping account password security newsletter offer discount event webinar "
+    "please thanks regards attached find below kindly confirm question answer follow next week monday friday"
+).split()
+SENDERS = ["alice@acme.com", "bob@globex.com", "news@shop.example", "billing@acme.com", "carol@initech.com"]
+HTML_TEMPLATE = """<html><head><style>body {{ font-family: Arial; }} .footer {{ color: #999; }}</style>
+<script>var tracking = "{tracking}";</script></head>
+<body><table width="100%"><tr><td><h1>{subject}</h1></td></tr>
+{paragraphs}
+<tr><td class="footer">Unsubscribe&nbsp;|&nbsp;View in browser</td></tr></table>
+-------
+<p>Previous newsletter content</p></body></html>"""
+
+
+def encode(text: str) -> str:
+    """Encode a text as the Gmail API does."""
+    return urlsafe_b64encode(text.encode()).decode()
+
+
+def get_text(rng: random.Random, nb_words: int) -> str:
+    """Get a random text."""
+    sentences = []
+    while nb_words > 0:
+        size = min(nb_words, rng.randint(5, 20))
+        sentences.append(" ".join(rng.choice(WORDS) for _ in range(size)).capitalize() + ".")
+        nb_words -= size
+    return " ".join(sentences)
+
+
+def get_html(rng: random.Random, subject: str, text: str) -> str:
+    """Wrap a text in a newsletter-like HTML page."""
+    paragraphs = "\n".join(f"<tr><td><p style='margin:0'>{paragraph}</p></td></tr>" for paragraph in text.split(". "))
+    tracking = "".join(rng.choice(string.ascii_letters) for _ in range(64))
+    return HTML_TEMPLATE.format(subject=subject, paragraphs=paragraphs, tracking=tracking)
+
+
+def generate_mailbox(
+    nb_messages: int = 1000,
+    html_ratio: float = 0.6,
+    attachment_ratio: float = 0.1,
+    thread_size: int = 3,
+    nb_words: int = 300,
+    newsletter_ratio: float = 0.0,
+    seed: int = 0,
+) -> list[dict]:
+    """Generate the messages of a synthetic mailbox, in the `full` format of the Gmail API.
+
+    Args:
+        nb_messages (int): number of messages.
+        html_ratio (float): proportion of messages having an HTML body (multipart/alternative).
+        attachment_ratio (float): proportion of messages having a PDF attachment.
+        thread_size (int): maximum number of messages per thread, replies quoting the previous message.
+        nb_words (int): average number of words of a message body.
+        newsletter_ratio (float): proportion of threads being a weekly newsletter, nearly identical each time.
+        seed (int): seed of the random generator.
+
+    Returns:
+        list[dict]: the messages, sorted from the most recent one as listed by the API.
+    """
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    messages = []
+    thread_id, thread_left, previous_text, subject = None, 0, "", ""
+    newsletter = get_text(random.Random(seed + 1), nb_words) if newsletter_ratio else ""
+    for number in range(nb_messages):
+        is_newsletter = False
+        if thread_left == 0:
+            thread_id = f"t{number:08x}"
+            is_newsletter = bool(newsletter_ratio) and rng.random() < newsletter_ratio
+            thread_left = 1 if is_newsletter else rng.randint(1, thread_size)
+            subject = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))).capitalize()
+            previous_text = ""
+        thread_left -= 1
+        date = start + timedelta(minutes=37 * number)
+        sender = rng.choice(SENDERS)
+        text = get_text(rng, max(10, int(rng.gauss(nb_words, nb_words / 3))))
+        if is_newsletter:
+            # the same content every week, only the introduction changes
+            sender, subject = "news@shop.example", "Weekly newsletter"
+            text = get_text(rng, 15) + " " + newsletter
+        is_reply = bool(previous_text)
+        if is_reply:
+            quoted = "\n".join(f"> {line}" for line in previous_text.splitlines())
+            text = f"{text}\n\nOn {format_datetime(date)} someone wrote:\n{quoted}"
+        previous_text = text
+        headers = [
+            {"name": "From", "value": sender},
+            {"name": "To", "value": "me@example.com"},
+            {"name": "Date", "value": format_datetime(date)},
+            {"name": "Subject", "value": f"Re: {subject}" if is_reply else subject},
+        ]
+        body_parts = [{"mimeType": "text/plain", "filename": "", "headers": [], "body": {"data": encode(text)}}]
+        if rng.random() < html_ratio:
+            html = get_html(rng, subject, text)
+            body_parts.append({"mimeType": "text/html", "filename": "", "headers": [], "body": {"data": encode(html)}})
+        parts = [{"mimeType": "multipart/alternative", "filename": "", "headers": [], "body": {}, "parts": body_parts}]
+        if rng.random() < attachment_ratio:
+            size = rng.randint(10_000, 2_000_000)
+            parts.append(
+                {
+                    "mimeType": "application/pdf",
+                    "filename": f"document_{number}.pdf",
+                    "headers": [
+                        {"name": "Content-Disposition", "value": f'attachment; filename="document_{number}.pdf"'}
+                    ],
+                    "body": {"attachmentId": f"a{number:08x}", "size": size},
+                }
+            )
+        messages.append(
+            {
+                "id": f"{number:016x}",
+                "threadId": thread_id,
+                "labelIds": ["INBOX"] + (["CATEGORY_PROMOTIONS"] if sender.startswith("news") else []),
+                "internalDate": str(int(date.timestamp() * 1000)),
+                "historyId": str(number + 1),
+                "payload": {"mimeType": "multipart/mixed", "headers": headers, "body": {}, "parts": parts},
+            }
+        )
+    return messages[::-1]
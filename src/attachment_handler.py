@@ -0,0 +1,215 @@
+"""Attachments of the emails: metadata, bounded concurrent downloads and text extraction."""
+import os
+import threading
+from base64 import urlsafe_b64decode
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Optional
+
+from src.html_extractor import get_extractor
+from src.metrics import increment, span
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+ATTACHMENT_DIR = os.path.join(DATA_DIR, "attachments")
+DEFAULT_MIME_TYPES = ["application/pdf", "text/plain", "text/csv", "text/markdown", "text/html"]
+# size of the base64 slices decoded at once, a multiple of 4 so that each slice decodes on its own
+DECODE_CHUNK_SIZE = 4 * 256 * 1024
+
+
+def get_attachments(parts) -> list[dict]:
+    """List the attachments of an email, without downloading them.
+
+    Args:
+        parts (list): partitions of the email payload.
+
+    Returns:
+        list[dict]: `filename`, `mime_type`, `size` (in bytes) and `attachment_id` of each attachment.
+    """
+    attachments = []
+    for part in parts or []:
+        if part.get("parts"):
+            attachments.extend(get_attachments(part["parts"]))
+        elif part.get("filename") and part.get("body", {}).get("attachmentId"):
+            attachments.append(
+                {
+                    "filename": part["filename"],
+                    "mime_type": part.get("mimeType", "application/octet-stream"),
+                    "size": part["body"].get("size", 0),
+                    "attachment_id": part["body"]["attachmentId"],
+                }
+            )
+    return attachments
+
+
+def write_base64(data: str, path: str):
+    """Decode base64url data to a file by slices, without holding the whole decoded content in memory."""
+    tmp_path = f"{path}.part"
+    with open(tmp_path, "wb") as f:
+        for start in range(0, len(data), DECODE_CHUNK_SIZE):
+            chunk = data[start : start + DECODE_CHUNK_SIZE]
+            f.write(urlsafe_b64decode(chunk + "=" * (-len(chunk) % 4)))
+    os.replace(tmp_path, path)
+
+
+def read_pdf(path: str) -> str:
+    """Extract the text of a PDF file."""
+    try:
+        from pypdf import PdfReader
+    except ImportError as e:
+        raise ImportError("The text extraction of PDF attachments needs pypdf: pip install pypdf") from e
+    return "\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+
+
+class AttachmentHandler:
+    """Download the attachments of the emails on demand or in a bounded background queue."""
+
+    def __init__(
+        self,
+        folder: str = ATTACHMENT_DIR,
+        download: bool = False,
+        extract_text: bool = False,
+        max_size: int = 10_000_000,
+        mime_types: Optional[list[str]] = None,
+        max_workers: int = 4,
+        max_pending: int = 64,
+    ):
+        """Initialise the handler.
+
+        Args:
+            folder (str): folder where the attachments are saved, in a sub-folder per email.
+            download (bool): whether the allowed attachments are downloaded when the emails are ingested.
+                They are only recorded in the metadata of the emails otherwise.
+            extract_text (bool): whether the text of the allowed attachments is added to their email in the
+                index. The downloaded files are removed after extraction unless `download` is set.
+            max_size (int): maximum size of the attachments downloaded, in bytes.
+            mime_types (list[str]): MIME types of the attachments downloaded (`type/*` allowed).
+            max_workers (int): number of attachments downloaded concurrently.
+            max_pending (int): maximum number of attachments waiting to be downloaded, submitting more blocks.
+        """
+        self.folder = folder
+        self.download = download
+        self.extract_text = extract_text
+        self.max_size = max_size
+        self.mime_types = DEFAULT_MIME_TYPES if mime_types is None else mime_types
+        self.max_workers = max_workers
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.futures: list[Future] = []
+        self.html_to_text = get_extractor("fast")
+        # types whose text cannot be extracted, the optional library being missing
+        self.unreadable_types: set[str] = set()
+
+    @property
+    def enabled(self) -> bool:
+        """Check if the attachments are fetched during the ingestion."""
+        return self.download or self.extract_text
+
+    def is_allowed(self, attachment: dict) -> bool:
+        """Check if an attachment is within the size and MIME type allow-lists."""
+        if attachment.get("size", 0) > self.max_size:
+            return False
+        mime_type = attachment.get("mime_type", "")
+        return any(
+            mime_type == allowed or (allowed.endswith("/*") and mime_type.startswith(allowed[:-1]))
+            for allowed in self.mime_types
+        )
+
+    def get_path(self, message_id: str, attachment: dict) -> str:
+        """Get the path where an attachment is saved."""
+        filename = "".join(c if c.isalnum() or c in ".-_" else "_" for c in attachment["filename"])
+        return os.path.join(self.folder, message_id, filename)
+
+    def fetch(self, service, message_id: str, attachment: dict, path: Optional[str] = None) -> Optional[str]:
+        """Download an attachment, whatever the allow-lists.
+
+        Args:
+            service: Gmail API service.
+            message_id (str): id of the Gmail message of the attachment.
+            attachment (dict): the attachment, as listed by `get_attachments`.
+            path (str): path of the file written (in the attachment folder when not given).
+
+        Returns:
+            str: the path of the file (None if the attachment is empty).
+        """
+        path = path or self.get_path(message_id, attachment)
+        with span("email.download_attachment"):
+            response = (
+                service.users()
+                .messages()
+                .attachments()
+                .get(userId="me", messageId=message_id, id=attachment["attachment_id"])
+                .execute()
+            )
+            data = response.get("data")
+            if not data:
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_base64(data, path)
+        increment("email.attachments_downloaded")
+        return path
+
+    def read_text(self, path: str, mime_type: str) -> str:
+        """Extract the text of a downloaded attachment (empty for the types not supported)."""
+        if mime_type in self.unreadable_types:
+            return ""
+        try:
+            if mime_type == "application/pdf":
+                return read_pdf(path)
+            if mime_type.startswith("text/"):
+                with open(path, encoding="utf-8", errors="replace") as f:
+                    content = f.read()
+                return self.html_to_text(content) if mime_type == "text/html" else content
+        except ImportError as e:
+            if mime_type not in self.unreadable_types:
+                self.unreadable_types.add(mime_type)
+                print(f"Skipping the text of the {mime_type} attachments. {e}")
+        except Exception as e:
+            print(f"Could not extract the text of the attachment {path}: {e}")
+        return ""
+
+    def fetch_text(self, service, message_id: str, attachment: dict) -> str:
+        """Download an attachment and extract its text.
+
+        The text is only extracted if `extract_text` is set, and the file only kept if `download` is set.
+        """
+        path = self.fetch(service, message_id, attachment)
+        if path is None or not self.extract_text:
+            return ""
+        with span("email.attachment_text"):
+            text = self.read_text(path, attachment["mime_type"])
+        if not self.download:
+            os.remove(path)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+        return text
+
+    def submit(self, function: Callable, *args) -> Future:
+        """Run a download in the background queue, waiting while `max_pending` downloads are queued.
+
+        Args:
+            function (Callable): the download, e.g. `fetch` or `fetch_text`.
+            *args: its arguments.
+
+        Returns:
+            Future: the result of the download.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.pending.acquire()
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(self.release)
+        self.futures = [pending for pending in self.futures if not pending.done()] + [future]
+        return future
+
+    def release(self, future: Future):
+        """Free the place of a finished download in the queue, reporting its failure."""
+        self.pending.release()
+        if future.exception() is not None:
+            increment("email.attachment_errors")
+            print(f"Could not download an attachment: {future.exception()}")
+
+    def wait(self):
+        """Wait for the downloads of the queue to be done."""
+        wait(self.futures)
+        self.futures = []
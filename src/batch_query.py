@@ -0,0 +1,162 @@
+"""Answer a batch of questions read from a JSONL file, e.g. nightly triage questions over the mailbox.
+
+Each input line is a JSON object with a `query` (and an optional `id`, its line number otherwise). The
+questions are retrieved by batches: embedded in a single call to the model and searched in a single call
+to the index. Their answers are generated concurrently, up to the number of slots of the llamafile server,
+and written as JSON lines as soon as they are ready, with their latency:
+
+    python -m src.batch_query questions.jsonl --output answers.jsonl
+"""
+import argparse
+import contextlib
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from typing import Iterator, Optional
+
+from src.llm_handler import LLMHandler
+from src.metrics import increment, observe
+from src.query_service import build_service
+from src.rag_handler import RAGHandler
+from src.utils import get_config
+
+
+def read_queries(path: str) -> Iterator[dict]:
+    """Read the questions of a JSONL file, skipping the blank lines.
+
+    Args:
+        path (str): path of the file, `-` for the standard input.
+
+    Yields:
+        dict: the `id` and the `query` of each question, with the other fields of its line.
+    """
+    with contextlib.ExitStack() as stack:
+        f = sys.stdin if path == "-" else stack.enter_context(open(path, encoding="utf-8"))
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not item.get("query"):
+                print(f"Skipping line {number} of {path}: no query")
+                continue
+            item.setdefault("id", number)
+            yield item
+
+
+def answer(llm_handler: LLMHandler, item: dict, context: str, retrieval_seconds: float) -> dict:
+    """Generate the answer to a question, once its context is retrieved."""
+    start = time.perf_counter()
+    try:
+        result = {**item, "answer": llm_handler.llm_invoke(llm_handler.prepare_prompt(item["query"], context))}
+    except Exception as e:
+        increment("batch.errors")
+        result = {**item, "answer": None, "error": str(e)}
+    generation_seconds = time.perf_counter() - start
+    observe("batch.generation_seconds", generation_seconds)
+    return {
+        **result,
+        "retrieval_seconds": retrieval_seconds,
+        "generation_seconds": generation_seconds,
+        "latency_seconds": retrieval_seconds + generation_seconds,
+    }
+
+
+def run_batch(
+    rag_service: RAGHandler,
+    llm_handler: LLMHandler,
+    items: Iterator[dict],
+    output,
+    batch_size: int = 64,
+    concurrency: int = 1,
+) -> int:
+    """Answer questions by batches, writing the answers as JSON lines in the order they are generated.
+
+    Args:
+        rag_service (RAGHandler): the RAG, with its vector store loaded.
+        llm_handler (LLMHandler): the LLM, with its llamafile server started.
+        items (Iterator[dict]): the questions, see `read_queries`.
+        output: text stream the answers are written to.
+        batch_size (int): number of questions retrieved together.
+        concurrency (int): number of answers generated at the same time.
+
+    Returns:
+        int: the number of answers written.
+    """
+    nb_answers = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = set()
+        while True:
+            batch = list(islice(items, batch_size))
+            if not batch:
+                break
+            start = time.perf_counter()
+            # the documents found are printed for each question, keep them out of the output
+            with contextlib.redirect_stdout(sys.stderr):
+                queries = [item["query"] for item in batch]
+                contexts = rag_service.get_contexts(
+                    queries,
+                    llm_handler.count_tokens,
+                    llm_handler.truncate_tokens,
+                    [llm_handler.get_context_budget(query) for query in queries],
+                )
+            # the retrieval of a batch is shared by its questions
+            retrieval_seconds = (time.perf_counter() - start) / len(batch)
+            futures.update(
+                executor.submit(answer, llm_handler, item, context, retrieval_seconds)
+                for item, context in zip(batch, contexts)
+            )
+            # keep at most a batch of answers waiting, the next batch being retrieved while they are generated
+            while len(futures) > batch_size:
+                done = next(as_completed(futures))
+                futures.remove(done)
+                write_result(output, done.result())
+                nb_answers += 1
+        for future in as_completed(futures):
+            write_result(output, future.result())
+            nb_answers += 1
+    return nb_answers
+
+
+def write_result(output, result: dict):
+    """Write an answer as a JSON line."""
+    output.write(json.dumps(result, ensure_ascii=False) + "\n")
+    output.flush()
+    increment("batch.answers")
+
+
+def main(args: Optional[list] = None):
+    """Answer the questions of a JSONL file."""
+    config = get_config()
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("input", help="JSONL file of questions (`-` for the standard input)")
+    parser.add_argument("--output", default="-", help="JSONL file of the answers (standard output by default)")
+    parser.add_argument("--batch-size", type=int, default=64, help="number of questions retrieved together")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="number of answers generated at the same time (the slots of the llamafile server by default)",
+    )
+    args = parser.parse_args(args)
+
+    with contextlib.ExitStack() as stack:
+        output = sys.stdout if args.output == "-" else stack.enter_context(open(args.output, "w", encoding="utf-8"))
+        # the answers are the only output, the progress of the set up goes to the standard error
+        stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+        service = build_service(config)
+        start = time.perf_counter()
+        nb_answers = run_batch(
+            service.rag_service,
+            service.llm_handler,
+            read_queries(args.input),
+            output,
+            batch_size=args.batch_size,
+            concurrency=args.concurrency or service.slots,
+        )
+        duration = time.perf_counter() - start
+    print(f"{nb_answers} answers in {duration:.1f}s ({nb_answers / duration:.2f} per second)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
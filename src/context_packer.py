@@ -0,0 +1,131 @@
+"""Pack the retrieved chunks into a context fitting a token budget."""
+import re
+from typing import Callable, Optional
+
+from langchain_core.documents import Document
+
+CONTEXT_SEPARATOR = "\n------\n"
+# minimum number of tokens left in the budget to add a truncated chunk
+MIN_TRUNCATED_TOKENS = 64
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of a text when the tokenizer of the model is not available."""
+    return len(text) // 4 + 1
+
+
+def truncate_text(text: str, max_tokens: int) -> str:
+    """Cut a text to an estimated number of tokens when the tokenizer of the model is not available."""
+    return text[: max(0, max_tokens - 1) * 4]
+
+
+def get_shingles(text: str, size: int = 3) -> set:
+    """Get the sets of consecutive words of a text."""
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i : i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+def merge_texts(first: str, second: str, max_overlap: int) -> str:
+    """Concatenate two consecutive chunks, removing the text they have in common.
+
+    The chunks are split at whitespace, so the common text must be whole words, and at least half the
+    overlap, not to glue chunks which do not overlap: they are separated by a space otherwise.
+    """
+    min_overlap = max(1, max_overlap // 2)
+    for size in range(min(max_overlap, len(first), len(second)), min_overlap - 1, -1):
+        if (
+            first.endswith(second[:size])
+            and (size == len(first) or first[-size - 1].isspace())
+            and (size == len(second) or second[size].isspace())
+        ):
+            return first + second[size:]
+    return first + " " + second
+
+
+def merge_chunks(results: list[tuple[Document, float]], max_overlap: int) -> list[tuple[Document, float]]:
+    """Merge the consecutive chunks of a same email into one document.
+
+    Args:
+        results (list[tuple[Document, float]]): chunks ordered by relevance.
+        max_overlap (int): overlap between consecutive chunks.
+
+    Returns:
+        list[tuple[Document, float]]: the documents, at the rank of their most relevant chunk.
+    """
+    groups: dict = {}
+    order = []
+    for doc, score in results:
+        message_id = doc.metadata.get("message_id")
+        key = message_id if message_id is not None and "chunk" in doc.metadata else id(doc)
+        if key not in groups:
+            groups[key] = []
+            order.append((key, score))
+        groups[key].append(doc)
+    merged = []
+    for key, score in order:
+        docs = sorted(groups[key], key=lambda doc: doc.metadata.get("chunk", 0))
+        text = docs[0].page_content
+        for previous, doc in zip(docs, docs[1:]):
+            if doc.metadata.get("chunk") == previous.metadata.get("chunk", -2) + 1:
+                text = merge_texts(text, doc.page_content, max_overlap)
+            else:
+                text += "\n[...]\n" + doc.page_content
+        merged.append((Document(page_content=text, metadata=docs[0].metadata), score))
+    return merged
+
+
+def pack_context(
+    results: list[tuple[Document, float]],
+    token_budget: int,
+    format_document: Callable[[Document], str],
+    count_tokens: Optional[Callable[[str], int]] = None,
+    max_overlap: int = 0,
+    duplicate_threshold: float = 0.8,
+    truncate_tokens: Optional[Callable[[str, int], str]] = None,
+) -> str:
+    """Build the context of a prompt from retrieved chunks, within a token budget.
+
+    The consecutive chunks of a same email are merged, the near-duplicates of more relevant chunks are
+    dropped, and the chunks are added by relevance until the budget is reached, the last one truncated.
+
+    Args:
+        results (list[tuple[Document, float]]): retrieved chunks, ordered by relevance.
+        token_budget (int): maximum number of tokens of the context.
+        format_document (Callable): function formatting a chunk for the prompt.
+        count_tokens (Callable): function counting the tokens of a text with the tokenizer of the model,
+            estimated from the number of characters when not given.
+        max_overlap (int): overlap between consecutive chunks.
+        duplicate_threshold (float): similarity (Jaccard index of word shingles) above which a chunk is a
+            near-duplicate of another.
+        truncate_tokens (Callable): function cutting a text to a number of tokens of the tokenizer of the model,
+            estimated from the number of characters when not given.
+
+    Returns:
+        str: the context.
+    """
+    count_tokens = count_tokens or estimate_tokens
+    truncate_tokens = truncate_tokens or truncate_text
+    separator_tokens = count_tokens(CONTEXT_SEPARATOR)
+    selected: list[str] = []
+    selected_shingles: list[set] = []
+    remaining = token_budget
+    for doc, _ in merge_chunks(results, max_overlap):
+        shingles = get_shingles(doc.page_content)
+        if any(len(shingles & other) / len(shingles | other) >= duplicate_threshold for other in selected_shingles):
+            continue
+        text = format_document(doc)
+        cost = count_tokens(text) + (separator_tokens if selected else 0)
+        if cost > remaining:
+            if remaining < MIN_TRUNCATED_TOKENS:
+                break
+            # the text is tokenized once and cut at the budget left
+            text = truncate_tokens(text, remaining - (separator_tokens if selected else 0))
+            if not text:
+                break
+            cost = remaining
+        selected.append(text)
+        selected_shingles.append(shingles)
+        remaining -= cost
+        if remaining <= 0:
+            break
+    return CONTEXT_SEPARATOR.join(selected)
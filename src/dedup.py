@@ -0,0 +1,339 @@
+"""Removal of the quoted replies and of the near-duplicate chunks of the emails before they are embedded.
+
+Every reply of a thread repeats the history of the thread, and newsletters are nearly identical from one
+week to the next. The quoted text and the signature of the emails are stripped, then each chunk is compared
+by SimHash with the chunks already indexed: a near-duplicate is not embedded, it is only recorded as a
+back-reference of the chunk it duplicates, so that the answers can still cite all the emails it comes from.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from typing import Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+# number of words of the shingles hashed by SimHash
+SHINGLE_SIZE = 3
+# the 64 bits of a fingerprint are split into bands: fingerprints with less differing bits than bands share
+# at least one band, so that only the chunks sharing a band are compared
+NB_BANDS = 4
+BAND_BITS = 64 // NB_BANDS
+# metadata of the duplicates given as back-references
+REFERENCE_FIELDS = ("message_id", "thread_id", "from", "date", "subject")
+
+WORD_PATTERN = re.compile(r"\w+")
+# first line of a quoted reply, e.g. "On Mon, 3 Jun 2024 at 10:00, John <john@acme.com> wrote:"
+REPLY_HEADER_PATTERN = re.compile(r"^(on|le|am|el)\b.*\b(wrote|a écrit|schrieb|escribió)\s*:$", re.IGNORECASE)
+# headers of the previous email quoted by Outlook
+OUTLOOK_HEADER_PATTERN = re.compile(r"^(-{2,}\s*original message\s*-{2,}|_{10,})$", re.IGNORECASE)
+OUTLOOK_FIELDS_PATTERN = re.compile(r"^(from|de|von)\s*:.+\n(sent|envoyé|gesendet|date)\s*:", re.IGNORECASE)
+HEADER_FIELD_PATTERN = re.compile(
+    r"^(from|de|von|sent|envoyé|gesendet|date|datum|to|à|an|cc|subject|objet|betreff)\s*:", re.IGNORECASE
+)
+# first line of a forwarded email, whose text is not quoted anywhere else
+FORWARD_HEADER_PATTERN = re.compile(
+    r"^(-{2,}\s*(forwarded message|message transféré|weitergeleitete nachricht|mensaje reenviado)\s*-{2,}"
+    r"|begin forwarded message\s*:|début du message réexpédié\s*:)$",
+    re.IGNORECASE,
+)
+SIGNATURE_DELIMITER = "-- "
+MOBILE_SIGNATURE_PATTERN = re.compile(r"^(sent from my \w+|get outlook for \w+|envoyé de mon \w+)", re.IGNORECASE)
+
+
+def skip_header_fields(lines: list[str], start: int) -> int:
+    """Get the number of the first line after the header fields (`From:`, `Sent:`, ...) starting at a line."""
+    while start < len(lines) and HEADER_FIELD_PATTERN.match(lines[start].strip()):
+        start += 1
+    return start
+
+
+def match_quote_header(lines: list[str], number: int) -> Optional[int]:
+    """Get the number of the line following the header of a quoted email starting at a line, if there is one.
+
+    The headers are the "On ... wrote:" line of a reply (over at most 3 lines), and the separator and the
+    fields of an email quoted by Outlook.
+    """
+    stripped = lines[number].strip()
+    if OUTLOOK_HEADER_PATTERN.match(stripped):
+        return skip_header_fields(lines, number + 1)
+    if OUTLOOK_FIELDS_PATTERN.match("\n".join(lines[number : number + 2]).strip()):
+        return skip_header_fields(lines, number)
+    if stripped[:3].lower() in ("on ", "le ", "am ", "el "):
+        for end in range(number + 1, min(number + 4, len(lines) + 1)):
+            if REPLY_HEADER_PATTERN.match(" ".join(part.strip() for part in lines[number:end])):
+                return end
+    return None
+
+
+def strip_quoted(text: str) -> str:
+    """Remove the quoted previous emails and the signature of the text of an email.
+
+    A quoted block, i.e. the header of a quoted reply ("On ... wrote:") or of an email quoted by Outlook and
+    the quoted lines (`>`) following it, is dropped, the text written after it (bottom-posted and inline
+    replies) being kept. The signature is dropped from its delimiter (`-- `). Forwarded emails are kept with
+    their headers, their text being found nowhere else.
+
+    Args:
+        text (str): the text of an email.
+
+    Returns:
+        str: the text written or forwarded by the sender of the email.
+    """
+    lines = text.splitlines()
+    kept: list[str] = []
+    number = 0
+    in_signature = False
+    while number < len(lines):
+        line = lines[number]
+        stripped = line.strip()
+        if FORWARD_HEADER_PATTERN.match(stripped):
+            in_signature = False
+            end = skip_header_fields(lines, number + 1)
+            kept.extend(lines[number:end])
+            number = end
+            continue
+        if in_signature or line.rstrip("\r") == SIGNATURE_DELIMITER:
+            in_signature = True
+            number += 1
+            continue
+        end = match_quote_header(lines, number)
+        if end is not None:
+            number = end
+            while number < len(lines) and (not lines[number].strip() or lines[number].lstrip().startswith(">")):
+                number += 1
+            continue
+        if not (stripped.startswith(">") or MOBILE_SIGNATURE_PATTERN.match(stripped)):
+            kept.append(line)
+        number += 1
+    return "\n".join(kept).strip()
+
+
+def hash_shingle(shingle: str) -> int:
+    """Hash a shingle on 64 bits, the same way in every process."""
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def simhash(text: str) -> int:
+    """Compute the 64 bits SimHash fingerprint of a text, from the shingles of its words.
+
+    Texts sharing most of their shingles have fingerprints differing by only a few bits.
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    shingles = {" ".join(words[start : start + SHINGLE_SIZE]) for start in range(max(len(words) - SHINGLE_SIZE, 0) + 1)}
+    hashes = np.fromiter((hash_shingle(shingle) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    bits = (hashes[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    majority = bits.sum(axis=0) * 2 > len(hashes)
+    return int(sum(1 << int(bit) for bit in np.flatnonzero(majority)))
+
+
+def hamming_distance(first: int, second: int) -> int:
+    """Get the number of bits differing between two fingerprints."""
+    return bin(first ^ second).count("1")
+
+
+def to_signed(fingerprint: int) -> int:
+    """Convert an unsigned 64 bits fingerprint to the signed integer stored by SQLite."""
+    return fingerprint - (1 << 64) if fingerprint >= 1 << 63 else fingerprint
+
+
+def get_bands(fingerprint: int) -> list[int]:
+    """Split a fingerprint into its bands."""
+    mask = (1 << BAND_BITS) - 1
+    return [(fingerprint >> (band * BAND_BITS)) & mask for band in range(NB_BANDS)]
+
+
+class Deduplicator:
+    """SQLite store of the fingerprints of the chunks indexed, and of the near-duplicates skipped.
+
+    Like the docstore, the changes are only committed by `commit`, when the index is saved.
+    """
+
+    def __init__(self, path: str, max_distance: int = 3, thread_max_distance: int = 10):
+        """Open the store, creating it if needed.
+
+        Args:
+            path (str): path of the SQLite database.
+            max_distance (int): maximum number of bits differing between the fingerprints of two chunks of
+                different threads for them to be duplicates (at most 3, see `NB_BANDS`).
+            thread_max_distance (int): maximum number of bits differing between the fingerprints of two
+                chunks of the same thread for them to be duplicates, which are all compared.
+        """
+        self.path = path
+        self.max_distance = min(max_distance, NB_BANDS - 1)
+        self.thread_max_distance = thread_max_distance
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        bands = "".join(f"band{band} INTEGER NOT NULL, " for band in range(NB_BANDS))
+        self.connection.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                docstore_id TEXT PRIMARY KEY,
+                message_id TEXT,
+                thread_id TEXT,
+                {bands}
+                fingerprint INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS fingerprints_message_id ON fingerprints (message_id);
+            CREATE INDEX IF NOT EXISTS fingerprints_thread_id ON fingerprints (thread_id);
+            CREATE TABLE IF NOT EXISTS duplicates (
+                docstore_id TEXT PRIMARY KEY,
+                original_id TEXT NOT NULL,
+                message_id TEXT,
+                content TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS duplicates_original_id ON duplicates (original_id);
+            CREATE INDEX IF NOT EXISTS duplicates_message_id ON duplicates (message_id);
+            """
+            + "".join(
+                f"CREATE INDEX IF NOT EXISTS fingerprints_band{band} ON fingerprints (band{band});\n"
+                for band in range(NB_BANDS)
+            )
+        )
+        self.connection.commit()
+
+    def get_nb_duplicates(self) -> int:
+        """Get the number of chunks skipped as duplicates."""
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM duplicates").fetchone()[0]
+
+    def find_original(self, fingerprint: int, thread_id: Optional[str]) -> Optional[str]:
+        """Get the docstore id of the chunk nearest to a fingerprint, if it is near enough to be duplicated."""
+        bands = get_bands(fingerprint)
+        with self.lock:
+            candidates = self.connection.execute(
+                "SELECT docstore_id, fingerprint, thread_id FROM fingerprints WHERE "
+                + " OR ".join(f"band{band} = ?" for band in range(NB_BANDS)),
+                bands,
+            ).fetchall()
+            if thread_id is not None:
+                candidates += self.connection.execute(
+                    "SELECT docstore_id, fingerprint, thread_id FROM fingerprints WHERE thread_id = ?", (thread_id,)
+                ).fetchall()
+        best = None
+        for docstore_id, candidate, candidate_thread_id in candidates:
+            distance = hamming_distance(fingerprint, candidate % (1 << 64))
+            same_thread = thread_id is not None and candidate_thread_id == thread_id
+            max_distance = self.thread_max_distance if same_thread else self.max_distance
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, docstore_id)
+        return None if best is None else best[1]
+
+    def add(self, docstore_id: str, chunk: Document) -> Optional[str]:
+        """Record a chunk, as a near-duplicate if there is one indexed.
+
+        Args:
+            docstore_id (str): the id of the chunk.
+            chunk (Document): the chunk, tagged with the ids of its Gmail message and thread.
+
+        Returns:
+            Optional[str]: the docstore id of the chunk it duplicates, None if it must be indexed.
+        """
+        fingerprint = simhash(chunk.page_content)
+        message_id = chunk.metadata.get("message_id")
+        thread_id = chunk.metadata.get("thread_id")
+        original_id = self.find_original(fingerprint, thread_id)
+        with self.lock:
+            if original_id is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO duplicates VALUES (?, ?, ?, ?, ?)",
+                    (
+                        docstore_id,
+                        original_id,
+                        message_id,
+                        chunk.page_content,
+                        json.dumps(chunk.metadata, ensure_ascii=False),
+                    ),
+                )
+            else:
+                self.connection.execute(
+                    f"INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, {'?, ' * NB_BANDS}?)",
+                    (docstore_id, message_id, thread_id, *get_bands(fingerprint), to_signed(fingerprint)),
+                )
+        return original_id
+
+    def remove_messages(self, message_ids: list[str]) -> list[Document]:
+        """Forget the chunks of Gmail messages.
+
+        The duplicates of their chunks lose their original: they are returned to be indexed in its place.
+
+        Args:
+            message_ids (list[str]): ids of the Gmail messages removed.
+
+        Returns:
+            list[Document]: the chunks of the other messages which were duplicates of the removed chunks.
+        """
+        orphans = []
+        with self.lock:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS removed (message_id TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM removed")
+            self.connection.executemany("INSERT OR IGNORE INTO removed VALUES (?)", ((id_,) for id_ in message_ids))
+            self.connection.execute("DELETE FROM duplicates WHERE message_id IN (SELECT message_id FROM removed)")
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS removed_chunks (docstore_id TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM removed_chunks")
+            self.connection.execute(
+                "INSERT INTO removed_chunks SELECT docstore_id FROM fingerprints "
+                "WHERE message_id IN (SELECT message_id FROM removed)"
+            )
+            self.connection.execute("DELETE FROM fingerprints WHERE docstore_id IN (SELECT * FROM removed_chunks)")
+            for content, metadata in self.connection.execute(
+                "SELECT content, metadata FROM duplicates WHERE original_id IN (SELECT * FROM removed_chunks)"
+            ):
+                orphans.append(Document(page_content=content, metadata=json.loads(metadata)))
+            self.connection.execute("DELETE FROM duplicates WHERE original_id IN (SELECT * FROM removed_chunks)")
+        return orphans
+
+    def get_duplicates(self, docstore_id: str) -> list[dict]:
+        """Get the emails of the duplicates of a chunk, to cite them with it."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT metadata FROM duplicates WHERE original_id = ? ORDER BY docstore_id", (docstore_id,)
+            ).fetchall()
+        references = []
+        for (metadata,) in rows:
+            metadata = json.loads(metadata)
+            references.append({name: metadata[name] for name in REFERENCE_FIELDS if metadata.get(name)})
+        return references
+
+    def iter_duplicates(self, batch_size: int = 1000):
+        """Read the duplicates by batches, to index them again.
+
+        Yields:
+            tuple[list[str], list[str], list[Document]]: the ids of the duplicates, of the chunks they duplicate,
+                and the duplicates.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT docstore_id, original_id, content, metadata FROM duplicates")
+            while True:
+                batch = rows.fetchmany(batch_size)
+                if not batch:
+                    return
+                yield (
+                    [docstore_id for docstore_id, _, _, _ in batch],
+                    [original_id for _, original_id, _, _ in batch],
+                    [
+                        Document(page_content=content, metadata=json.loads(metadata))
+                        for _, _, content, metadata in batch
+                    ],
+                )
+
+    def clear(self):
+        """Forget all the chunks."""
+        with self.lock:
+            self.connection.execute("DELETE FROM fingerprints")
+            self.connection.execute("DELETE FROM duplicates")
+
+    def commit(self):
+        """Save the changes on disk."""
+        with self.lock:
+            self.connection.commit()
+
+    def rollback(self):
+        """Discard the changes made since the last commit."""
+        with self.lock:
+            self.connection.rollback()
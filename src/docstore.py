@@ -0,0 +1,267 @@
+"""On-disk docstore of the chunks of the vector store, replacing the pickled in-memory docstore."""
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import Mapping
+from typing import Iterator, Optional, Union
+
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+# maximum number of parameters of a SQLite query
+BATCH_SIZE = 500
+
+
+class SQLiteDocstore(Docstore, AddableMixin):
+    """SQLite store of the text and metadata of the chunks, with the row of their vector in the FAISS index.
+
+    Only the chunks returned by a search are read, so opening the store takes the same time and memory
+    whatever the size of the mailbox. The changes are only committed by `commit`, when the index is saved,
+    so that the store stays consistent with the saved index if the process stops in between.
+    """
+
+    def __init__(self, path: str):
+        """Open the store, creating it if needed.
+
+        Args:
+            path (str): path of the SQLite database.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                row INTEGER NOT NULL,
+                docstore_id TEXT UNIQUE NOT NULL,
+                message_id TEXT,
+                content TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chunks_row ON chunks (row);
+            CREATE INDEX IF NOT EXISTS chunks_message_id ON chunks (message_id);
+            CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            """
+        )
+        self.connection.commit()
+
+    def __len__(self) -> int:
+        """Get the number of chunks in the store."""
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def search(self, search: str) -> Union[str, Document]:
+        """Get a chunk by its docstore id (a message if it is not found, like the other langchain docstores)."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT content, metadata FROM chunks WHERE docstore_id = ?", (search,)
+            ).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def add(self, texts: dict[str, Document]):
+        """Add chunks after the last row (see `add_rows` to set their rows)."""
+        start = self.get_max_row() + 1
+        self.add_rows(list(range(start, start + len(texts))), list(texts), list(texts.values()))
+
+    def add_rows(self, rows: list[int], docstore_ids: list[str], documents: list[Document]):
+        """Add chunks, with the rows of their vectors in the index.
+
+        Args:
+            rows (list[int]): rows of the vectors of the chunks.
+            docstore_ids (list[str]): ids of the chunks.
+            documents (list[Document]): the chunks.
+        """
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO chunks (row, docstore_id, message_id, content, metadata) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        row,
+                        docstore_id,
+                        document.metadata.get("message_id"),
+                        document.page_content,
+                        json.dumps(document.metadata, ensure_ascii=False),
+                    )
+                    for row, docstore_id, document in zip(rows, docstore_ids, documents)
+                ),
+            )
+
+    def delete(self, ids: list[str]):
+        """Remove chunks, the rows of the other chunks being unchanged."""
+        with self.lock:
+            for start in range(0, len(ids), BATCH_SIZE):
+                batch = ids[start : start + BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                self.connection.execute(f"DELETE FROM chunks WHERE docstore_id IN ({placeholders})", batch)
+
+    def delete_rows(self, rows: list[int], shift: bool = False):
+        """Remove the chunks of some rows.
+
+        Args:
+            rows (list[int]): the rows removed.
+            shift (bool): whether the following rows are shifted down, as in a flat index.
+        """
+        if not rows:
+            return
+        with self.lock:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS removed (row INTEGER PRIMARY KEY)")
+            self.connection.execute("DELETE FROM removed")
+            self.connection.executemany("INSERT OR IGNORE INTO removed VALUES (?)", ((row,) for row in rows))
+            self.connection.execute("DELETE FROM chunks WHERE row IN (SELECT row FROM removed)")
+            if shift:
+                self.connection.execute(
+                    "UPDATE chunks SET row = row - (SELECT COUNT(*) FROM removed WHERE removed.row < chunks.row) "
+                    "WHERE row > ?",
+                    (min(rows),),
+                )
+
+    def clear(self):
+        """Remove all the chunks."""
+        with self.lock:
+            self.connection.execute("DELETE FROM chunks")
+
+    def commit(self):
+        """Save the changes on disk."""
+        with self.lock:
+            self.connection.commit()
+
+    def rollback(self):
+        """Discard the changes made since the last commit."""
+        with self.lock:
+            self.connection.rollback()
+
+    def get_state(self, key: str) -> Optional[str]:
+        """Get a value saved with the chunks (None if it is not set)."""
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_state(self, key: str, value: str):
+        """Set a value saved with the chunks, committed with them."""
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    def close(self):
+        """Close the store, discarding the changes not committed."""
+        with self.lock:
+            self.connection.close()
+
+    def get_max_row(self) -> int:
+        """Get the last row of the chunks (-1 if there are none)."""
+        with self.lock:
+            row = self.connection.execute("SELECT MAX(row) FROM chunks").fetchone()[0]
+        return -1 if row is None else row
+
+    def get_ids(self, rows: list[int]) -> dict[int, str]:
+        """Get the docstore ids of the chunks of some rows, the rows without a chunk being skipped."""
+        result = {}
+        with self.lock:
+            for start in range(0, len(rows), BATCH_SIZE):
+                batch = rows[start : start + BATCH_SIZE]
+                result.update(
+                    self.connection.execute(
+                        f"SELECT row, docstore_id FROM chunks WHERE row IN ({','.join('?' * len(batch))})", batch
+                    ).fetchall()
+                )
+        return result
+
+    def get_rows(self, docstore_ids: list[str]) -> list[int]:
+        """Get the rows of chunks (in no particular order), the unknown ids being skipped."""
+        rows = []
+        with self.lock:
+            for start in range(0, len(docstore_ids), BATCH_SIZE):
+                batch = docstore_ids[start : start + BATCH_SIZE]
+                rows.extend(
+                    row
+                    for (row,) in self.connection.execute(
+                        f"SELECT row FROM chunks WHERE docstore_id IN ({','.join('?' * len(batch))})", batch
+                    )
+                )
+        return rows
+
+    def get_message_chunks(self, message_ids: list[str]) -> list[str]:
+        """Get the docstore ids of the chunks of Gmail messages."""
+        docstore_ids = []
+        with self.lock:
+            for start in range(0, len(message_ids), BATCH_SIZE):
+                batch = message_ids[start : start + BATCH_SIZE]
+                docstore_ids.extend(
+                    docstore_id
+                    for (docstore_id,) in self.connection.execute(
+                        f"SELECT docstore_id FROM chunks WHERE message_id IN ({','.join('?' * len(batch))})", batch
+                    )
+                )
+        return docstore_ids
+
+    def iter_documents(self, batch_size: int = 1000) -> Iterator[tuple[list[str], list[Document]]]:
+        """Read all the chunks, ordered by row, by batches of ids and documents."""
+        last_row = -1
+        while True:
+            with self.lock:
+                batch = self.connection.execute(
+                    "SELECT row, docstore_id, content, metadata FROM chunks WHERE row > ? ORDER BY row LIMIT ?",
+                    (last_row, batch_size),
+                ).fetchall()
+            if not batch:
+                return
+            last_row = batch[-1][0]
+            yield [docstore_id for _, docstore_id, _, _ in batch], [
+                Document(page_content=content, metadata=json.loads(metadata)) for _, _, content, metadata in batch
+            ]
+
+    def get_all_rows(self) -> list[int]:
+        """Get the rows of all the chunks, in order."""
+        with self.lock:
+            rows = self.connection.execute("SELECT row FROM chunks ORDER BY row").fetchall()
+        return [row for (row,) in rows]
+
+    def sample_texts(self, size: int) -> list[str]:
+        """Get the text of a random sample of chunks."""
+        with self.lock:
+            rows = self.connection.execute("SELECT content FROM chunks ORDER BY RANDOM() LIMIT ?", (size,)).fetchall()
+        return [content for (content,) in rows]
+
+
+class RowMapping(Mapping):
+    """Read-only view of the rows of a `SQLiteDocstore`, as the `index_to_docstore_id` of a langchain FAISS."""
+
+    def __init__(self, docstore: SQLiteDocstore):
+        """Initialise the view.
+
+        Args:
+            docstore (SQLiteDocstore): the docstore whose rows are read.
+        """
+        self.docstore = docstore
+
+    def __getitem__(self, row: int) -> str:
+        """Get the docstore id of the chunk of a row.
+
+        Raises:
+            KeyError: if the row has no chunk.
+        """
+        docstore_id = self.get(row)
+        if docstore_id is None:
+            raise KeyError(row)
+        return docstore_id
+
+    def get(self, row: int, default: Optional[str] = None) -> Optional[str]:
+        """Get the docstore id of the chunk of a row, or `default` if it has none."""
+        return self.docstore.get_ids([int(row)]).get(int(row), default)
+
+    def __contains__(self, row) -> bool:
+        """Check if a row has a chunk."""
+        return self.get(row) is not None
+
+    def __len__(self) -> int:
+        """Get the number of rows with a chunk."""
+        return len(self.docstore)
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the rows with a chunk, in order."""
+        return iter(self.docstore.get_all_rows())
@@ -1,58 +1,123 @@
 """Classes to handle email interactions."""
+import json
 import os
 import pickle
+import random
+import threading
+import time
 from base64 import urlsafe_b64decode
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Optional
 
-from bs4 import BeautifulSoup
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from langchain_core.documents import Document
 from tqdm import tqdm
 
+from src.attachment_handler import AttachmentHandler, get_attachments
+from src.html_extractor import get_extractor
+from src.metrics import increment, span, timed
+
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+SYNC_STATE_PATH = os.path.join(DATA_DIR, "sync_state.json")
+# file written in each email folder to keep track of the Gmail message it comes from
+MESSAGE_ID_FILE = ".message_id"
+# messages with these labels are not part of the mailbox listed by `search_messages("")`
+IGNORED_LABELS = {"DRAFT", "SPAM", "TRASH"}
+# HTTP status codes returned by the Gmail API when a request should be retried later
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded"}
+MAX_BACKOFF = 32
+DEFAULT_EXTRACTOR = get_extractor("fast")
+
+
+def is_retryable(error: Exception) -> bool:
+    """Check if an error raised by the Gmail API is a transient quota or server error."""
+    if not isinstance(error, HttpError):
+        return False
+    status = getattr(error.resp, "status", None)
+    if status in RETRYABLE_STATUS:
+        return True
+    if status == 403:
+        # quota errors are reported as 403 with a rate limit reason
+        details = getattr(error, "error_details", None) or []
+        reasons = {detail.get("reason") for detail in details if isinstance(detail, dict)}
+        return bool(reasons & RATE_LIMIT_REASONS) or "rate limit" in str(error).lower()
+    return False
 
 
-def convert_html_to_text(html_string: str) -> str:
-    """Convert a html string to a readable and understandable text."""
-    soup = BeautifulSoup(html_string, features="html.parser")
-    soup.prettify(formatter=lambda s: s.replace("\xa0", " "))
+def get_backoff_delay(attempt: int) -> float:
+    """Get the delay before the next retry, exponential with jitter."""
+    return min(MAX_BACKOFF, 2**attempt) + random.uniform(0, 1)
 
-    # kill all script and style elements
-    for script in soup(["script", "style"]):
-        script.extract()  # rip it out
 
-    # get text
-    text = soup.get_text()
+@timed("email.convert_html_to_text")
+def convert_html_to_text(html_string: str, extractor: Optional[Callable[[str], str]] = None) -> str:
+    """Convert a html string to a readable and understandable text.
 
-    # break into lines and remove leading and trailing space on each
-    lines = (line.strip() for line in text.splitlines())
-    # break multi-headlines into a line each
-    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-    # drop blank lines
-    text = "\n".join(chunk for chunk in chunks if chunk)
-    index = text.find("-------")
-    if index != -1:
-        return text[:index]
+    Args:
+        html_string (str): the html content of an email.
+        extractor (Callable): HTML to text extractor (see `html_extractor.get_extractor`), the fast one
+            when not given.
 
-    return text
+    Returns:
+        str: the text, without the quoted previous email.
+    """
+    return (extractor or DEFAULT_EXTRACTOR)(html_string)
 
 
 class EmailHandler:
     """Basic class to communicate with the Gmail API."""
 
-    def __init__(self, token_path: str, credentials_path: str, scopes: list) -> None:
+    def __init__(
+        self,
+        token_path: str,
+        credentials_path: str,
+        scopes: list,
+        batch_size: int = 50,
+        max_workers: int = 4,
+        max_retries: int = 5,
+        sync_state_path: str = SYNC_STATE_PATH,
+        html_extractor: str = "fast",
+        parse_processes: int = 0,
+        attachments: Optional[dict] = None,
+    ) -> None:
         """Initialise the email handler.
 
         Args:
             credentials_path (str): path to the credentials to access the API.
             token_path (str): path to the file containing the access and refresh tokens.
             scopes (list): list of scope for interacting with the API.
+            batch_size (int): number of messages fetched in a single batch request (100 at most).
+            max_workers (int): number of batch requests run concurrently.
+            max_retries (int): number of retries for messages hitting quota or server errors.
+            sync_state_path (str): path to the file keeping the last synchronisation checkpoint.
+            html_extractor (str): extractor of the text of HTML emails: `fast` (single pass tokenizer), `lxml`
+                or `beautifulsoup` (see `html_extractor.get_extractor`).
+            parse_processes (int): number of processes parsing the downloaded emails (0 to parse them in
+                the main process).
+            attachments (dict): parameters of the attachment downloads (see `AttachmentHandler`). By default
+                the attachments are only listed in the metadata of the emails.
         """
         self.token_path = token_path
         self.credentials_path = credentials_path
         self.scopes = scopes
+        self.batch_size = min(batch_size, 100)
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.sync_state_path = sync_state_path
+        self.html_extractor = html_extractor
+        self.html_to_text = get_extractor(html_extractor)
+        self.parse_processes = parse_processes
+        self.attachment_handler = AttachmentHandler(**(attachments or {}))
+        self.pending_sync_state: dict = {}
         self.service = None
+        self.credentials = None
+        self._local = threading.local()
 
     def set_service(self):
         """Set the connection to the service."""
@@ -70,6 +135,7 @@ class EmailHandler:
             # Save the credentials for the next run
             with open(self.token_path, "wb") as token:
                 pickle.dump(creds, token)
+        self.credentials = creds
 
         try:
             # Call the Gmail API
@@ -83,6 +149,20 @@ class EmailHandler:
         """Get the Gmail API service."""
         return self.service
 
+    def get_thread_service(self):
+        """Get a Gmail API service for the current thread.
+
+        httplib2 is not thread-safe, so each worker thread builds its own client from the credentials.
+        A service set without credentials (e.g. a fake one) is shared as is.
+        """
+        if self.credentials is None:
+            return self.service
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = build("gmail", "v1", credentials=self.credentials)
+            self._local.service = service
+        return service
+
     def get_size_format(self, b, factor=1024, suffix="B"):
         """Scale bytes to its proper byte format."""
         for unit in ["", "K", "M", "G", "T", "P", "E", "Z"]:
@@ -95,6 +175,115 @@ class EmailHandler:
         """Create a folder name where to save a file with special characters removed from the text."""
         return "".join(c if c.isalnum() else "_" for c in text)
 
+    def get_part_text(self, part) -> str:
+        """Get the readable text of a text/plain or text/html email partition."""
+        data = part.get("body", {}).get("data")
+        if not data:
+            return ""
+        try:
+            content = urlsafe_b64decode(data).decode()
+        except (TypeError, UnicodeDecodeError) as e:
+            print(f"Could not decode the content of the email: {e}")
+            return ""
+        if part.get("mimeType") == "text/html":
+            return convert_html_to_text(content, self.html_to_text)
+        return content
+
+    def extract_text(self, parts, alternative: bool = False) -> list[str]:
+        """Extract in memory the texts of the email partitions.
+
+        Args:
+            parts (list): partitions of the email payload.
+            alternative (bool): whether the partitions are alternative versions of the same content,
+                in which case only the last one is kept (as when the email is saved to disk).
+
+        Returns:
+            list[str]: texts of the partitions.
+        """
+        texts = []
+        for part in parts or []:
+            if part.get("parts"):
+                texts.extend(self.extract_text(part["parts"], part.get("mimeType") == "multipart/alternative"))
+            elif part.get("mimeType") in ("text/plain", "text/html") and not part.get("filename"):
+                text = self.get_part_text(part)
+                if text:
+                    texts.append(text)
+        if alternative and texts:
+            return texts[-1:]
+        return texts
+
+    @timed("email.parse_message")
+    def parse_message(self, msg):
+        """Parse a downloaded message into a document, without writing anything to disk.
+
+        Args:
+            msg (dict): full message as returned by the Gmail API.
+
+        Returns:
+            Document: the text of the email, with its headers as metadata (None if the email has no text).
+        """
+        payload = msg["payload"]
+        parts = payload.get("parts") or [payload]
+        texts = self.extract_text(parts, payload.get("mimeType") == "multipart/alternative")
+        if not texts:
+            return None
+        metadata = {
+            "message_id": msg["id"],
+            "thread_id": msg.get("threadId"),
+            "labels": msg.get("labelIds", []),
+            "timestamp": int(msg["internalDate"]) / 1000 if msg.get("internalDate") else None,
+        }
+        for header in payload.get("headers") or []:
+            name = header.get("name", "").lower()
+            if name in ("from", "to", "date", "subject"):
+                metadata[name] = header.get("value")
+        attachments = get_attachments(parts)
+        if attachments:
+            metadata["attachments"] = attachments
+        return Document(page_content="\n".join(texts), metadata=metadata)
+
+    def iter_documents(self, messages):
+        """Download and parse messages as a stream of documents.
+
+        Args:
+            messages (list): messages as returned by `search_messages`.
+
+        Yields:
+            Document: one document per email having some text.
+        """
+        downloaded = tqdm(self.fetch_messages(messages), total=len(messages))
+        if self.parse_processes:
+            documents = self.parse_in_processes(downloaded)
+        else:
+            documents = map(self.parse_message, downloaded)
+        documents = (document for document in documents if document is not None)
+        if self.attachment_handler.enabled:
+            documents = self.add_attachment_texts(documents)
+        yield from documents
+
+    def parse_in_processes(self, messages):
+        """Parse downloaded messages in a pool of processes.
+
+        At most two batches per process are in flight, which keeps memory bounded whatever the mailbox size.
+
+        Args:
+            messages (iterable): full messages as returned by the Gmail API.
+
+        Yields:
+            Document: the parsed messages, in the same order as the input (None for emails without text).
+        """
+        batches = iter(lambda: list(islice(messages, self.batch_size)), [])
+        with ProcessPoolExecutor(
+            max_workers=self.parse_processes, initializer=init_parser, initargs=(self.html_extractor,)
+        ) as executor:
+            futures: deque = deque()
+            for batch in batches:
+                futures.append(executor.submit(parse_messages, batch))
+                if len(futures) >= self.parse_processes * 2:
+                    yield from futures.popleft().result()
+            while futures:
+                yield from futures.popleft().result()
+
     def parse_parts(self, parts, folder_name, message, text):
         """Parse the content of an email partition."""
         if parts:
@@ -130,7 +319,7 @@ class EmailHandler:
                         except TypeError as e:
                             print(f"Could not decode the html content of the email: {e}")
                             html_content = ""
-                        email_content = convert_html_to_text(html_content)
+                        email_content = convert_html_to_text(html_content, self.html_to_text)
                         f.write(text + email_content)
                 else:
                     # attachment other than a plain text or HTML
@@ -138,32 +327,23 @@ class EmailHandler:
                         part_header_name = part_header.get("name")
                         part_header_value = part_header.get("value")
                         if part_header_name == "Content-Disposition":
-                            if "attachment" in part_header_value:
-                                # we get the attachment ID
-                                # and make another request to get the attachment itself
-                                print(
-                                    "Saving the file:",
-                                    filename,
-                                    "size:",
-                                    self.get_size_format(file_size),
-                                )
-                                attachment_id = body.get("attachmentId")
-                                attachment = (
-                                    self.service.users()
-                                    .messages()
-                                    .attachments()
-                                    .get(
-                                        id=attachment_id,
-                                        userId="me",
-                                        messageId=message["id"],
+                            if "attachment" in part_header_value and body.get("attachmentId"):
+                                # the attachment is listed in the email text, and only downloaded if it is
+                                # allowed, in the background queue
+                                attachment = {
+                                    "filename": filename,
+                                    "mime_type": mimeType,
+                                    "size": file_size or 0,
+                                    "attachment_id": body["attachmentId"],
+                                }
+                                if self.attachment_handler.download and self.attachment_handler.is_allowed(attachment):
+                                    print("Saving the file:", filename, "size:", self.get_size_format(file_size or 0))
+                                    self.attachment_handler.submit(
+                                        self.download_attachment,
+                                        message["id"],
+                                        attachment,
+                                        os.path.join(folder_name, filename),
                                     )
-                                    .execute()
-                                )
-                                data = attachment.get("data")
-                                filepath = os.path.join(folder_name, filename)
-                                if data:
-                                    with open(filepath, "wb") as f:
-                                        f.write(urlsafe_b64decode(data))
 
     def search_messages(self, query):
         """Search a mail based on a query."""
@@ -178,6 +358,79 @@ class EmailHandler:
                 messages.extend(result["messages"])
         return messages
 
+    @timed("email.fetch_batch")
+    def fetch_batch(self, messages) -> list:
+        """Download a group of messages in a single batch request.
+
+        Messages failing with a quota or server error are retried with an exponential backoff,
+        the other failures are reported and skipped.
+
+        Args:
+            messages (list): messages as returned by `search_messages`.
+
+        Returns:
+            list: the full messages, in the same order as the input (None for messages that could not be fetched).
+        """
+        service = self.get_thread_service()
+        results: list = [None] * len(messages)
+        pending = list(range(len(messages)))
+        for attempt in range(self.max_retries + 1):
+            retry: list = []
+
+            def callback(request_id, response, exception):
+                position = int(request_id)
+                if exception is None:
+                    results[position] = response
+                elif is_retryable(exception):
+                    retry.append(position)
+                else:
+                    increment("email.fetch_errors")
+                    print(f"Could not fetch message {messages[position]['id']}: {exception}")
+
+            batch = service.new_batch_http_request(callback=callback)
+            for position in pending:
+                request = service.users().messages().get(userId="me", id=messages[position]["id"], format="full")
+                batch.add(request, request_id=str(position))
+            try:
+                batch.execute()
+            except HttpError as error:
+                if not is_retryable(error):
+                    raise error
+                retry = [position for position in pending if results[position] is None]
+            if not retry:
+                break
+            pending = sorted(retry)
+            if attempt < self.max_retries:
+                increment("email.fetch_retries", len(pending))
+                time.sleep(get_backoff_delay(attempt))
+        else:
+            increment("email.fetch_errors", len(pending))
+            print(f"Giving up on {len(pending)} messages after {self.max_retries} retries.")
+        increment("email.messages_fetched", sum(msg is not None for msg in results))
+        return results
+
+    def fetch_messages(self, messages):
+        """Download messages with concurrent batch requests.
+
+        At most `max_workers` batches are in flight, which keeps memory bounded whatever the mailbox size.
+
+        Args:
+            messages (list): messages as returned by `search_messages`.
+
+        Yields:
+            dict: the full messages, in the same order as the input.
+        """
+        batches = (messages[i : i + self.batch_size] for i in range(0, len(messages), self.batch_size))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures: deque = deque()
+            for batch in batches:
+                futures.append(executor.submit(self.fetch_batch, batch))
+                if len(futures) >= self.max_workers * 2:
+                    yield from (msg for msg in futures.popleft().result() if msg is not None)
+            while futures:
+                yield from (msg for msg in futures.popleft().result() if msg is not None)
+
+    @timed("email.read_message")
     def read_message(self, message):
         """Do the following for a given message_id.
 
@@ -188,6 +441,10 @@ class EmailHandler:
         - Downloads any file that is attached to the email and saves it in the folder created
         """
         msg = self.service.users().messages().get(userId="me", id=message["id"], format="full").execute()
+        self.save_message(msg)
+
+    def save_message(self, msg):
+        """Save the content of an already downloaded message in its own folder."""
         # parts can be the message body, or attachments
         payload = msg["payload"]
         headers = payload.get("headers")
@@ -236,17 +493,222 @@ class EmailHandler:
             # since folders are created based on subjects
             if not os.path.isdir(folder_name):
                 os.mkdir(folder_name)
-        self.parse_parts(parts, folder_name, message, text)
+        with open(os.path.join(folder_name, MESSAGE_ID_FILE), "w") as f:
+            f.write(msg["id"])
+        attachments = get_attachments(parts)
+        if attachments:
+            text += f"Attachments: {', '.join(attachment['filename'] for attachment in attachments)} \n"
+        with span("email.parse_parts"):
+            self.parse_parts(parts, folder_name, msg, text)
 
-    def get_mails(self):
-        """Get all emails."""
-        results = self.search_messages("")
+    def get_mails(self, messages=None):
+        """Get all emails, or only the given messages."""
+        results = self.search_messages("") if messages is None else messages
         print(f"Found {len(results)} results.")
         # for each email matched, read it (output plain/text to console & save HTML and attachments)
-        for msg in tqdm(results):
-            self.read_message(msg)
+        for msg in tqdm(self.fetch_messages(results), total=len(results)):
+            self.save_message(msg)
+        self.attachment_handler.wait()
+
+    def download_attachment(self, message_id: str, attachment: dict, path: Optional[str] = None) -> Optional[str]:
+        """Download an attachment on demand, whatever the allow-lists.
+
+        Args:
+            message_id (str): id of the Gmail message of the attachment.
+            attachment (dict): the attachment, as listed in the `attachments` metadata of the email.
+            path (str): path of the file written (in the attachment folder when not given).
+
+        Returns:
+            str: the path of the file (None if the attachment is empty).
+        """
+        return self.attachment_handler.fetch(self.get_thread_service(), message_id, attachment, path)
+
+    def get_attachment_text(self, message_id: str, attachment: dict) -> str:
+        """Download an attachment and extract its text (empty if `extract_text` is not set)."""
+        return self.attachment_handler.fetch_text(self.get_thread_service(), message_id, attachment)
+
+    def add_attachment_texts(self, documents):
+        """Download the allowed attachments of a stream of documents in the background queue.
+
+        Their text is added to their email if `extract_text` is set, they are only saved otherwise.
+
+        Args:
+            documents (iterable): documents of the emails, with their `attachments` metadata.
+
+        Yields:
+            Document: the documents, in the same order, followed by the text of their attachments.
+        """
+        handler = self.attachment_handler
+        pending: deque = deque()
+        for document in documents:
+            attachments = [
+                attachment
+                for attachment in document.metadata.get("attachments", [])
+                if handler.is_allowed(attachment)
+                and (handler.download or attachment["mime_type"] not in handler.unreadable_types)
+            ]
+            futures = [
+                (
+                    attachment["filename"],
+                    handler.submit(self.get_attachment_text, document.metadata["message_id"], attachment),
+                )
+                for attachment in attachments
+            ]
+            pending.append((document, futures))
+            while pending and (len(pending) > self.batch_size or all(f.done() for _, f in pending[0][1])):
+                yield self.join_attachment_texts(*pending.popleft())
+        while pending:
+            yield self.join_attachment_texts(*pending.popleft())
+
+    def join_attachment_texts(self, document: Document, futures: list) -> Document:
+        """Append the text of the downloaded attachments to the text of their email, if it is extracted."""
+        for filename, future in futures:
+            text = future.result() if future.exception() is None else ""
+            if self.attachment_handler.extract_text and text.strip():
+                document.page_content += f"\n\nAttachment {filename}:\n{text}"
+        return document
+
+    def get_history_id(self) -> str:
+        """Get the current history id of the mailbox."""
+        return self.service.users().getProfile(userId="me").execute()["historyId"]
+
+    def load_sync_state(self) -> dict:
+        """Load the last synchronisation checkpoint."""
+        if not os.path.exists(self.sync_state_path):
+            return {}
+        with open(self.sync_state_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_sync_state(self, history_id: str, message_ids) -> None:
+        """Save a synchronisation checkpoint.
+
+        Args:
+            history_id (str): history id of the mailbox at the time of the checkpoint.
+            message_ids (iterable): ids of the messages known at the time of the checkpoint.
+        """
+        tmp_path = f"{self.sync_state_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"history_id": history_id, "message_ids": sorted(message_ids)}, f)
+        os.replace(tmp_path, self.sync_state_path)
+
+    def list_history(self, start_history_id: str) -> tuple[set, set, str]:
+        """List the messages added and deleted since a given history id.
+
+        A message moved to the trash or the spam is deleted, and added back when it is restored.
+
+        Args:
+            start_history_id (str): history id of the last checkpoint.
+
+        Returns:
+            tuple[set, set, str]: ids of the added messages, ids of the deleted messages and the latest history id.
+        """
+        added: set = set()
+        deleted: set = set()
+        history = self.service.users().history()
+        kwargs = {
+            "userId": "me",
+            "startHistoryId": start_history_id,
+            "historyTypes": ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"],
+        }
+        result = history.list(**kwargs).execute()
+        while True:
+            # records are in chronological order, a message can be added then deleted in the same window
+            for record in result.get("history", []):
+                for key in ("messagesAdded", "labelsAdded", "labelsRemoved", "messagesDeleted"):
+                    for item in record.get(key, []):
+                        # the labels of the message are the ones it has after the change
+                        message = item["message"]
+                        if key != "messagesDeleted" and IGNORED_LABELS.isdisjoint(message.get("labelIds", [])):
+                            added.add(message["id"])
+                            deleted.discard(message["id"])
+                        else:
+                            added.discard(message["id"])
+                            deleted.add(message["id"])
+            if "nextPageToken" not in result:
+                break
+            result = history.list(pageToken=result["nextPageToken"], **kwargs).execute()
+        return added, deleted, result.get("historyId", start_history_id)
+
+    def sync(self) -> tuple[list, list]:
+        """Get the changes of the mailbox since the last checkpoint.
+
+        The history API is used when possible. When there is no checkpoint yet, or when it is too old for
+        the history API, the current listing of the mailbox is compared to the known messages instead.
+        The new checkpoint is only saved by `commit_sync`, once the changes have been handled.
+
+        Returns:
+            tuple[list, list]: the added messages (as returned by `search_messages`) and the ids of the deleted ones.
+        """
+        state = self.load_sync_state()
+        known_ids = set(state.get("message_ids", []))
+        added_ids: set = set()
+        deleted_ids: set = set()
+        history_id = None
+        if state.get("history_id"):
+            try:
+                added_ids, deleted_ids, history_id = self.list_history(state["history_id"])
+            except HttpError as error:
+                if getattr(error.resp, "status", None) != 404:
+                    raise error
+                print("Sync checkpoint is too old, comparing with the full mailbox listing.")
+        if history_id is None:
+            history_id = self.get_history_id()
+            current_ids = {message["id"] for message in self.search_messages("")}
+            added_ids = current_ids - known_ids
+            deleted_ids = known_ids - current_ids
+        added_ids -= known_ids
+        deleted_ids &= known_ids
+        self.pending_sync_state = {
+            "history_id": history_id,
+            "message_ids": (known_ids - deleted_ids) | added_ids,
+        }
+        print(f"Sync: {len(added_ids)} new messages, {len(deleted_ids)} deleted messages.")
+        return [{"id": message_id} for message_id in sorted(added_ids)], sorted(deleted_ids)
+
+    def commit_sync(self) -> None:
+        """Save the checkpoint of the last `sync`, once its changes have been handled."""
+        if self.pending_sync_state:
+            self.save_sync_state(**self.pending_sync_state)
+            self.pending_sync_state = {}
 
     def initialise_set_up(self):
-        """Initialise the setup for the first time."""
+        """Initialise the setup for the first time.
+
+        Returns:
+            iterator: documents of all the emails of the mailbox. The checkpoint is saved by `commit_sync`.
+        """
+        self.set_service()
+        history_id = self.get_history_id()
+        messages = self.search_messages("")
+        self.pending_sync_state = {"history_id": history_id, "message_ids": {message["id"] for message in messages}}
+        return self.iter_documents(messages)
+
+    def update(self) -> tuple:
+        """Get the changes of the mailbox since the last checkpoint.
+
+        Returns:
+            tuple: documents of the added emails, and ids of the deleted ones.
+        """
         self.set_service()
-        self.get_mails()
+        if not self.load_sync_state():
+            # mailbox indexed before checkpoints existed: take its current state as the reference
+            print("No sync checkpoint found, the current mailbox is taken as reference.")
+            self.save_sync_state(self.get_history_id(), {message["id"] for message in self.search_messages("")})
+            return iter([]), []
+        added, deleted = self.sync()
+        return self.iter_documents(added), deleted
+
+
+# handler parsing the messages in each process of the parsing pool
+PARSER: Optional[EmailHandler] = None
+
+
+def init_parser(html_extractor: str):
+    """Initialise a process of the parsing pool."""
+    global PARSER
+    PARSER = EmailHandler("", "", [], html_extractor=html_extractor)
+
+
+def parse_messages(messages: list) -> list:
+    """Parse downloaded messages in a process of the parsing pool."""
+    return [PARSER.parse_message(msg) for msg in messages]
@@ -0,0 +1,207 @@
+"""Persistent cache of the embeddings computed for the chunks of the emails."""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", "data", "embedding_cache")
+INITIAL_CAPACITY = 1024
+# maximum number of parameters of a SQLite query
+BATCH_SIZE = 500
+
+
+class EmbeddingCache:
+    """On-disk embedding cache keyed by model name and hash of the text.
+
+    The vectors are kept in a memory-mapped array, one file per model, and a SQLite index maps
+    the hash of each text to its row. When the cache is full, the least recently used rows are reused.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        path: str = CACHE_DIR,
+        max_entries: int = 500_000,
+        dtype: str = "float16",
+        variant: str = "",
+    ):
+        """Initialise the cache.
+
+        Args:
+            model_name (str): name of the embedding model, each model has its own cache.
+            path (str): folder where the caches are saved.
+            max_entries (int): maximum number of embeddings kept per model.
+            dtype (str): type used to store the vectors (float16 or float32).
+            variant (str): backend and normalization of the embeddings of the model (see
+                `embedding_engine.get_embeddings_variant`), each variant having its own cache.
+        """
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.dtype = np.dtype(dtype)
+        name = f"{model_name}-{variant}" if variant else model_name
+        self.cache_dir = os.path.join(path, "".join(c if c.isalnum() else "_" for c in name))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.vectors_path = os.path.join(self.cache_dir, f"vectors.{self.dtype.name}")
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(self.cache_dir, "index.sqlite"), check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, row INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value INTEGER)")
+        self.connection.commit()
+        dim = self.connection.execute("SELECT value FROM settings WHERE name = 'dim'").fetchone()
+        self.dim: Optional[int] = dim[0] if dim else None
+        self.vectors: Optional[np.memmap] = None
+        if self.dim is not None and os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path):
+            self.open_vectors()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(text: str) -> str:
+        """Get the key of a text in the cache."""
+        return hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+    def open_vectors(self, capacity: int = 0):
+        """Open the memory-mapped vectors, growing the file to hold at least `capacity` rows."""
+        row_size = self.dim * self.dtype.itemsize
+        current = os.path.getsize(self.vectors_path) // row_size if os.path.exists(self.vectors_path) else 0
+        if capacity > current:
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(capacity * row_size)
+            current = capacity
+        if self.vectors is not None:
+            self.vectors.flush()
+        self.vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode="r+", shape=(current, self.dim))
+
+    def get(self, texts: list[str]) -> list[Optional[list[float]]]:
+        """Get the cached embeddings of texts.
+
+        Args:
+            texts (list[str]): texts to look for.
+
+        Returns:
+            list[Optional[list[float]]]: the embedding of each text, None when it is not in the cache.
+        """
+        results: list[Optional[list[float]]] = [None] * len(texts)
+        if self.vectors is None:
+            self.misses += len(texts)
+            return results
+        keys = [self.get_key(text) for text in texts]
+        with self.lock:
+            rows = self.get_rows(keys)
+            for position, key in enumerate(keys):
+                if key in rows:
+                    results[position] = self.vectors[rows[key]].astype(np.float32).tolist()
+            now = time.time()
+            self.connection.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, key) for key in rows])
+            self.connection.commit()
+        self.hits += len(rows)
+        self.misses += len(texts) - len(rows)
+        return results
+
+    def get_rows(self, keys: list[str]) -> dict[str, int]:
+        """Get the rows of the keys in the cache, by batches not to exceed the parameters of a SQLite query.
+
+        Must be called with the lock held.
+        """
+        rows = {}
+        for start in range(0, len(keys), BATCH_SIZE):
+            batch = keys[start : start + BATCH_SIZE]
+            query = f"SELECT key, row FROM entries WHERE key IN ({','.join('?' * len(batch))})"
+            rows.update(self.connection.execute(query, batch).fetchall())
+        return rows
+
+    def put(self, texts: list[str], embeddings: list[list[float]]):
+        """Add embeddings to the cache, evicting the least recently used ones if it is full.
+
+        Args:
+            texts (list[str]): texts that have been embedded.
+            embeddings (list[list[float]]): their embeddings.
+        """
+        if not texts:
+            return
+        entries = dict(zip((self.get_key(text) for text in texts), embeddings))
+        with self.lock:
+            if self.dim is None:
+                self.dim = len(embeddings[0])
+                self.connection.execute("INSERT INTO settings VALUES ('dim', ?)", (self.dim,))
+            existing = self.get_rows(list(entries))
+            new_keys = [key for key in entries if key not in existing][: self.max_entries]
+            if not new_keys:
+                self.connection.commit()
+                return
+            count = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            nb_evicted = max(0, count + len(new_keys) - self.max_entries)
+            # rows of the evicted entries are reused, new rows are appended
+            free_rows = [
+                row
+                for (row,) in self.connection.execute(
+                    "SELECT row FROM entries ORDER BY last_used LIMIT ?", (nb_evicted,)
+                ).fetchall()
+            ]
+            if free_rows:
+                self.connection.execute(
+                    "DELETE FROM entries WHERE row IN (SELECT row FROM entries ORDER BY last_used LIMIT ?)",
+                    (nb_evicted,),
+                )
+            next_row = self.connection.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM entries").fetchone()[0]
+            next_row = max([next_row] + [row + 1 for row in free_rows])
+            rows = free_rows + list(range(next_row, next_row + len(new_keys) - len(free_rows)))
+            if self.vectors is None or max(rows) >= len(self.vectors):
+                capacity = max(INITIAL_CAPACITY, len(self.vectors) * 2 if self.vectors is not None else 0)
+                self.open_vectors(min(max(capacity, max(rows) + 1), self.max_entries))
+            for key, row in zip(new_keys, rows):
+                self.vectors[row] = np.asarray(entries[key], dtype=self.dtype)
+            self.vectors.flush()
+            now = time.time()
+            self.connection.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?)", [(key, row, now) for key, row in zip(new_keys, rows)]
+            )
+            self.connection.commit()
+
+    def get_stats(self) -> dict:
+        """Get the hit and miss counts of the cache."""
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings looking in an embedding cache before calling the model."""
+
+    def __init__(self, embedding: Embeddings, cache: EmbeddingCache):
+        """Initialise the embeddings.
+
+        Args:
+            embedding (Embeddings): the embedding model.
+            cache (EmbeddingCache): the cache of this model.
+        """
+        self.embedding = embedding
+        self.cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embed documents, only calling the model for the texts not in the cache."""
+        embeddings = self.cache.get(texts)
+        missing = [position for position, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            computed = self.embedding.embed_documents([texts[position] for position in missing])
+            for position, embedding in zip(missing, computed):
+                embeddings[position] = embedding
+            self.cache.put([texts[position] for position in missing], computed)
+        return embeddings  # type: ignore[return-value]
+
+    def embed_query(self, text: str) -> list[float]:
+        """Embed a query."""
+        return self.embedding.embed_query(text)
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """Embed a batch of queries, which are not cached."""
+        if hasattr(self.embedding, "embed_queries"):
+            return self.embedding.embed_queries(texts)
+        return [self.embedding.embed_query(text) for text in texts]
@@ -0,0 +1,249 @@
+"""Embedding engine for CPU hosts, with batching, multi-process encoding and quantized backends."""
+import argparse
+import json
+import os
+import time
+from typing import Optional
+
+import torch
+from langchain_core.embeddings import Embeddings
+from sentence_transformers import SentenceTransformer
+
+BACKENDS = ["torch", "int8", "onnx"]
+# variables setting the number of threads of torch in the encoding processes, read when they start
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+def get_embeddings_variant(backend: str = "torch", normalize: bool = False, **engine_config) -> str:
+    """Get the variant of the embeddings of a model computed by an engine configuration.
+
+    The backends and the normalization change the vectors, which are not interchangeable. The embeddings of the
+    default configuration (torch, not normalized) have no variant name.
+
+    Args:
+        backend (str): backend of the engine.
+        normalize (bool): whether the embeddings are normalized.
+        **engine_config: the other parameters of the engine (see `EmbeddingEngine`), which do not change the vectors.
+
+    Returns:
+        str: the name of the variant.
+    """
+    parts = [] if backend == "torch" else [backend]
+    if normalize:
+        parts.append("normalized")
+    return "-".join(parts)
+
+
+class EmbeddingEngine(Embeddings):
+    """Sentence-transformers embeddings with configurable batching, processes and backend.
+
+    - `torch`: the model as is.
+    - `int8`: linear layers dynamically quantized to int8, for CPU.
+    - `onnx`: the transformer exported to ONNX and run with onnxruntime (needs `optimum[onnxruntime]`),
+      followed by a mean pooling.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        device: str = "cpu",
+        batch_size: int = 64,
+        processes: int = 0,
+        threads: int = 0,
+        backend: str = "torch",
+        normalize: bool = False,
+    ):
+        """Initialise the engine.
+
+        Args:
+            model_name (str): name of the sentence-transformers model.
+            device (str): device to run the model on.
+            batch_size (int): number of texts encoded at once.
+            processes (int): number of processes to shard the encoding across (0 or 1 for the current process).
+            threads (int): number of torch threads used per process (0 to keep the default, or to share the
+                cores between the processes when there are several).
+            backend (str): one of `torch`, `int8` or `onnx`.
+            normalize (bool): whether to normalize the embeddings.
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown embedding backend {backend}, expected one of {BACKENDS}.")
+        if backend == "onnx" and processes > 1:
+            raise ValueError("The onnx backend does not support multi-process encoding.")
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = batch_size
+        self.processes = processes
+        self.backend = backend
+        self.normalize = normalize
+        self.pool = None
+        self.nb_chunks = 0
+        self.duration = 0.0
+        if threads <= 0 and processes > 1:
+            # each process would use all the cores otherwise
+            threads = max(1, (os.cpu_count() or 1) // processes)
+        self.threads = threads
+        if threads > 0:
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model_name, device="cpu" if backend != "torch" else device)
+        self.onnx_model = None
+        self.tokenizer = None
+        if backend == "int8":
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif backend == "onnx":
+            self.set_onnx_model()
+
+    def set_onnx_model(self):
+        """Export the transformer of the model to ONNX."""
+        try:
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError("The onnx backend needs optimum: pip install optimum[onnxruntime]") from e
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self.onnx_model = ORTModelForFeatureExtraction.from_pretrained(self.model_name, export=True)
+
+    def encode_onnx(self, texts: list[str]) -> list[list[float]]:
+        """Encode texts with the ONNX model."""
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(
+                texts[start : start + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.model.max_seq_length,
+                return_tensors="pt",
+            )
+            outputs = self.onnx_model(**inputs)
+            mask = inputs["attention_mask"].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+            pooled = (outputs.last_hidden_state * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+            if self.normalize:
+                pooled = torch.nn.functional.normalize(pooled, p=2, dim=1)
+            embeddings.extend(pooled.tolist())
+        return embeddings
+
+    def start_pool(self):
+        """Start the encoding processes, with `threads` torch threads each."""
+        previous = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+        os.environ.update({name: str(self.threads) for name in THREAD_VARIABLES})
+        try:
+            self.pool = self.model.start_multi_process_pool(target_devices=["cpu"] * self.processes)
+        finally:
+            for name, value in previous.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    def encode(self, texts: list[str]) -> list[list[float]]:
+        """Encode texts with the configured backend and processes."""
+        if self.onnx_model is not None:
+            return self.encode_onnx(texts)
+        if self.processes > 1:
+            if self.pool is None:
+                self.start_pool()
+            embeddings = self.model.encode_multi_process(
+                texts,
+                self.pool,
+                batch_size=self.batch_size,
+                chunk_size=max(1, len(texts) // self.processes),
+                normalize_embeddings=self.normalize,
+            )
+        else:
+            embeddings = self.model.encode(
+                texts, batch_size=self.batch_size, normalize_embeddings=self.normalize, show_progress_bar=False
+            )
+        return embeddings.tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embed documents, keeping track of the throughput."""
+        if not texts:
+            return []
+        start = time.perf_counter()
+        texts = [text.replace("\n", " ") for text in texts]
+        embeddings = self.encode(texts)
+        self.duration += time.perf_counter() - start
+        self.nb_chunks += len(texts)
+        return embeddings
+
+    def embed_query(self, text: str) -> list[float]:
+        """Embed a query in the current process."""
+        if self.onnx_model is not None:
+            return self.encode_onnx([text.replace("\n", " ")])[0]
+        return self.model.encode(text.replace("\n", " "), normalize_embeddings=self.normalize).tolist()
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """Embed a batch of queries in the current process, in batches of `batch_size`."""
+        texts = [text.replace("\n", " ") for text in texts]
+        if self.onnx_model is not None:
+            return self.encode_onnx(texts)
+        return self.model.encode(
+            texts, batch_size=self.batch_size, normalize_embeddings=self.normalize, show_progress_bar=False
+        ).tolist()
+
+    def get_stats(self) -> dict:
+        """Get the number of chunks embedded and the throughput of the engine."""
+        return {
+            "chunks": self.nb_chunks,
+            "seconds": self.duration,
+            "chunks_per_second": self.nb_chunks / self.duration if self.duration else 0.0,
+        }
+
+    def close(self):
+        """Stop the encoding processes."""
+        if self.pool is not None:
+            self.model.stop_multi_process_pool(self.pool)
+            self.pool = None
+
+
+def benchmark(model_name: str, texts: list[str], settings: list[dict]) -> list[dict]:
+    """Measure the throughput of the engine for several settings.
+
+    Args:
+        model_name (str): name of the sentence-transformers model.
+        texts (list[str]): texts to embed.
+        settings (list[dict]): parameters of the engine to compare.
+
+    Returns:
+        list[dict]: the settings with their throughput.
+    """
+    results = []
+    for setting in settings:
+        engine = EmbeddingEngine(model_name, **setting)
+        # warm-up, so that process start and model load are not measured
+        engine.embed_documents(texts[: engine.batch_size])
+        engine.nb_chunks, engine.duration = 0, 0.0
+        engine.embed_documents(texts)
+        engine.close()
+        results.append({**setting, **engine.get_stats()})
+        print(json.dumps(results[-1]))
+    return results
+
+
+def main(args: Optional[list] = None):
+    """Compare the throughput of the engine settings on this host."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--model", default="lewispons/email-classifiers")
+    parser.add_argument("--texts", help="file with one text per line (synthetic texts when not given)")
+    parser.add_argument("--nb-texts", type=int, default=2000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--processes", type=int, nargs="+", default=[0, os.cpu_count() or 1])
+    parser.add_argument("--backends", nargs="+", default=["torch", "int8"], choices=BACKENDS)
+    parsed = parser.parse_args(args)
+    if parsed.texts:
+        with open(parsed.texts, encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()][: parsed.nb_texts]
+    else:
+        words = "meeting invoice project update please find attached the report for next week thanks".split()
+        texts = [" ".join(words[(i + j) % len(words)] for j in range(150)) for i in range(parsed.nb_texts)]
+    settings = [
+        {"batch_size": batch_size, "processes": processes, "backend": backend}
+        for backend in parsed.backends
+        for processes in parsed.processes
+        for batch_size in parsed.batch_sizes
+        if not (backend == "onnx" and processes > 1)
+    ]
+    benchmark(parsed.model, texts, settings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Extractors of the readable text of HTML emails."""
+from html.parser import HTMLParser
+from typing import Callable
+
+from bs4 import BeautifulSoup
+
+# elements whose content is not text
+SKIPPED_TAGS = {"script", "style"}
+# marker of the quoted previous email, everything after it is dropped
+QUOTE_MARKER = "-------"
+
+
+def clean_text(text: str) -> str:
+    """Drop blank lines, split multi-headlines and remove the quoted previous email of an extracted text."""
+    phrases = []
+    for line in text.splitlines():
+        for phrase in line.strip().split("  "):
+            phrase = phrase.strip()
+            if phrase:
+                phrases.append(phrase)
+    text = "\n".join(phrases)
+    index = text.find(QUOTE_MARKER)
+    if index != -1:
+        return text[:index]
+    return text
+
+
+class TextParser(HTMLParser):
+    """Streaming HTML tokenizer keeping the text outside of script and style elements."""
+
+    def __init__(self):
+        """Initialise the parser, converting the character references of the text."""
+        super().__init__(convert_charrefs=True)
+        self.texts: list[str] = []
+        self.skipped = 0
+
+    def handle_starttag(self, tag, attrs):
+        """Start skipping the text at the opening of a script or style element."""
+        if tag in SKIPPED_TAGS:
+            self.skipped += 1
+
+    def handle_endtag(self, tag):
+        """Stop skipping the text at the closing of a script or style element."""
+        if tag in SKIPPED_TAGS and self.skipped:
+            self.skipped -= 1
+
+    def handle_startendtag(self, tag, attrs):
+        """Ignore the self-closing elements, which have no text nor content to skip."""
+
+    def handle_data(self, data):
+        """Keep the text, unless it is in a script or style element."""
+        if not self.skipped:
+            self.texts.append(data)
+
+
+def stream_to_text(html_string: str) -> str:
+    """Convert a html string to text in a single pass of the standard library tokenizer."""
+    parser = TextParser()
+    parser.feed(html_string)
+    parser.close()
+    return clean_text("".join(parser.texts))
+
+
+def lxml_to_text(html_string: str) -> str:
+    """Convert a html string to text with the lxml parser."""
+    try:
+        from lxml import etree
+        from lxml import html as lxml_html
+    except ImportError as e:
+        raise ImportError("The lxml extractor needs lxml: pip install lxml") from e
+    if not html_string.strip():
+        return ""
+    root = lxml_html.document_fromstring(html_string)
+    etree.strip_elements(root, *SKIPPED_TAGS, with_tail=False)
+    return clean_text(root.text_content())
+
+
+def beautifulsoup_to_text(html_string: str) -> str:
+    """Convert a html string to text with BeautifulSoup, the original (slower) extraction."""
+    soup = BeautifulSoup(html_string, features="html.parser")
+    # kill all script and style elements
+    for script in soup(list(SKIPPED_TAGS)):
+        script.extract()
+    return clean_text(soup.get_text())
+
+
+EXTRACTORS: dict[str, Callable[[str], str]] = {
+    "fast": stream_to_text,
+    "lxml": lxml_to_text,
+    "beautifulsoup": beautifulsoup_to_text,
+}
+
+
+def get_extractor(name: str = "fast") -> Callable[[str], str]:
+    """Get an HTML to text extractor, falling back to BeautifulSoup when it fails on a document.
+
+    Args:
+        name (str): `fast` (standard library tokenizer), `lxml` or `beautifulsoup`.
+
+    Returns:
+        Callable[[str], str]: function converting a html string to text.
+    """
+    if name not in EXTRACTORS:
+        raise ValueError(f"Unknown HTML extractor {name}, expected one of {sorted(EXTRACTORS)}")
+    if name == "lxml":
+        # fail early rather than on the first email if lxml is not installed
+        lxml_to_text("")
+    extractor = EXTRACTORS[name]
+    if extractor is beautifulsoup_to_text:
+        return extractor
+    return ExtractorWithFallback(name)
+
+
+class ExtractorWithFallback:
+    """Extractor falling back to BeautifulSoup on the documents it cannot parse (picklable for process pools)."""
+
+    def __init__(self, name: str):
+        """Initialise the extractor.
+
+        Args:
+            name (str): name of the extractor tried first (see `EXTRACTORS`).
+        """
+        self.name = name
+
+    def __call__(self, html_string: str) -> str:
+        """Extract the text of a html string, with BeautifulSoup if the extractor fails."""
+        try:
+            return EXTRACTORS[self.name](html_string)
+        except Exception as e:
+            print(f"Could not extract the text of the email with {self.name}, using BeautifulSoup: {e}")
+            return beautifulsoup_to_text(html_string)
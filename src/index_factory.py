@@ -0,0 +1,282 @@
+"""Build, save and load the FAISS indexes used by the vector store."""
+import argparse
+import json
+import os
+import pickle
+import tempfile
+import time
+from collections import defaultdict
+from typing import Iterator, Optional
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ["flat", "ivf", "hnsw", "ivfpq"]
+# faiss recommends at least 39 training vectors per IVF list
+MIN_POINTS_PER_LIST = 39
+
+
+def get_factory_string(
+    index_type: str = "flat", nlist: int = 1024, pq_m: int = 16, pq_nbits: int = 8, hnsw_m: int = 32
+) -> str:
+    """Get the faiss factory string of an index type.
+
+    Args:
+        index_type (str): one of `flat`, `ivf`, `hnsw` or `ivfpq`.
+        nlist (int): number of inverted lists of the IVF indexes.
+        pq_m (int): number of sub-quantizers of the IVF-PQ index (must divide the dimension).
+        pq_nbits (int): number of bits per sub-quantizer of the IVF-PQ index.
+        hnsw_m (int): number of neighbours per node of the HNSW index.
+
+    Returns:
+        str: the factory string.
+    """
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf":
+        return f"IVF{nlist},Flat"
+    if index_type == "hnsw":
+        return f"HNSW{hnsw_m}"
+    if index_type == "ivfpq":
+        return f"IVF{nlist},PQ{pq_m}x{pq_nbits}"
+    raise ValueError(f"Unknown index type {index_type}, expected one of {INDEX_TYPES}.")
+
+
+def get_train_size(config: dict) -> int:
+    """Get the number of vectors needed to train an index (0 if it does not need training)."""
+    index_type = config.get("type", "flat")
+    if index_type not in ("ivf", "ivfpq"):
+        return 0
+    default = MIN_POINTS_PER_LIST * config.get("nlist", 1024)
+    if index_type == "ivfpq":
+        default = max(default, MIN_POINTS_PER_LIST * 2 ** config.get("pq_nbits", 8))
+    return config.get("train_size", default)
+
+
+def build_index(vectors: np.ndarray, config: dict) -> faiss.Index:
+    """Build an empty index, trained on a sample of vectors if needed.
+
+    When there are not enough vectors to train the inverted lists, their number is reduced,
+    down to an exact flat index for very small mailboxes.
+
+    Args:
+        vectors (np.ndarray): sample of the vectors that will be indexed.
+        config (dict): `type` of index and its parameters (see `get_factory_string`).
+
+    Returns:
+        faiss.Index: the index, ready to add vectors.
+    """
+    index_type = config.get("type", "flat")
+    nlist = config.get("nlist", 1024)
+    if index_type in ("ivf", "ivfpq"):
+        nlist = min(nlist, len(vectors) // MIN_POINTS_PER_LIST)
+        if nlist < 1 or (index_type == "ivfpq" and len(vectors) < 2 ** config.get("pq_nbits", 8)):
+            print(f"Not enough vectors to train a {index_type} index, using a flat index.")
+            index_type = "flat"
+    factory_string = get_factory_string(
+        index_type, nlist, config.get("pq_m", 16), config.get("pq_nbits", 8), config.get("hnsw_m", 32)
+    )
+    index = faiss.index_factory(vectors.shape[1], factory_string)
+    if not index.is_trained:
+        sample = vectors
+        if len(vectors) > get_train_size(config):
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(len(vectors), get_train_size(config), replace=False)]
+        index.train(np.ascontiguousarray(sample, dtype=np.float32))
+    set_search_parameters(index, config)
+    return index
+
+
+class TrainingBuffer:
+    """Chunks embedded before their index can be trained, with a uniform sample of their vectors.
+
+    The chunks are written to a temporary file until the index is created, so that it is trained on a
+    reservoir sample of all the vectors of the ingestion, and not only on the oldest emails.
+    """
+
+    def __init__(self, size: int, seed: int = 0):
+        """Initialise the buffer.
+
+        Args:
+            size (int): number of vectors of the training sample.
+            seed (int): seed of the random generator of the sample.
+        """
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.file = None
+        # the sample only grows with the chunks added, many shards can be waiting for their training at once
+        self.sample: list[np.ndarray] = []
+        self.dim = 0
+        # number of chunks written to the file, and position of the file at the last removal of each message
+        self.nb_written = 0
+        self.removed: dict = {}
+        self.message_counts: dict = defaultdict(int)
+
+    def __len__(self) -> int:
+        """Get the number of chunks in the buffer, without the removed ones."""
+        return sum(self.message_counts.values())
+
+    def add(self, texts: list[str], embeddings: list[list[float]], metadatas: list[dict], ids: list[str]):
+        """Add embedded chunks to the buffer, and draw their vectors in the training sample."""
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if self.file is None:
+            self.file = tempfile.TemporaryFile()
+            self.dim = vectors.shape[1]
+        pickle.dump((self.nb_written, texts, vectors, metadatas, ids), self.file)
+        for position, vector in enumerate(vectors, self.nb_written):
+            if position < self.size:
+                self.sample.append(vector)
+                continue
+            slot = self.rng.integers(position + 1)
+            if slot < self.size:
+                self.sample[slot] = vector
+        self.nb_written += len(vectors)
+        for metadata in metadatas:
+            self.message_counts[metadata.get("message_id")] += 1
+
+    def remove_messages(self, message_ids: set) -> int:
+        """Remove the chunks of some Gmail messages, returning their number.
+
+        Their vectors may stay in the training sample, where they only move the centroids slightly.
+        """
+        nb_removed = 0
+        for message_id in message_ids & self.message_counts.keys():
+            nb_removed += self.message_counts.pop(message_id)
+            self.removed[message_id] = self.nb_written
+        return nb_removed
+
+    def get_sample(self) -> np.ndarray:
+        """Get the training sample."""
+        return np.asarray(self.sample, dtype=np.float32).reshape(-1, self.dim)
+
+    def __iter__(self) -> Iterator[tuple[list[str], np.ndarray, list[dict], list[str]]]:
+        """Iterate over the batches of chunks added, without the removed ones."""
+        if self.file is None:
+            return
+        self.file.seek(0)
+        while True:
+            try:
+                start, texts, vectors, metadatas, ids = pickle.load(self.file)
+            except EOFError:
+                break
+            kept = [
+                position
+                for position, metadata in enumerate(metadatas)
+                if start + position >= self.removed.get(metadata.get("message_id"), 0)
+            ]
+            if kept:
+                yield (
+                    [texts[position] for position in kept],
+                    vectors[kept],
+                    [metadatas[position] for position in kept],
+                    [ids[position] for position in kept],
+                )
+
+    def close(self):
+        """Delete the temporary file of the buffer."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def set_search_parameters(index: faiss.Index, config: dict):
+    """Set the search parameters of an index: `nprobe` for IVF indexes and `ef_search` for HNSW indexes."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = config.get("nprobe", 16)
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = config.get("ef_search", 64)
+
+
+def get_search_parameters(index: faiss.Index, config: dict, rows: np.ndarray) -> faiss.SearchParameters:
+    """Get the parameters restricting a search to some rows of an index, keeping its search parameters."""
+    selector = faiss.IDSelectorBatch(rows)
+    if faiss.try_extract_index_ivf(index) is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=config.get("nprobe", 16))
+    if hasattr(index, "hnsw"):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=config.get("ef_search", 64))
+    return faiss.SearchParameters(sel=selector)
+
+
+def supports_removal(index: faiss.Index) -> bool:
+    """Check if vectors can be removed from an index (HNSW indexes do not support it)."""
+    return not hasattr(index, "hnsw")
+
+
+def has_explicit_ids(index: faiss.Index) -> bool:
+    """Check if an index keeps the ids of its vectors (IVF indexes) instead of their positions."""
+    return faiss.try_extract_index_ivf(index) is not None
+
+
+def write_index(index: faiss.Index, path: str):
+    """Save an index, replacing the previous file only once it is fully written."""
+    faiss.write_index(index, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+def read_index(path: str, mmap: bool = False) -> faiss.Index:
+    """Load an index, memory-mapped (and read only) if asked."""
+    if mmap:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    return faiss.read_index(path)
+
+
+def recall_report(vectors: np.ndarray, queries: np.ndarray, configs: list[dict], k: int = 10) -> list[dict]:
+    """Compare the recall and latency of index configurations with the exact flat index.
+
+    Args:
+        vectors (np.ndarray): vectors to index.
+        queries (np.ndarray): query vectors.
+        configs (list[dict]): index configurations to compare.
+        k (int): number of neighbours retrieved.
+
+    Returns:
+        list[dict]: for each configuration, its recall@k, mean latency per query (ms) and build time (s).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    baseline = faiss.IndexFlatL2(vectors.shape[1])
+    baseline.add(vectors)
+    start = time.perf_counter()
+    _, expected = baseline.search(queries, k)
+    flat_latency = (time.perf_counter() - start) * 1000 / len(queries)
+    report = [{"type": "flat", "recall": 1.0, "latency_ms": flat_latency, "build_s": 0.0}]
+    for config in configs:
+        start = time.perf_counter()
+        index = build_index(vectors, config)
+        index.add(vectors)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        _, found = index.search(queries, k)
+        latency = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = np.mean([len(set(f) & set(e)) / k for f, e in zip(found, expected)])
+        report.append({**config, "recall": float(recall), "latency_ms": latency, "build_s": build_time})
+        print(json.dumps(report[-1]))
+    return report
+
+
+def main(args: Optional[list] = None):
+    """Compare the recall and latency of index types on a sample of the emails' vector store."""
+    from src.rag_handler import RAGHandler
+    from src.utils import get_config
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--sample", type=int, default=20000, help="number of indexed chunks in the sample")
+    parser.add_argument("--queries", type=int, default=200, help="number of chunks used as queries")
+    parser.add_argument("--k", type=int, default=10)
+    parsed = parser.parse_args(args)
+    rag_service = RAGHandler(**get_config()["rag"])
+    rag_service.set_embeddings()
+    rag_service.load_vectorestore(mmap=False)
+    vectors = rag_service.get_sample_vectors(parsed.sample)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), min(parsed.queries, len(vectors)), replace=False)]
+    nlist = max(1, int(4 * np.sqrt(len(vectors))))
+    configs = [{"type": "ivf", "nlist": nlist, "nprobe": nprobe} for nprobe in (1, 8, 32)]
+    configs += [{"type": "hnsw", "hnsw_m": 32, "ef_search": ef_search} for ef_search in (16, 64, 256)]
+    configs += [{"type": "ivfpq", "nlist": nlist, "nprobe": nprobe, "pq_m": 16} for nprobe in (8, 32)]
+    recall_report(vectors, queries, configs, parsed.k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""Lexical (BM25) and metadata indexes of the chunks, kept alongside the vector store."""
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from email.utils import getaddresses, parsedate_to_datetime
+from typing import Optional
+
+from langchain_core.documents import Document
+
+# Gmail-like operators that can be used in a query to filter the emails
+FILTER_PATTERN = re.compile(r"\b(from|to|after|before|label):(\"[^\"]*\"|\S+)", re.IGNORECASE)
+FILTER_NAMES = {"from": "sender", "to": "recipient", "after": "after", "before": "before", "label": "label"}
+
+
+def parse_date(value: str) -> float:
+    """Convert a date (YYYY-MM-DD or YYYY/MM/DD) to a timestamp."""
+    return datetime.fromisoformat(value.replace("/", "-")).timestamp()
+
+
+def parse_query(query: str) -> tuple[str, dict]:
+    """Extract the filters of a query, written as Gmail search operators.
+
+    For instance `invoice from:acme after:2024/03/01 before:2024/04/01` searches for `invoice` in the
+    emails sent by an address containing `acme` in March 2024.
+
+    Args:
+        query (str): the query of the user.
+
+    Returns:
+        tuple[str, dict]: the query without the operators, and the filters (`sender`, `recipient`,
+            `after`, `before` and `label`).
+    """
+    filters: dict = {}
+    for name, value in FILTER_PATTERN.findall(query):
+        value = value.strip('"')
+        try:
+            filters[FILTER_NAMES[name.lower()]] = parse_date(value) if name.lower() in ("after", "before") else value
+        except ValueError:
+            print(f"Could not parse the date of the filter {name}:{value}")
+    return FILTER_PATTERN.sub(" ", query).strip(), filters
+
+
+def get_timestamp(metadata: dict) -> Optional[float]:
+    """Get the timestamp of an email from its metadata."""
+    if metadata.get("timestamp"):
+        return float(metadata["timestamp"])
+    if metadata.get("date"):
+        try:
+            return parsedate_to_datetime(metadata["date"]).timestamp()
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+class LexicalIndex:
+    """SQLite index of the chunks: full text search ranked with BM25, and indexes on their email metadata.
+
+    The near-duplicate chunks which are not embedded (see `Deduplicator`) are indexed too, with the id of the
+    chunk they duplicate: the emails they come from are found by the filters and the terms of the queries,
+    the chunk they duplicate being returned in their place.
+    """
+
+    def __init__(self, path: str):
+        """Initialise the index.
+
+        Args:
+            path (str): path of the SQLite database.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                docstore_id TEXT UNIQUE NOT NULL,
+                message_id TEXT,
+                sender TEXT,
+                recipients TEXT,
+                timestamp REAL,
+                original_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS chunks_timestamp ON chunks (timestamp);
+            CREATE TABLE IF NOT EXISTS labels (chunk INTEGER NOT NULL, label TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS labels_label ON labels (label, chunk);
+            CREATE INDEX IF NOT EXISTS labels_chunk ON labels (chunk);
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks_text USING fts5(body, subject);
+            """
+        )
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(chunks)")]
+        if "original_id" not in columns:
+            # index created by a previous version, without the duplicates
+            self.connection.execute("ALTER TABLE chunks ADD COLUMN original_id TEXT")
+        self.connection.executescript(
+            """
+            CREATE INDEX IF NOT EXISTS chunks_message_id ON chunks (message_id);
+            CREATE INDEX IF NOT EXISTS chunks_original_id ON chunks (original_id);
+            """
+        )
+        self.connection.commit()
+
+    def __len__(self) -> int:
+        """Get the number of chunks in the index, their duplicates not counted."""
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM chunks WHERE original_id IS NULL").fetchone()[0]
+
+    def get_nb_duplicates(self) -> int:
+        """Get the number of duplicates of chunks in the index."""
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM chunks WHERE original_id IS NOT NULL").fetchone()[0]
+
+    def add(self, docstore_ids: list[str], documents: list[Document], original_ids: Optional[list[str]] = None):
+        """Add chunks to the index.
+
+        Args:
+            docstore_ids (list[str]): ids of the chunks in the docstore.
+            documents (list[Document]): the chunks, with the metadata of their email.
+            original_ids (list[str]): for near-duplicates which are not in the docstore, the ids of the
+                chunks they duplicate.
+        """
+        original_ids = original_ids or [None] * len(docstore_ids)
+        with self.lock:
+            self.delete(docstore_ids)
+            for docstore_id, document, original_id in zip(docstore_ids, documents, original_ids):
+                metadata = document.metadata
+                recipients = ", ".join(address for _, address in getaddresses([metadata.get("to") or ""]))
+                cursor = self.connection.execute(
+                    "INSERT INTO chunks (docstore_id, message_id, sender, recipients, timestamp, original_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        docstore_id,
+                        metadata.get("message_id"),
+                        (metadata.get("from") or "").lower(),
+                        recipients.lower(),
+                        get_timestamp(metadata),
+                        original_id,
+                    ),
+                )
+                chunk = cursor.lastrowid
+                self.connection.executemany(
+                    "INSERT INTO labels VALUES (?, ?)",
+                    [(chunk, label.upper()) for label in metadata.get("labels") or []],
+                )
+                self.connection.execute(
+                    "INSERT INTO chunks_text (rowid, body, subject) VALUES (?, ?, ?)",
+                    (chunk, document.page_content, metadata.get("subject") or ""),
+                )
+            self.connection.commit()
+
+    def delete(self, docstore_ids: list[str]):
+        """Remove chunks from the index."""
+        with self.lock:
+            for start in range(0, len(docstore_ids), 500):
+                batch = docstore_ids[start : start + 500]
+                placeholders = ",".join("?" * len(batch))
+                chunks = f"SELECT id FROM chunks WHERE docstore_id IN ({placeholders})"
+                self.connection.execute(f"DELETE FROM chunks_text WHERE rowid IN ({chunks})", batch)
+                self.connection.execute(f"DELETE FROM labels WHERE chunk IN ({chunks})", batch)
+                self.connection.execute(f"DELETE FROM chunks WHERE docstore_id IN ({placeholders})", batch)
+            self.connection.commit()
+
+    def delete_messages(self, message_ids: list[str]):
+        """Remove the chunks of Gmail messages from the index, with their duplicates."""
+        with self.lock:
+            for start in range(0, len(message_ids), 500):
+                batch = message_ids[start : start + 500]
+                chunks = f"SELECT id FROM chunks WHERE message_id IN ({','.join('?' * len(batch))})"
+                self.connection.execute(f"DELETE FROM chunks_text WHERE rowid IN ({chunks})", batch)
+                self.connection.execute(f"DELETE FROM labels WHERE chunk IN ({chunks})", batch)
+                self.connection.execute(f"DELETE FROM chunks WHERE id IN ({chunks})", batch)
+            self.connection.commit()
+
+    def clear(self):
+        """Remove all the chunks from the index."""
+        with self.lock:
+            self.connection.executescript("DELETE FROM chunks_text; DELETE FROM labels; DELETE FROM chunks;")
+            self.connection.commit()
+
+    def get_filter_clause(self, filters: dict) -> tuple[str, list]:
+        """Get the SQL condition on the `chunks` table matching filters."""
+        conditions = []
+        parameters: list = []
+        if filters.get("sender"):
+            conditions.append("chunks.sender LIKE ?")
+            parameters.append(f"%{filters['sender'].lower()}%")
+        if filters.get("recipient"):
+            conditions.append("chunks.recipients LIKE ?")
+            parameters.append(f"%{filters['recipient'].lower()}%")
+        if filters.get("after") is not None:
+            conditions.append("chunks.timestamp >= ?")
+            parameters.append(filters["after"])
+        if filters.get("before") is not None:
+            conditions.append("chunks.timestamp < ?")
+            parameters.append(filters["before"])
+        if filters.get("label"):
+            conditions.append("chunks.id IN (SELECT chunk FROM labels WHERE label = ?)")
+            parameters.append(filters["label"].upper())
+        return " AND ".join(conditions) or "1", parameters
+
+    def filter(self, filters: dict) -> set[str]:
+        """Get the ids of the chunks matching filters.
+
+        Args:
+            filters (dict): `sender`, `recipient` (parts of the addresses), `after`, `before` (timestamps)
+                and `label` (Gmail label id).
+
+        Returns:
+            set[str]: the docstore ids of the matching chunks, and of the chunks duplicated by matching ones.
+        """
+        clause, parameters = self.get_filter_clause(filters)
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT DISTINCT COALESCE(original_id, docstore_id) FROM chunks WHERE {clause}", parameters
+            ).fetchall()
+        return {docstore_id for (docstore_id,) in rows}
+
+    def search(self, query: str, k: int, filters: Optional[dict] = None) -> list[tuple[str, float]]:
+        """Search the chunks containing the terms of a query, ranked with BM25.
+
+        Args:
+            query (str): the query.
+            k (int): maximum number of chunks returned.
+            filters (dict): filters on the metadata of the chunks (see `filter`).
+
+        Returns:
+            list[tuple[str, float]]: the docstore ids of the chunks and their BM25 score (lower is better), the
+                duplicates being replaced by the chunk they duplicate.
+        """
+        terms = re.findall(r"\w+", query.lower())
+        if not terms:
+            return []
+        match = " OR ".join(f'"{term}"' for term in dict.fromkeys(terms))
+        clause, parameters = self.get_filter_clause(filters or {})
+        results: dict[str, float] = {}
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT COALESCE(chunks.original_id, chunks.docstore_id), bm25(chunks_text) AS score "
+                "FROM chunks_text JOIN chunks ON chunks.id = chunks_text.rowid "
+                f"WHERE chunks_text MATCH ? AND {clause} ORDER BY score",
+                [match, *parameters],
+            )
+            # a chunk and its duplicates are only returned once, with the best score
+            for docstore_id, score in rows:
+                results.setdefault(docstore_id, score)
+                if len(results) >= k:
+                    break
+        return list(results.items())
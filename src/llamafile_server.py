@@ -0,0 +1,186 @@
+"""Lifecycle of the llamafile server: start or reuse, readiness, warm-up and shutdown."""
+import atexit
+import subprocess
+import threading
+import time
+from typing import Optional
+
+import requests
+
+# servers started by this process, shared by all the sessions of the app
+SERVERS: dict = {}
+SERVERS_LOCK = threading.Lock()
+
+
+class LlamafileServer:
+    """Manager of a llamafile running in server mode."""
+
+    def __init__(
+        self,
+        model_path: str,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+        threads: int = 0,
+        ctx_size: int = 4096,
+        parallel: int = 1,
+        gpu_layers: int = 9999,
+        startup_timeout: float = 300,
+    ):
+        """Initialise the manager.
+
+        Args:
+            model_path (str): path to the llamafile.
+            host (str): host the server listens on.
+            port (int): port the server listens on.
+            threads (int): number of threads used for generation (0 for the llamafile default).
+            ctx_size (int): size of the context, shared by the parallel slots.
+            parallel (int): number of requests the server processes in parallel (slots).
+            gpu_layers (int): number of layers offloaded to the GPU, if any.
+            startup_timeout (float): maximum time to wait for the model to be loaded, in seconds.
+        """
+        self.model_path = model_path
+        self.host = host
+        self.port = port
+        self.threads = threads
+        self.ctx_size = ctx_size
+        self.parallel = parallel
+        self.gpu_layers = gpu_layers
+        self.startup_timeout = startup_timeout
+        self.process: Optional[subprocess.Popen] = None
+        self.timings: dict = {}
+
+    @property
+    def base_url(self) -> str:
+        """Get the URL of the server."""
+        return f"http://{self.host}:{self.port}"
+
+    def get_command(self) -> list[str]:
+        """Get the command starting the server."""
+        command = [
+            self.model_path,
+            "--server",
+            "--nobrowser",
+            "--host",
+            self.host,
+            "--port",
+            str(self.port),
+            "-c",
+            str(self.ctx_size),
+            "-np",
+            str(self.parallel),
+            "-ngl",
+            str(self.gpu_layers),
+        ]
+        if self.threads:
+            command += ["-t", str(self.threads)]
+        return command
+
+    def is_ready(self) -> bool:
+        """Check if the server is up and has loaded the model."""
+        try:
+            response = requests.get(f"{self.base_url}/health", timeout=2)
+            health = response.json() if response.status_code == 200 else None
+        except (requests.RequestException, ValueError):
+            # another process listening on the port does not answer with the health of a llamafile
+            return False
+        return isinstance(health, dict) and health.get("status", "ok") == "ok"
+
+    def start(self):
+        """Start the server, or reuse the one already listening on the same port."""
+        start = time.perf_counter()
+        if self.is_ready():
+            print(f"Reusing the llamafile server running at {self.base_url}.")
+            self.timings = {"ready": time.perf_counter() - start, "reused": True}
+            return
+        print(f"Starting the llamafile server at {self.base_url}.")
+        try:
+            self.process = subprocess.Popen(self.get_command())
+        except OSError:
+            # actually portable executables are run by the shell when the system cannot execute them
+            self.process = subprocess.Popen(["sh"] + self.get_command())
+        atexit.register(self.stop)
+        self.wait_ready()
+        self.timings = {"ready": time.perf_counter() - start, "reused": False}
+
+    def wait_ready(self):
+        """Wait until the server has loaded the model.
+
+        Raises:
+            RuntimeError: if the server process stopped.
+            TimeoutError: if the model is not loaded after `startup_timeout` seconds.
+        """
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process is not None and self.process.poll() is not None:
+                raise RuntimeError(f"The llamafile server exited with code {self.process.returncode}.")
+            if self.is_ready():
+                return
+            time.sleep(0.5)
+        raise TimeoutError(f"The llamafile server was not ready after {self.startup_timeout} seconds.")
+
+    def warm_up(self, prompt_prefix: str = ""):
+        """Load the model weights and cache the prompt prefix shared by all the requests.
+
+        Args:
+            prompt_prefix (str): beginning of the prompts, evaluated once and kept in the cache of the slots.
+        """
+        start = time.perf_counter()
+        response = requests.post(
+            f"{self.base_url}/completion",
+            json={"prompt": prompt_prefix or " ", "n_predict": 1, "cache_prompt": True},
+            timeout=self.startup_timeout,
+        )
+        response.raise_for_status()
+        self.timings["warm_up"] = time.perf_counter() - start
+        self.timings["first_token"] = self.timings["ready"] + self.timings["warm_up"]
+
+    def count_tokens(self, text: str) -> int:
+        """Count the tokens of a text with the tokenizer of the model."""
+        return len(self.tokenize(text))
+
+    def tokenize(self, text: str) -> list[int]:
+        """Split a text into the tokens of the model."""
+        response = requests.post(f"{self.base_url}/tokenize", json={"content": text}, timeout=10)
+        response.raise_for_status()
+        return response.json()["tokens"]
+
+    def detokenize(self, tokens: list[int]) -> str:
+        """Get the text of tokens of the model."""
+        response = requests.post(f"{self.base_url}/detokenize", json={"tokens": tokens}, timeout=10)
+        response.raise_for_status()
+        return response.json()["content"]
+
+    def get_slot_size(self) -> int:
+        """Get the number of tokens of the context of a slot, the context being shared by the parallel slots."""
+        return self.ctx_size // max(1, self.parallel)
+
+    def stop(self):
+        """Stop the server if it has been started by this manager."""
+        if self.process is None or self.process.poll() is not None:
+            return
+        print("Stopping the llamafile server.")
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def get_server(model_path: str, **kwargs) -> LlamafileServer:
+    """Get the server of a llamafile, starting it only once per host and port.
+
+    Args:
+        model_path (str): path to the llamafile.
+        **kwargs: parameters of the server (see `LlamafileServer`).
+
+    Returns:
+        LlamafileServer: the server, ready to answer.
+    """
+    server = LlamafileServer(model_path, **kwargs)
+    with SERVERS_LOCK:
+        key = (server.host, server.port)
+        if key not in SERVERS:
+            server.start()
+            SERVERS[key] = server
+        return SERVERS[key]
@@ -2,11 +2,65 @@
 import os
 import platform
 import subprocess
+import time
+from typing import Iterator, Optional
 
 import requests
 from langchain_community.llms.llamafile import Llamafile
+from langchain_core.outputs import GenerationChunk
+
+from src.context_packer import estimate_tokens, truncate_text
+from src.llamafile_server import get_server
+from src.metrics import increment, observe, span
+from src.query_cache import LRUCache, get_prompt_key
 
 LLM_DIR = os.path.join(os.path.dirname(__file__), "..", "llm")
+PROMPT_TEMPLATE = """<|user|>
+        You are an AI assistant having access to my emails. I have a question: {query}.
+        Here is some emails to help you answer : {context}
+        Provide a short answer based on those emails. Remember, the question is: {query}.
+        <|assistant|>"""
+# beginning of all the prompts, evaluated once by the server at warm-up
+PROMPT_PREFIX = PROMPT_TEMPLATE.split("{query}")[0]
+# tokens kept for the answer in the context of a slot, when their number is not limited by `n_predict`
+ANSWER_TOKENS = 512
+
+
+class StreamingLlamafile(Llamafile):
+    """Llamafile LLM yielding each token as soon as the server sends it.
+
+    The langchain class reads the stream by blocks of 512 bytes, so the tokens arrive by bursts of about ten,
+    and keeps the connection open when the stream is closed, so the server keeps generating.
+    """
+
+    def _stream(self, prompt: str, stop: Optional[list[str]] = None, run_manager=None, **kwargs) -> Iterator:
+        params = self._get_parameters(stop=stop, **kwargs)
+        params.setdefault("stream", True)
+        try:
+            response = requests.post(
+                url=f"{self.base_url}/completion",
+                headers={"Content-Type": "application/json"},
+                json={"prompt": prompt, **params},
+                stream=True,
+                timeout=self.request_timeout,
+            )
+        except requests.exceptions.ConnectionError:
+            raise requests.exceptions.ConnectionError(
+                f"Could not connect to Llamafile server. Please make sure that a server is running at {self.base_url}."
+            )
+        response.encoding = "utf8"
+        try:
+            for raw_chunk in response.iter_lines(chunk_size=None, decode_unicode=True):
+                if not raw_chunk:
+                    # blank line separating the events
+                    continue
+                chunk = GenerationChunk(text=self._get_chunk_content(raw_chunk))
+                if run_manager:
+                    run_manager.on_llm_new_token(token=chunk.text)
+                yield chunk
+        finally:
+            # closing the connection stops the generation by the server
+            response.close()
 
 
 class LLMHandler:
@@ -17,6 +71,9 @@ class LLMHandler:
         self.llm = None
         self.model_url = model_url
         self.model_name = model_name
+        self.answer_cache = LRUCache()
+        self.server = None
+        self.answer_tokens = ANSWER_TOKENS
 
     def set_llm_config(self, model_url, model_name):
         """Set model_url."""
@@ -48,33 +105,119 @@ class LLMHandler:
             print(f"Something went wrong while making the llamafile executable: {e}")
             raise e
 
-    def start_llamafile(self):
-        """Start the llamafile."""
+    def start_llamafile(self, warm_up: bool = True, **kwargs):
+        """Start the llamafile server, or reuse the one already running, and wait for the model to be loaded.
+
+        Args:
+            warm_up (bool): whether to evaluate the beginning of the prompt once the model is loaded.
+            **kwargs: parameters of the server (see `LlamafileServer`): port, threads, context size, slots...
+        """
         if not os.path.exists(os.path.join(LLM_DIR, self.model_name)):
             self.download_model()
         try:
-            subprocess.Popen(f"{os.path.join(LLM_DIR, self.model_name)} -ngl 9999 --server --nobrowser", shell=True)
+            with span("llm.start"):
+                self.server = get_server(os.path.join(LLM_DIR, self.model_name), **kwargs)
+            if warm_up and "warm_up" not in self.server.timings:
+                with span("llm.warm_up"):
+                    self.server.warm_up(PROMPT_PREFIX)
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
             raise e
+        print(f"Llamafile server ready: {self.server.timings}")
+
+    def stop_llamafile(self):
+        """Stop the llamafile server if it has been started by this process."""
+        if self.server is not None:
+            self.server.stop()
+
+    def set_answer_cache(self, max_size: int = 256, ttl: float = 3600):
+        """Set the cache of the answers, keyed by prompt."""
+        self.answer_cache = LRUCache(max_size=max_size, ttl=ttl)
 
     def set_llm(self, **kwargs):
         """Set the LLM once the llamafile has started."""
-        self.llm = Llamafile(**kwargs)
+        if self.server is not None:
+            kwargs.setdefault("base_url", self.server.base_url)
+        if kwargs.get("n_predict", -1) > 0:
+            self.answer_tokens = kwargs["n_predict"]
+        self.llm = StreamingLlamafile(**kwargs)
+
+    def count_tokens(self, text: str) -> int:
+        """Count the tokens of a text with the tokenizer of the model (estimated if the server is not started)."""
+        if self.server is None:
+            return estimate_tokens(text)
+        try:
+            return self.server.count_tokens(text)
+        except requests.RequestException as e:
+            print(f"Could not count the tokens with the llamafile server: {e}")
+            return estimate_tokens(text)
+
+    def truncate_tokens(self, text: str, max_tokens: int) -> str:
+        """Cut a text to a number of tokens of the model, tokenized once (estimated if the server is not started)."""
+        if self.server is None:
+            return truncate_text(text, max_tokens)
+        try:
+            tokens = self.server.tokenize(text)
+            if len(tokens) <= max_tokens:
+                return text
+            return self.server.detokenize(tokens[: max(0, max_tokens)])
+        except requests.RequestException as e:
+            print(f"Could not tokenize the text with the llamafile server: {e}")
+            return truncate_text(text, max_tokens)
+
+    def get_context_budget(self, query: str) -> Optional[int]:
+        """Get the number of tokens left for the context of a question in a slot of the server.
+
+        The context of a slot is the context size of the server divided by its parallel slots, and must also hold
+        the prompt template, the question and the answer.
+
+        Returns:
+            Optional[int]: the number of tokens, None if the server is not started.
+        """
+        if self.server is None:
+            return None
+        prompt_tokens = self.count_tokens(self.prepare_prompt(query, ""))
+        return max(0, self.server.get_slot_size() - prompt_tokens - self.answer_tokens)
 
     def prepare_prompt(self, query, context) -> str:
         """Prepare the prompt for the model."""
-        prompt = f"""<|user|>
-        You are an AI assistant having access to my emails. I have a question: {query}.
-        Here is some emails to help you answer : {context}
-        Provide a short answer based on those emails. Remember, the question is: {query}.
-        <|assistant|>"""
+        prompt = PROMPT_TEMPLATE.format(query=query, context=context)
         return prompt
 
     def llm_stream(self, input_text):
-        """Generate a response by the LLM in a stream way."""
-        yield self.llm.stream(input_text)
+        """Generate a response by the LLM in a stream way, or return the cached answer to the same prompt.
+
+        The time to the first token (mostly the evaluation of the prompt) and the generation speed are
+        reported to the metrics.
+        """
+        key = get_prompt_key(input_text)
+        answer = self.answer_cache.get(key)
+        if answer is not None:
+            increment("llm.answer_cache_hits")
+            yield answer
+            return
+        tokens = []
+        start = time.perf_counter()
+        first_token = None
+        for token in self.llm.stream(input_text):
+            if first_token is None:
+                first_token = time.perf_counter()
+                observe("llm.time_to_first_token_seconds", first_token - start)
+            tokens.append(token)
+            yield token
+        end = time.perf_counter()
+        increment("llm.tokens_generated", len(tokens))
+        observe("llm.stream_seconds", end - start)
+        if first_token is not None and len(tokens) > 1 and end > first_token:
+            observe("llm.tokens_per_second", (len(tokens) - 1) / (end - first_token))
+        self.answer_cache.put(key, "".join(tokens))
 
     def llm_invoke(self, input_text):
         """Generate a response not in a stream way."""
-        self.llm.invoke(input_text)
+        key = get_prompt_key(input_text)
+        answer = self.answer_cache.get(key)
+        if answer is None:
+            with span("llm.invoke"):
+                answer = self.llm.invoke(input_text)
+            self.answer_cache.put(key, answer)
+        return answer
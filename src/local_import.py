@@ -0,0 +1,416 @@
+"""Import the emails of local mailboxes (mbox files, e.g. a Google Takeout export, and Maildir folders).
+
+The mbox files are memory-mapped: the messages are delimited by their `From ` line without reading the
+whole file, and each process of the parsing pool reads the messages it parses from its own mapping. The
+messages are converted to the format of the Gmail API, so that their text is extracted like the
+downloaded emails (see `EmailHandler.parse_message`), then indexed, without any call to the API:
+
+    python -m src.local_import "Takeout/Mail/All mail Including Spam and Trash.mbox"
+
+The emails of a Google Takeout export keep their Gmail ids, so that the mailbox can then be synchronised
+with the Gmail API from the export (`--sync`), only downloading the emails received since.
+"""
+import argparse
+import email
+import hashlib
+import mmap
+import os
+import re
+import time
+from base64 import urlsafe_b64encode
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from email.header import decode_header, make_header
+from email.message import Message
+from email.utils import parsedate_to_datetime
+from itertools import islice
+from typing import Iterator, Optional
+
+from tqdm import tqdm
+
+from src.email_handler import IGNORED_LABELS, EmailHandler
+from src.metrics import increment
+from src.rag_handler import RAGHandler
+from src.utils import get_config
+
+MBOX_SEPARATOR = b"\nFrom "
+# `From ` line of the messages of a Google Takeout export: the decimal Gmail id of the message, then its date
+TAKEOUT_FROM_PATTERN = re.compile(rb"^From (\d+)@xxx (.*)$")
+# lines starting with `From ` are escaped in the body of the messages of an mbox file
+ESCAPED_FROM_PATTERN = re.compile(rb"^>(>*From )", re.MULTILINE)
+# names of the system labels in a Google Takeout export (`X-Gmail-Labels`), with their Gmail API id
+TAKEOUT_LABELS = {"Drafts": "DRAFT", "Chat": "CHAT", "Opened": None}
+# messages of a location: path, start and end of the message in the file (None for the whole file), and
+# label of the Maildir folder
+Location = tuple[str, int, Optional[int], Optional[str]]
+
+
+def decode_header_value(value) -> str:
+    """Decode an encoded header (RFC 2047), e.g. `=?utf-8?q?R=C3=A9union?=`."""
+    try:
+        return str(make_header(decode_header(str(value))))
+    except (LookupError, UnicodeError, ValueError):
+        return str(value)
+
+
+def get_id(value: str) -> str:
+    """Get a Gmail-like id (16 hexadecimal characters) from a header value."""
+    return hashlib.sha1(value.encode("utf-8", errors="replace")).hexdigest()[:16]
+
+
+def get_label(name: str) -> Optional[str]:
+    """Get the Gmail API id of a label from its name in a Google Takeout export or a Maildir folder."""
+    if name in TAKEOUT_LABELS:
+        return TAKEOUT_LABELS[name]
+    return "_".join(name.replace("/", " ").split()).upper() or None
+
+
+def convert_part(part: Message) -> dict:
+    """Convert a MIME part to a partition of the Gmail API format, only keeping the content of the texts."""
+    mime_type = part.get_content_type()
+    filename = decode_header_value(part.get_filename() or "") if part.get_filename() else ""
+    result: dict = {"mimeType": mime_type, "filename": filename, "headers": [], "body": {}}
+    if part.is_multipart():
+        result["parts"] = [convert_part(subpart) for subpart in part.get_payload()]
+        return result
+    payload = part.get_payload(decode=True) or b""
+    result["body"]["size"] = len(payload)
+    if mime_type in ("text/plain", "text/html") and not filename:
+        charset = part.get_content_charset() or "utf-8"
+        try:
+            text = payload.decode(charset, errors="replace")
+        except LookupError:
+            text = payload.decode("utf-8", errors="replace")
+        result["body"]["data"] = urlsafe_b64encode(text.encode("utf-8")).decode()
+    return result
+
+
+def list_attachments(part: dict) -> list[dict]:
+    """List the attachments of a converted message, with their `filename`, `mime_type` and `size`."""
+    attachments = []
+    for subpart in part.get("parts") or []:
+        attachments.extend(list_attachments(subpart))
+    if part.get("filename"):
+        attachments.append(
+            {"filename": part["filename"], "mime_type": part["mimeType"], "size": part["body"].get("size", 0)}
+        )
+    return attachments
+
+
+def to_gmail_message(raw: bytes, folder_label: Optional[str] = None) -> Optional[dict]:
+    """Convert a message of a local mailbox to the `full` format of the Gmail API.
+
+    Args:
+        raw (bytes): the message, with the `From ` line of its mbox file if any.
+        folder_label (str): label of the Maildir folder of the message.
+
+    Returns:
+        dict: the message, None if it is a draft, a spam or in the trash (like with the Gmail API).
+    """
+    gmail_id, from_date = None, None
+    if raw.startswith(b"From "):
+        from_line, _, raw = raw.partition(b"\n")
+        match = TAKEOUT_FROM_PATTERN.match(from_line.rstrip(b"\r"))
+        if match:
+            gmail_id, from_date = f"{int(match.group(1)):x}", match.group(2).decode("ascii", errors="replace")
+        raw = ESCAPED_FROM_PATTERN.sub(rb"\1", raw)
+    message = email.message_from_bytes(raw)
+    labels = [get_label(name.strip()) for name in decode_header_value(message.get("X-Gmail-Labels", "")).split(",")]
+    labels = list(dict.fromkeys(label for label in labels + [folder_label] if label))
+    if IGNORED_LABELS & set(labels):
+        return None
+    message_id = message.get("Message-ID", "").strip()
+    if gmail_id is None:
+        gmail_id = get_id(message_id) if message_id else hashlib.sha1(raw).hexdigest()[:16]
+    if message.get("X-GM-THRID", "").strip().isdigit():
+        thread_id = f"{int(message['X-GM-THRID']):x}"
+    else:
+        # the thread is the first email it references
+        references = (message.get("References") or message.get("In-Reply-To") or "").split()
+        thread_id = get_id(references[0]) if references else get_id(message_id) if message_id else gmail_id
+    internal_date = None
+    for date in (message.get("Date"), from_date):
+        try:
+            internal_date = str(int(parsedate_to_datetime(date).timestamp() * 1000))
+            break
+        except (TypeError, ValueError, IndexError):
+            continue
+    headers = [
+        {"name": name, "value": decode_header_value(message[name])}
+        for name in ("From", "To", "Date", "Subject")
+        if message[name] is not None
+    ]
+    payload = convert_part(message)
+    payload["headers"] = headers
+    return {
+        "id": gmail_id,
+        "threadId": thread_id,
+        "labelIds": labels,
+        "internalDate": internal_date,
+        "payload": payload,
+    }
+
+
+def iter_mbox(path: str) -> Iterator[Location]:
+    """Locate the messages of an mbox file, without reading it in memory.
+
+    Args:
+        path (str): path of the mbox file.
+
+    Yields:
+        Location: the start and end of each message in the file.
+    """
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        size = len(mapping)
+        start = 0 if mapping[:5] == b"From " else mapping.find(MBOX_SEPARATOR) + 1
+        if start == 0 and mapping[:5] != b"From ":
+            print(f"Skipping {path}: not an mbox file")
+            return
+        while start < size:
+            end = mapping.find(MBOX_SEPARATOR, start)
+            end = size if end == -1 else end + 1
+            yield path, start, end, None
+            start = end
+
+
+def iter_maildir(path: str) -> Iterator[Location]:
+    """Locate the messages of a Maildir folder and of its sub-folders, labelled with the name of their folder.
+
+    Args:
+        path (str): path of the Maildir folder.
+
+    Yields:
+        Location: the file of each message.
+    """
+    for folder, subfolders, filenames in os.walk(path):
+        subfolders.sort()
+        if os.path.basename(folder) not in ("cur", "new"):
+            continue
+        name = os.path.relpath(os.path.dirname(folder), path)
+        # Maildir++ sub-folders are named `.Parent.Child`
+        label = "INBOX" if name == "." else get_label(name.strip(".").replace(".", " "))
+        for filename in sorted(filenames):
+            if not filename.startswith("."):
+                yield os.path.join(folder, filename), 0, None, label
+
+
+def iter_locations(paths: list[str]) -> Iterator[Location]:
+    """Locate the messages of mbox files, Maildir folders, and folders of mbox files like a Takeout export."""
+    for path in paths:
+        if os.path.isfile(path):
+            yield from iter_mbox(path)
+        elif any(os.path.isdir(os.path.join(path, name)) for name in ("cur", "new")):
+            yield from iter_maildir(path)
+        elif os.path.isdir(path):
+            for folder, subfolders, filenames in os.walk(path):
+                subfolders.sort()
+                if any(name in ("cur", "new") for name in subfolders):
+                    subfolders.clear()
+                    yield from iter_maildir(folder)
+                    continue
+                for filename in sorted(filenames):
+                    if filename.endswith(".mbox"):
+                        yield from iter_mbox(os.path.join(folder, filename))
+        else:
+            print(f"Skipping {path}: no such file or folder")
+
+
+# handler parsing the messages and mappings of the mbox files, in each process of the parsing pool
+PARSER: Optional[EmailHandler] = None
+MAPPINGS: dict = {}
+
+
+def init_importer(html_extractor: str):
+    """Initialise a process of the parsing pool."""
+    global PARSER
+    PARSER = EmailHandler("", "", [], html_extractor=html_extractor)
+
+
+def read_message(location: Location) -> bytes:
+    """Read a message of a local mailbox, from the mapping of its mbox file."""
+    path, start, end, _ = location
+    if end is None:
+        with open(path, "rb") as f:
+            return f.read()
+    mapping = MAPPINGS.get(path)
+    if mapping is None:
+        with open(path, "rb") as f:
+            mapping = MAPPINGS[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return mapping[start:end]
+
+
+def parse_locations(locations: list[Location]) -> list[tuple]:
+    """Parse messages of local mailboxes into documents.
+
+    Returns:
+        list[tuple]: the id and the document of each message (None for the documents of the emails without
+            text, and for both for the emails skipped), and whether the id is its Gmail id (Google Takeout).
+    """
+    parsed = []
+    for location in locations:
+        try:
+            raw = read_message(location)
+            msg = to_gmail_message(raw, location[3])
+        except Exception as e:
+            print(f"Could not parse the message at {location[0]}:{location[1]}: {e}")
+            msg = None
+        if msg is None:
+            parsed.append((None, None, False))
+            continue
+        document = PARSER.parse_message(msg)
+        if document is not None:
+            attachments = list_attachments(msg["payload"])
+            if attachments:
+                document.metadata["attachments"] = attachments
+        exported = TAKEOUT_FROM_PATTERN.match(raw.partition(b"\n")[0].rstrip(b"\r")) is not None
+        parsed.append((msg["id"], document, exported))
+    return parsed
+
+
+def iter_local_documents(
+    paths: list[str],
+    processes: int = 0,
+    batch_size: int = 200,
+    html_extractor: str = "fast",
+    seen=None,
+    local_ids=None,
+):
+    """Parse the emails of local mailboxes as a stream of documents.
+
+    Args:
+        paths (list[str]): mbox files, Maildir folders or folders containing them.
+        processes (int): number of processes parsing the emails (0 to parse them in the main process).
+        batch_size (int): number of emails sent at once to a process.
+        html_extractor (str): extractor of the text of HTML emails (see `html_extractor.get_extractor`).
+        seen (set): ids of the emails already imported, which are skipped. The ids of the emails imported
+            (with or without text) are added to it.
+        local_ids (set): the ids of the emails imported which are not Gmail ids (not exported by Google
+            Takeout) are added to it.
+
+    Yields:
+        Document: one document per email having some text, with the same metadata as the Gmail emails.
+    """
+    seen = set() if seen is None else seen
+    locations = iter_locations(paths)
+    batches = iter(lambda: list(islice(locations, batch_size)), [])
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=processes, initializer=init_importer, initargs=(html_extractor,))
+        results = run_in_pool(executor, batches, processes)
+    else:
+        init_importer(html_extractor)
+        results = map(parse_locations, batches)
+    with tqdm(unit=" emails") as progress:
+        for parsed in results:
+            progress.update(len(parsed))
+            for message_id, document, exported in parsed:
+                # the same email can be in several folders
+                if message_id is None or message_id in seen:
+                    continue
+                seen.add(message_id)
+                if not exported and local_ids is not None:
+                    local_ids.add(message_id)
+                if document is not None:
+                    increment("import.emails")
+                    yield document
+
+
+def run_in_pool(executor: ProcessPoolExecutor, batches, processes: int):
+    """Parse batches of messages in a pool of processes, at most two batches per process being in flight."""
+    with executor:
+        futures: deque = deque()
+        for batch in batches:
+            futures.append(executor.submit(parse_locations, batch))
+            if len(futures) >= processes * 2:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def sync_imported(email_handler: EmailHandler, imported: set) -> tuple:
+    """Get the changes of the Gmail mailbox since its export, and save its synchronisation checkpoint.
+
+    Args:
+        email_handler (EmailHandler): handler of the mailbox the emails were exported from.
+        imported (set): Gmail ids of the emails imported.
+
+    Returns:
+        tuple: documents of the emails missing from the export, and ids of the emails deleted since.
+    """
+    email_handler.set_service()
+    history_id = email_handler.get_history_id()
+    messages = email_handler.search_messages("")
+    listed = {message["id"] for message in messages}
+    missing = [message for message in messages if message["id"] not in imported]
+    print(f"{len(missing)} emails received and {len(imported - listed)} deleted since the export.")
+    email_handler.pending_sync_state = {"history_id": history_id, "message_ids": listed}
+    return email_handler.iter_documents(missing), sorted(imported - listed)
+
+
+def main(args: Optional[list] = None):
+    """Import the emails of local mailboxes in the index."""
+    config = get_config()
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("paths", nargs="+", help="mbox files, Maildir folders, or folders containing them")
+    parser.add_argument(
+        "--processes", type=int, default=os.cpu_count() or 1, help="number of processes parsing the emails"
+    )
+    parser.add_argument("--account", help="account of the emails, when several accounts are configured")
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="then synchronise the index with the Gmail mailbox the emails were exported from (Google Takeout "
+        "exports only, the other emails have no Gmail id)",
+    )
+    args = parser.parse_args(args)
+
+    email_config = config["email"]
+    imported: set = set()
+    local_ids: set = set()
+    documents = iter_local_documents(
+        args.paths,
+        args.processes,
+        html_extractor=email_config.get("html_extractor", "fast"),
+        seen=imported,
+        local_ids=local_ids,
+    )
+    start = time.perf_counter()
+    if args.account:
+        from src.sharded_index import ShardedIndex, get_account_handler
+
+        accounts = {account["name"]: account for account in config.get("accounts") or []}
+        if args.account not in accounts:
+            parser.error(f"Unknown account {args.account}, the accounts are: {', '.join(accounts) or 'none'}")
+        rag_service: RAGHandler = ShardedIndex(**config.get("shards", {}), **config["rag"])
+        rag_service.set_embeddings()
+        rag_service.update_account(args.account, documents, [])
+        email_handler = get_account_handler(config, accounts[args.account], rag_service.index_dir)
+    else:
+        rag_service = RAGHandler(**config["rag"])
+        if rag_service.has_index():
+            rag_service.set_embeddings()
+            rag_service.load_vectorestore()
+            rag_service.update_vectorestore(documents, [])
+        else:
+            rag_service.initialise_set_up(documents)
+        email_handler = EmailHandler(**email_config)
+    duration = time.perf_counter() - start
+    print(f"{len(imported)} emails imported in {duration:.1f}s ({len(imported) / duration:.1f} per second).")
+    if args.sync and local_ids:
+        # their ids never match the Gmail ones: they would all be deleted, and the mailbox downloaded again
+        print(
+            f"Not synchronising with Gmail: {len(local_ids)} emails imported are not from a Google Takeout export, "
+            "their ids cannot be matched with the ids of the Gmail emails."
+        )
+    elif args.sync:
+        added_documents, deleted_message_ids = sync_imported(email_handler, imported)
+        if args.account:
+            rag_service.update_account(args.account, added_documents, deleted_message_ids)
+        else:
+            rag_service.update_vectorestore(added_documents, deleted_message_ids)
+        email_handler.commit_sync()
+
+
+if __name__ == "__main__":
+    main()
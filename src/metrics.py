@@ -0,0 +1,280 @@
+"""Lightweight instrumentation of the pipeline: timed spans, counters and summaries.
+
+The metrics are disabled by default, in which case `span` returns a shared no-op context manager and the
+other functions return immediately. Once enabled with `configure`, they can be written as JSON lines
+and exposed in the Prometheus text format.
+"""
+import functools
+import json
+import re
+import sys
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional, TextIO
+
+PREFIX = "emailbot"
+# upper bounds of the buckets of the span durations, in seconds
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+NULL_SPAN = nullcontext()
+
+
+def get_metric_name(name: str, suffix: str = "") -> str:
+    """Convert a dotted metric name (e.g. `rag.query`) to a Prometheus one (`emailbot_rag_query_seconds`)."""
+    return f"{PREFIX}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}{suffix}"
+
+
+def format_labels(labels: tuple, extra: str = "") -> str:
+    """Format the labels of a metric in the Prometheus text format."""
+    items = [f'{key}="{str(value)}"' for key, value in labels]
+    if extra:
+        items.append(extra)
+    return "{" + ",".join(items) + "}" if items else ""
+
+
+class Metrics:
+    """Thread-safe registry of the metrics of the process."""
+
+    def __init__(self):
+        """Initialise an empty, disabled registry."""
+        self.enabled = False
+        self.log_stream: Optional[TextIO] = None
+        self.lock = threading.Lock()
+        # (name, labels) -> [count, sum, bucket counts]
+        self.histograms: dict = {}
+        # (name, labels) -> value
+        self.counters: dict = {}
+        # (name, labels) -> [count, sum, last value]
+        self.summaries: dict = {}
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    def log(self, kind: str, name: str, value: float, labels: dict):
+        """Write a measure as a JSON line, if the JSON logs are enabled."""
+        if self.log_stream is None:
+            return
+        record = {"time": time.time(), "type": kind, "name": name, "value": value, **labels}
+        with self.lock:
+            print(json.dumps(record), file=self.log_stream, flush=True)
+
+    def record_span(self, name: str, duration: float, labels: dict):
+        """Add the duration of a span to its histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0, 0.0, [0] * len(DURATION_BUCKETS)]
+            histogram[0] += 1
+            histogram[1] += duration
+            for position, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    histogram[2][position] += 1
+        self.log("span", name, duration, labels)
+
+    def increment(self, name: str, value: float, labels: dict):
+        """Increment a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.log("counter", name, value, labels)
+
+    def observe(self, name: str, value: float, labels: dict):
+        """Add a value to a summary."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            summary = self.summaries.get(key)
+            if summary is None:
+                summary = self.summaries[key] = [0, 0.0, 0.0]
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = value
+        self.log("observation", name, value, labels)
+
+    def clear(self):
+        """Remove all the measures."""
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.summaries.clear()
+
+    def get_snapshot(self) -> dict:
+        """Get the current value of the metrics, as a JSON-serialisable dict."""
+        with self.lock:
+            return {
+                "spans": {
+                    self.get_key(name, labels): {"count": count, "seconds": total, "mean": total / count}
+                    for (name, labels), (count, total, _) in self.histograms.items()
+                },
+                "counters": {self.get_key(name, labels): value for (name, labels), value in self.counters.items()},
+                "summaries": {
+                    self.get_key(name, labels): {"count": count, "mean": total / count, "last": last}
+                    for (name, labels), (count, total, last) in self.summaries.items()
+                },
+            }
+
+    @staticmethod
+    def get_key(name: str, labels: tuple) -> str:
+        """Get the key of a metric in a snapshot."""
+        return name + "".join(f"[{key}={value}]" for key, value in labels)
+
+    def render_prometheus(self) -> str:
+        """Get the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            declared = set()
+            for (name, labels), (count, total, buckets) in sorted(self.histograms.items()):
+                metric = get_metric_name(name, "_seconds")
+                if metric not in declared:
+                    lines.append(f"# TYPE {metric} histogram")
+                    declared.add(metric)
+                for bound, bucket in zip(DURATION_BUCKETS + ("+Inf",), buckets + [count]):
+                    bucket_labels = format_labels(labels, f'le="{bound}"')
+                    lines.append(f"{metric}_bucket{bucket_labels} {bucket}")
+                lines.append(f"{metric}_sum{format_labels(labels)} {total}")
+                lines.append(f"{metric}_count{format_labels(labels)} {count}")
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = get_metric_name(name, "_total")
+                if metric not in declared:
+                    lines.append(f"# TYPE {metric} counter")
+                    declared.add(metric)
+                lines.append(f"{metric}{format_labels(labels)} {value}")
+            for (name, labels), (count, total, _) in sorted(self.summaries.items()):
+                metric = get_metric_name(name)
+                if metric not in declared:
+                    lines.append(f"# TYPE {metric} summary")
+                    declared.add(metric)
+                lines.append(f"{metric}_sum{format_labels(labels)} {total}")
+                lines.append(f"{metric}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def serve_prometheus(self, host: str, port: int):
+        """Expose the metrics on `http://host:port/metrics`, from a background thread."""
+        if self.server is not None:
+            return
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Handler serving the metrics in the Prometheus text format."""
+
+            def do_GET(self):
+                """Answer the requests of `/metrics`, any other path being not found."""
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                content = registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                """Do not log the requests, the metrics being scraped every few seconds."""
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"Metrics exposed at http://{host}:{self.server.server_address[1]}/metrics")
+
+
+METRICS = Metrics()
+
+
+class Span:
+    """Context manager timing a stage of the pipeline."""
+
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name: str, labels: dict):
+        """Initialise the span.
+
+        Args:
+            name (str): name of the stage.
+            labels (dict): labels of the measure.
+        """
+        self.name = name
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        """Start timing the stage."""
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Record the duration of the stage, labelled with the type of the error it raised, if any."""
+        labels = self.labels if exc_type is None else {**self.labels, "error": exc_type.__name__}
+        METRICS.record_span(self.name, time.perf_counter() - self.start, labels)
+        return False
+
+
+def configure(
+    enabled: bool = False,
+    json_logs: bool = False,
+    log_path: Optional[str] = None,
+    prometheus_port: Optional[int] = None,
+    prometheus_host: str = "127.0.0.1",
+):
+    """Enable or disable the metrics.
+
+    Args:
+        enabled (bool): whether the metrics are measured.
+        json_logs (bool): whether each measure is written as a JSON line.
+        log_path (str): file the JSON lines are appended to (standard error when not given).
+        prometheus_port (int): port of the Prometheus endpoint (not exposed when not given).
+        prometheus_host (str): host of the Prometheus endpoint.
+    """
+    METRICS.enabled = enabled
+    METRICS.log_stream = None
+    if enabled and json_logs:
+        METRICS.log_stream = open(log_path, "a", encoding="utf-8") if log_path else sys.stderr
+    if enabled and prometheus_port is not None:
+        METRICS.serve_prometheus(prometheus_host, prometheus_port)
+
+
+def span(name: str, **labels):
+    """Time a block of code.
+
+    Args:
+        name (str): dotted name of the stage, e.g. `rag.query`.
+        **labels: labels of the measure.
+
+    Returns:
+        a context manager, doing nothing when the metrics are disabled.
+    """
+    if not METRICS.enabled:
+        return NULL_SPAN
+    return Span(name, labels)
+
+
+def timed(name: str) -> Callable:
+    """Decorate a function so that each call is timed as a span."""
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return function(*args, **kwargs)
+            with Span(name, {}):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def increment(name: str, value: float = 1, **labels):
+    """Increment a counter, e.g. the number of messages fetched."""
+    if METRICS.enabled:
+        METRICS.increment(name, value, labels)
+
+
+def observe(name: str, value: float, **labels):
+    """Record a value which is not a duration of a span, e.g. a number of tokens per second."""
+    if METRICS.enabled:
+        METRICS.observe(name, value, labels)
+
+
+def get_snapshot() -> dict:
+    """Get the current value of the metrics."""
+    return METRICS.get_snapshot()
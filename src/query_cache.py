@@ -0,0 +1,73 @@
+"""In-memory caches of the query pipeline: query embeddings, retrieved chunks and answers."""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+def normalize_query(query: str) -> str:
+    """Normalize the whitespace of a query so that the same question written differently shares the cache entries.
+
+    The case is kept, since the embedding of a query depends on it.
+    """
+    return " ".join(query.split())
+
+
+def get_prompt_key(prompt: str) -> str:
+    """Get the cache key of a prompt."""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe cache evicting the least recently used entries, and the entries older than a time to live."""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600):
+        """Initialise the cache.
+
+        Args:
+            max_size (int): maximum number of entries.
+            ttl (float): time to live of the entries in seconds (0 for no expiry).
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get the value of a key, or `default` when it is not in the cache or has expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (not self.ttl or time.monotonic() - entry[0] < self.ttl):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any):
+        """Set the value of a key, evicting the least recently used entry if the cache is full."""
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all the entries."""
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self) -> dict:
+        """Get the size and the hit rate of the cache."""
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,83 @@
+"""Thin client of the query service, used by the Streamlit app and the scripts."""
+import time
+import uuid
+from typing import Iterator, Optional
+
+import requests
+
+
+class QueryClient:
+    """Client of the HTTP query service."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, timeout: float = 600):
+        """Initialise the client.
+
+        Args:
+            host (str): host of the service.
+            port (int): port of the service.
+            timeout (float): maximum time to wait for the service to answer, in seconds.
+        """
+        self.base_url = f"http://{host}:{port}"
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def is_ready(self) -> bool:
+        """Check if the service is up."""
+        try:
+            return self.session.get(f"{self.base_url}/health", timeout=2).ok
+        except requests.RequestException:
+            # the service may not answer in time while it loads the index
+            return False
+
+    def wait_ready(self, timeout: float = 600):
+        """Wait for the service to be up, raising TimeoutError after `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+        while not self.is_ready():
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"The query service at {self.base_url} is not up after {timeout} seconds")
+            time.sleep(0.5)
+
+    def stream(self, query: str, request_id: Optional[str] = None) -> Iterator[str]:
+        """Ask a question, the answer being streamed.
+
+        Args:
+            query (str): the question.
+            request_id (str): id of the request, to cancel it (random when not given).
+
+        Yields:
+            str: the parts of the answer, as they are generated. Closing the iterator stops the generation.
+        """
+        request_id = request_id or uuid.uuid4().hex
+        with self.session.post(
+            f"{self.base_url}/query",
+            json={"query": query, "stream": True, "request_id": request_id},
+            stream=True,
+            timeout=self.timeout,
+        ) as response:
+            response.raise_for_status()
+            response.encoding = "utf-8"
+            yield from response.iter_content(chunk_size=None, decode_unicode=True)
+
+    def ask(self, query: str) -> str:
+        """Ask a question, returning the whole answer."""
+        response = self.session.post(
+            f"{self.base_url}/query", json={"query": query, "stream": False}, timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()["answer"]
+
+    def cancel(self, request_id: str) -> bool:
+        """Stop the generation of an answer, returning False if it was already over."""
+        return self.session.post(f"{self.base_url}/cancel/{request_id}", timeout=self.timeout).ok
+
+    def get_context(self, query: str) -> str:
+        """Get the emails retrieved for a question."""
+        response = self.session.post(f"{self.base_url}/context", json={"query": query}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["context"]
+
+    def get_stats(self) -> dict:
+        """Get the cache statistics and the metrics of the service."""
+        response = self.session.get(f"{self.base_url}/stats", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
@@ -0,0 +1,289 @@
+"""Asynchronous HTTP service answering the questions, sharing one index and one LLM between all the clients.
+
+The index, the embedding model and the llamafile server are loaded once. Questions are answered by
+`POST /query` as a stream of tokens, at most one per slot of the llamafile server at a time: the others wait
+in a bounded queue. A generation stops as soon as its client disconnects or calls `POST /cancel/<id>`.
+
+    python -m src.query_service --port 8765
+"""
+import argparse
+import asyncio
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from aiohttp import web
+
+from src.email_handler import EmailHandler
+from src.llm_handler import LLMHandler
+from src.metrics import METRICS, configure, get_snapshot, increment, observe
+from src.rag_handler import RAGHandler
+from src.sharded_index import build_sharded_index
+from src.utils import get_config
+
+# end of the stream of tokens of a generation
+END_OF_STREAM = object()
+
+
+class QueryService:
+    """Service answering the questions with a shared RAG and LLM."""
+
+    def __init__(self, rag_service: RAGHandler, llm_handler: LLMHandler, slots: int = 1, max_queued: int = 32):
+        """Initialise the service.
+
+        Args:
+            rag_service (RAGHandler): the RAG, with its vector store loaded.
+            llm_handler (LLMHandler): the LLM, with its llamafile server started.
+            slots (int): number of answers generated at the same time, the number of slots of the server.
+            max_queued (int): maximum number of questions waiting for a slot, the next ones are rejected.
+        """
+        self.rag_service = rag_service
+        self.llm_handler = llm_handler
+        self.slots = slots
+        self.max_queued = max_queued
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.executor = ThreadPoolExecutor(max_workers=slots + 4, thread_name_prefix="query")
+        self.waiting = 0
+        # cancellation flags of the generations in progress, by request id
+        self.running: dict[str, threading.Event] = {}
+
+    def get_context(self, query: str) -> str:
+        """Retrieve the context of a question, fitting in a slot of the llamafile server with the prompt."""
+        return self.rag_service.get_context(
+            query,
+            self.llm_handler.count_tokens,
+            self.llm_handler.truncate_tokens,
+            self.llm_handler.get_context_budget(query),
+        )
+
+    def get_prompt(self, query: str) -> str:
+        """Retrieve the context of a question and build the prompt."""
+        return self.llm_handler.prepare_prompt(query, self.get_context(query))
+
+    def generate(self, query: str, cancelled: threading.Event, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+        """Answer a question in a worker thread, sending the tokens to the event loop until cancelled."""
+        try:
+            prompt = self.get_prompt(query)
+            stream = self.llm_handler.llm_stream(prompt)
+            try:
+                for token in stream:
+                    if cancelled.is_set():
+                        increment("service.cancelled")
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, token)
+            finally:
+                # closing the stream closes the connection to the server, which stops the generation
+                stream.close()
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, END_OF_STREAM)
+
+    async def stream_answer(self, query: str, request_id: str):
+        """Answer a question once a slot is free.
+
+        Args:
+            query (str): the question.
+            request_id (str): id of the request, to cancel it.
+
+        Yields:
+            str: the tokens of the answer.
+
+        Raises:
+            web.HTTPServiceUnavailable: if too many questions are already waiting.
+        """
+        if self.waiting >= self.max_queued:
+            increment("service.rejected")
+            raise web.HTTPServiceUnavailable(text="Too many questions are waiting, retry later.")
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        observe("service.queue_seconds", time.perf_counter() - start)
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        self.running[request_id] = cancelled
+        try:
+            future = loop.run_in_executor(self.executor, self.generate, query, cancelled, loop, queue)
+        except BaseException:
+            self.semaphore.release()
+            raise
+        # the slot is only free once the generation has stopped, even if the client is gone
+        future.add_done_callback(lambda _: self.semaphore.release())
+        try:
+            while True:
+                item = await queue.get()
+                if item is END_OF_STREAM or cancelled.is_set():
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            cancelled.set()
+            self.running.pop(request_id, None)
+
+    async def handle_query(self, request: web.Request) -> web.StreamResponse:
+        """Answer a question (`{"query": ..., "stream": true}`), as a stream of text or as JSON."""
+        body = await request.json()
+        query = (body.get("query") or "").strip()
+        if not query:
+            raise web.HTTPBadRequest(text="The query is empty.")
+        request_id = body.get("request_id") or uuid.uuid4().hex
+        increment("service.requests")
+        start = time.perf_counter()
+        answer = self.stream_answer(query, request_id)
+        if not body.get("stream", True):
+            tokens = [token async for token in answer]
+            return web.json_response(
+                {"request_id": request_id, "answer": "".join(tokens), "seconds": time.perf_counter() - start}
+            )
+        response = web.StreamResponse(headers={"Content-Type": "text/plain; charset=utf-8", "X-Request-Id": request_id})
+        try:
+            async for token in answer:
+                if not response.prepared:
+                    await response.prepare(request)
+                await response.write(token.encode("utf-8"))
+        except ConnectionResetError:
+            # the client is gone, closing the answer stops its generation
+            return response
+        finally:
+            await answer.aclose()
+        if not response.prepared:
+            await response.prepare(request)
+        await response.write_eof()
+        return response
+
+    async def handle_cancel(self, request: web.Request) -> web.Response:
+        """Stop the generation of an answer."""
+        cancelled = self.running.get(request.match_info["request_id"])
+        if cancelled is None:
+            raise web.HTTPNotFound(text="No answer in progress with this id.")
+        cancelled.set()
+        return web.json_response({"cancelled": True})
+
+    async def handle_context(self, request: web.Request) -> web.Response:
+        """Get the emails retrieved for a question (`{"query": ...}`), without generating an answer."""
+        body = await request.json()
+        loop = asyncio.get_running_loop()
+        context = await loop.run_in_executor(self.executor, self.get_context, body.get("query", ""))
+        return web.json_response({"context": context})
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """Check that the service is up."""
+        return web.json_response({"status": "ok", "running": len(self.running), "waiting": self.waiting})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        """Get the cache statistics and the metrics of the service."""
+        stats = {**self.rag_service.get_cache_stats(), "answer": self.llm_handler.answer_cache.get_stats()}
+        if METRICS.enabled:
+            stats["metrics"] = get_snapshot()
+        return web.json_response(stats)
+
+    async def on_startup(self, app: web.Application):
+        """Create the objects bound to the event loop of the service."""
+        self.semaphore = asyncio.Semaphore(self.slots)
+
+    async def on_cleanup(self, app: web.Application):
+        """Stop the encoding processes of the embedding engine when the service stops."""
+        self.rag_service.close()
+
+    def create_app(self) -> web.Application:
+        """Create the web application of the service."""
+        app = web.Application()
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        app.router.add_post("/query", self.handle_query)
+        app.router.add_post("/cancel/{request_id}", self.handle_cancel)
+        app.router.add_post("/context", self.handle_context)
+        app.router.add_get("/health", self.handle_health)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+
+def synchronise(rag_service: RAGHandler, email_handler: EmailHandler) -> bool:
+    """Apply the changes of the mailbox to the loaded index, which is kept as saved if they cannot be fetched.
+
+    Returns:
+        bool: whether the index has been synchronised.
+    """
+    try:
+        added_documents, deleted_message_ids = email_handler.update()
+        rag_service.update_vectorestore(added_documents, deleted_message_ids)
+    except Exception as e:
+        print(f"Could not synchronise the mailbox, serving the saved index: {e}")
+        rag_service.load_vectorestore()
+        return False
+    email_handler.commit_sync()
+    return True
+
+
+def build_service(config: dict) -> QueryService:
+    """Load the index (synchronising it with the mailbox) and start the LLM, once for all the clients.
+
+    With several `accounts`, the index is split into shards per account and per period (see `ShardedIndex`).
+    An index already built is served even if it cannot be synchronised (no network, expired credentials...),
+    or without synchronising it when `service.sync` is false.
+    """
+    configure(**config.get("metrics", {}))
+    sync = config.get("service", {}).get("sync", True)
+    if config.get("accounts"):
+        rag_service: RAGHandler = build_sharded_index(config, sync)
+    else:
+        rag_service = RAGHandler(**config["rag"])
+        email_handler = EmailHandler(**config["email"])
+        if not rag_service.has_index():
+            rag_service.initialise_set_up(email_handler.initialise_set_up())
+            email_handler.commit_sync()
+        else:
+            rag_service.set_embeddings()
+            rag_service.load_vectorestore()
+            if sync:
+                synchronise(rag_service, email_handler)
+    llm_handler = LLMHandler(**config["llm"]["model"])
+    server_config = config["llm"].get("server", {})
+    llm_handler.start_llamafile(**server_config)
+    llm_handler.set_llm(**config["llm"]["model_config"])
+    llm_handler.set_answer_cache(**config["llm"].get("answer_cache", {}))
+    service_config = config.get("service", {})
+    return QueryService(
+        rag_service,
+        llm_handler,
+        slots=server_config.get("parallel", 1),
+        max_queued=service_config.get("max_queued", 32),
+    )
+
+
+def start_in_thread(service: QueryService, host: str = "127.0.0.1", port: int = 8765) -> threading.Thread:
+    """Serve in a background thread, e.g. next to the Streamlit app in the same process."""
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(service.create_app())
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, host, port).start())
+    thread = threading.Thread(target=loop.run_forever, name="query-service", daemon=True)
+    thread.start()
+    print(f"Query service listening on http://{host}:{port}")
+    return thread
+
+
+def main(args: Optional[list] = None):
+    """Run the query service."""
+    config = get_config()
+    service_config = config.get("service", {})
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--host", default=service_config.get("host", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=service_config.get("port", 8765))
+    parser.add_argument("--no-sync", action="store_true", help="serve the saved index without synchronising it")
+    args = parser.parse_args(args)
+    if args.no_sync:
+        config["service"] = {**service_config, "sync": False}
+    service = build_service(config)
+    web.run_app(service.create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
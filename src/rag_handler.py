@@ -1,15 +1,67 @@
 """Classes to handle RAG related actions."""
+import atexit
+import json
 import os
+import pickle
 import shutil
+import uuid
+from collections import defaultdict
+from itertools import chain, islice
+from typing import Callable, Optional
 
+import numpy as np
 import torch
 from langchain_community.document_loaders import DirectoryLoader, TextLoader
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from src.context_packer import pack_context
+from src.dedup import Deduplicator, strip_quoted
+from src.docstore import RowMapping, SQLiteDocstore
+from src.embedding_cache import CachedEmbeddings, EmbeddingCache
+from src.embedding_engine import EmbeddingEngine, get_embeddings_variant
+from src.index_factory import (
+    TrainingBuffer,
+    build_index,
+    get_search_parameters,
+    get_train_size,
+    has_explicit_ids,
+    read_index,
+    set_search_parameters,
+    supports_removal,
+    write_index,
+)
+from src.lexical_index import LexicalIndex, parse_query
+from src.metrics import increment, span, timed
+from src.query_cache import LRUCache, normalize_query
+
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+INDEX_DIR = os.path.join(DATA_DIR, "faiss_index")
+INDEX_FILE = "index.faiss"
+# folder of the index keeping the changes saved since the last full save
+JOURNAL_DIR = "journal"
+# save whose index or journal entry is written but not published yet, with the id committed with the docstore
+PENDING_SAVE_FILE = "pending_save.json"
+PENDING_SUFFIX = ".pending"
+DOCSTORE_FILE = "docstore.sqlite"
+DEDUP_FILE = "dedup.sqlite"
+# number of emails a chunk was duplicated in which are cited in the context
+MAX_CITED_DUPLICATES = 5
+# docstore pickled with the mapping of the rows by the previous versions, converted when loaded
+PICKLED_DOCSTORE_FILE = "index.pkl"
+# files of the data folder that are not downloaded emails
+DATA_DIR_KEEP = [
+    ".gitkeep",
+    ".DS_Store",
+    "faiss_index",
+    "sync_state.json",
+    "embedding_cache",
+    "metrics.jsonl",
+    "attachments",
+    "shards",
+]
+MESSAGE_ID_FILE = ".message_id"
 os.environ["CURL_CA_BUNDLE"] = ""
 CONFIG = {}
 
@@ -33,8 +85,45 @@ class RAGHandler:
         chunk_size: int = 1000,
         chunk_overlap: int = 20,
         threshold: float = 0.8,
+        max_journal_entries: int = 20,
+        embedding_batch_size: int = 256,
+        embedding_cache: Optional[dict] = None,
+        embedding_engine: Optional[dict] = None,
+        index: Optional[dict] = None,
+        hybrid: bool = True,
+        rrf_k: int = 60,
+        query_cache: Optional[dict] = None,
+        context_tokens: int = 2500,
+        dedup: Optional[dict] = None,
+        index_dir: str = INDEX_DIR,
     ):
-        """Initialise the class."""
+        """Initialise the class.
+
+        Args:
+            model (str): name of the embedding model.
+            nb_docs_returned (int): number of documents returned by a query.
+            fetch_k_docs (int): number of documents fetched before filtering.
+            chunk_size (int): size of the chunks the emails are split into.
+            chunk_overlap (int): overlap between two consecutive chunks.
+            threshold (float): maximum distance for a document to be returned.
+            max_journal_entries (int): number of incremental saves kept before the index is saved in full again.
+            embedding_batch_size (int): number of chunks embedded and inserted in the index at once.
+            embedding_cache (dict): parameters of the on-disk embedding cache (see `EmbeddingCache`),
+                no cache is used when not given.
+            embedding_engine (dict): parameters of the embedding engine (see `EmbeddingEngine`): batch size,
+                processes, threads and backend.
+            index (dict): type of FAISS index and its parameters (see `index_factory.build_index`), and `mmap`
+                to load it memory-mapped. An exact flat index is used when not given.
+            hybrid (bool): whether to combine the vector search with a lexical (BM25) search. The metadata
+                filters are applied in both cases.
+            rrf_k (int): constant of the reciprocal rank fusion of the vector and lexical results.
+            query_cache (dict): `max_size` and `ttl` of the caches of query embeddings and retrieved chunks.
+            context_tokens (int): maximum number of tokens of the context given to the LLM.
+            dedup (dict): `strip_quotes` to remove the quoted replies and signatures of the emails, and the
+                parameters of the detection of near-duplicate chunks (see `Deduplicator`). All the chunks are
+                embedded when not given.
+            index_dir (str): folder where the vector store is saved.
+        """
         self.documents = None
         self.model = model
         self.split_docs = None
@@ -45,6 +134,33 @@ class RAGHandler:
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
         self.threshold = threshold
+        self.max_journal_entries = max_journal_entries
+        self.embedding_batch_size = embedding_batch_size
+        self.embedding_cache = embedding_cache
+        self.embedding_engine = embedding_engine or {}
+        self.engine = None
+        self.index_config = index or {"type": "flat"}
+        # embedded chunks waiting for the index to be trained on a sample of them
+        self.untrained = TrainingBuffer(get_train_size(self.index_config))
+        self.hybrid = hybrid
+        self.rrf_k = rrf_k
+        self.lexical_index: Optional[LexicalIndex] = None
+        self.docstore: Optional[SQLiteDocstore] = None
+        # number of vectors of the index which no longer have a chunk (HNSW indexes do not support removal)
+        self.nb_removed: Optional[int] = None
+        # incremented at each change of the vector store, so that cached results are not used anymore
+        self.index_version = 0
+        self.query_embedding_cache = LRUCache(**(query_cache or {}))
+        self.retrieval_cache = LRUCache(**(query_cache or {}))
+        self.context_tokens = context_tokens
+        self.dedup = dict(dedup) if dedup is not None else None
+        self.strip_quotes = self.dedup.pop("strip_quotes", True) if self.dedup is not None else False
+        self.deduplicator: Optional[Deduplicator] = None
+        self.index_dir = index_dir
+        # changes of the index not saved yet, in order: rows deleted, and rows added with their vectors
+        self.journal: list[dict] = []
+        self.journal_vectors: list[np.ndarray] = []
+        self.full_save_needed = True
 
     def set_nb_docs_returned(self, nb_docs_returned):
         """Set nb_docs_returned."""
@@ -68,30 +184,106 @@ class RAGHandler:
         loader = DirectoryLoader("data", show_progress=True, loader_cls=TextLoader, silent_errors=True)
         print("Email loading successful.")
         self.documents = loader.load()
+        # tag each document with the id of the Gmail message it comes from
+        message_ids: dict = {}
+        for doc in self.documents:
+            folder = os.path.dirname(doc.metadata.get("source", ""))
+            if folder not in message_ids:
+                message_id_path = os.path.join(folder, MESSAGE_ID_FILE)
+                message_ids[folder] = None
+                if os.path.exists(message_id_path):
+                    with open(message_id_path) as f:
+                        message_ids[folder] = f.read().strip()
+            if message_ids[folder]:
+                doc.metadata["message_id"] = message_ids[folder]
 
+    @timed("rag.split_documents")
     def split_documents(self):
         """Split the documents."""
         print("Start emails splitting for vector store ingestion.")
         text_splitter = RecursiveCharacterTextSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
         print("Emails splitting successful.")
-        self.split_docs = text_splitter.split_documents(self.documents)
+        self.split_docs = text_splitter.split_documents([self.remove_quotes(doc) for doc in self.documents])
+
+    def iter_chunks(self, documents):
+        """Split a stream of documents into a stream of chunks.
+
+        Args:
+            documents (iterable): documents to split.
+
+        Yields:
+            Document: chunks, numbered within their document.
+        """
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
+        for document in documents:
+            with span("rag.split"):
+                chunks = text_splitter.split_documents([self.remove_quotes(document)])
+            for number, chunk in enumerate(chunks):
+                chunk.metadata["chunk"] = number
+                yield chunk
+
+    def remove_quotes(self, document: Document) -> Document:
+        """Strip the quoted previous emails and the signature of a document, if enabled.
+
+        A document which is only a quote is kept whole, its chunks being then dropped as duplicates.
+        """
+        if not self.strip_quotes:
+            return document
+        text = strip_quoted(document.page_content)
+        if not text:
+            return document
+        return Document(page_content=text, metadata=document.metadata)
+
+    def get_chunk_ids(self, chunks: list[Document]) -> list[str]:
+        """Get the docstore ids of chunks, derived from the id of their Gmail message."""
+        ids = []
+        counters: dict = defaultdict(int)
+        for chunk in chunks:
+            message_id = chunk.metadata.get("message_id")
+            if message_id:
+                number = chunk.metadata.get("chunk", counters[message_id])
+                ids.append(f"{message_id}:{number}")
+                counters[message_id] += 1
+            else:
+                ids.append(str(uuid.uuid4()))
+        return ids
 
     def set_embeddings(self):
         """Set the embedding with appropriate model."""
-        embeddings = HuggingFaceEmbeddings(model_name=self.model, model_kwargs=CONFIG)
+        set_config()
+        if self.engine is None:
+            self.engine = EmbeddingEngine(self.model, device=CONFIG["device"], **self.embedding_engine)
+            # the encoding processes must not outlive the application
+            atexit.register(self.close)
+        embeddings = self.engine
+        if self.embedding_cache is not None:
+            variant = get_embeddings_variant(**self.embedding_engine)
+            embeddings = CachedEmbeddings(
+                embeddings, EmbeddingCache(self.model, variant=variant, **self.embedding_cache)
+            )
         self.embedding = embeddings
 
+    def close(self):
+        """Stop the encoding processes of the embedding engine, if any."""
+        if self.engine is not None:
+            self.engine.close()
+
     def set_vectorestore(self):
         """Set the vectore store."""
         print("Start setting up the vector store.")
-        set_config()
-        embeddings = HuggingFaceEmbeddings(model_name=self.model, model_kwargs=CONFIG)
-        self.vectorstore = FAISS.from_documents(self.split_docs, embeddings)
-        self.embedding = embeddings
+        self.set_embeddings()
+        self.reset_vectorestore()
+        for start in range(0, len(self.split_docs), self.embedding_batch_size):
+            self.add_chunks(self.split_docs[start : start + self.embedding_batch_size])
+        self.create_vectorestore()
         print("Vector store set up successfully.")
+        self.clean_data_dir()
+
+    def clean_data_dir(self):
+        """Remove the downloaded emails once they are in the vector store."""
         print("Cleaning...")
         for item in os.listdir("./data/"):
-            if item not in [".gitkeep", ".DS_Store"]:
+            if item not in DATA_DIR_KEEP:
                 try:
                     shutil.rmtree("./data/" + item)
                 except Exception as e:
@@ -99,41 +291,732 @@ class RAGHandler:
                     raise e
         print("Cleaning done.")
 
+    def set_lexical_index(self):
+        """Open the lexical index of the vector store, rebuilding it if it does not match the docstore."""
+        self.lexical_index = LexicalIndex(os.path.join(self.index_dir, "lexical.sqlite"))
+        if self.vectorstore is None:
+            return
+        nb_duplicates = self.deduplicator.get_nb_duplicates() if self.deduplicator is not None else 0
+        if len(self.lexical_index) != len(self.docstore) or self.lexical_index.get_nb_duplicates() != nb_duplicates:
+            print("Rebuilding the lexical index.")
+            self.lexical_index.clear()
+            for ids, documents in self.docstore.iter_documents():
+                self.lexical_index.add(ids, documents)
+            if self.deduplicator is not None:
+                for ids, original_ids, documents in self.deduplicator.iter_duplicates():
+                    self.lexical_index.add(ids, documents, original_ids)
+
+    def open_docstore(self):
+        """Open the docstore (and the fingerprints) of the vector store, discarding their changes not saved."""
+        if self.docstore is None:
+            self.docstore = SQLiteDocstore(os.path.join(self.index_dir, DOCSTORE_FILE))
+        else:
+            self.docstore.rollback()
+        if self.dedup is not None:
+            if self.deduplicator is None:
+                self.deduplicator = Deduplicator(os.path.join(self.index_dir, DEDUP_FILE), **self.dedup)
+            else:
+                self.deduplicator.rollback()
+
+    def index_changed(self):
+        """Invalidate what depends on the content of the vector store."""
+        self.index_version += 1
+        self.nb_removed = None
+        self.retrieval_cache.clear()
+
+    def get_cache_stats(self) -> dict:
+        """Get the hit rates of the query caches."""
+        return {
+            "index_version": self.index_version,
+            "query_embedding": self.query_embedding_cache.get_stats(),
+            "retrieval": self.retrieval_cache.get_stats(),
+        }
+
+    def reset_vectorestore(self):
+        """Drop the vector store, before building a new one."""
+        self.index_changed()
+        self.vectorstore = None
+        self.open_docstore()
+        self.docstore.clear()
+        if self.deduplicator is not None:
+            self.deduplicator.clear()
+        self.set_lexical_index()
+        self.lexical_index.clear()
+        self.reset_training_buffer()
+        self.journal = []
+        self.journal_vectors = []
+        self.full_save_needed = True
+
+    def reset_training_buffer(self):
+        """Drop the chunks waiting for the index to be trained."""
+        self.untrained.close()
+        self.untrained = TrainingBuffer(get_train_size(self.index_config))
+
+    def create_vectorestore(self):
+        """Create the vector store from the chunks embedded so far, training its index on a sample of them if needed."""
+        if self.vectorstore is not None or not len(self.untrained):
+            return
+        index = build_index(self.untrained.get_sample(), self.index_config)
+        self.vectorstore = FAISS(self.embedding, index, self.docstore, RowMapping(self.docstore))
+        for texts, vectors, metadatas, ids in self.untrained:
+            self.add_vectors(texts, vectors, metadatas, ids)
+        self.reset_training_buffer()
+
+    @timed("rag.add_vectors")
+    def add_vectors(self, texts: list[str], embeddings: list[list[float]], metadatas: list[dict], ids: list[str]):
+        """Add embedded chunks to the index and the docstore of the vector store."""
+        index = self.vectorstore.index
+        start = index.ntotal
+        if has_explicit_ids(index):
+            start = max(start, self.docstore.get_max_row() + 1)
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        self.add_to_index(vectors, start)
+        documents = [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)]
+        self.docstore.add_rows(list(range(start, start + len(ids))), ids, documents)
+        self.index_changed()
+        if self.lexical_index is not None:
+            self.lexical_index.add(ids, documents)
+        if not self.full_save_needed:
+            self.journal.append({"add": start, "count": len(ids)})
+            self.journal_vectors.append(vectors)
+
+    def remove_vectors(self, docstore_ids: list[str]):
+        """Remove chunks from the vector store.
+
+        Flat indexes shift the rows following the removed ones, IVF indexes keep the ids of the other rows.
+        Indexes that do not support removal (HNSW) keep the vectors, but their rows no longer map to a
+        document and are skipped at search time until the next rebuild.
+        """
+        index = self.vectorstore.index
+        rows = self.docstore.get_rows(docstore_ids)
+        self.remove_from_index(rows)
+        self.docstore.delete_rows(rows, shift=supports_removal(index) and not has_explicit_ids(index))
+        self.index_changed()
+        if self.lexical_index is not None:
+            self.lexical_index.delete(docstore_ids)
+        if not self.full_save_needed:
+            self.journal.append({"delete": rows})
+
+    def add_to_index(self, vectors: np.ndarray, start: int):
+        """Add vectors to the index, from the row `start` for the indexes keeping the ids of their vectors."""
+        index = self.vectorstore.index
+        if has_explicit_ids(index):
+            index.add_with_ids(vectors, np.arange(start, start + len(vectors), dtype=np.int64))
+        else:
+            index.add(vectors)
+
+    def remove_from_index(self, rows: list[int]):
+        """Remove the vectors of some rows from the index, if it supports removal."""
+        if rows and supports_removal(self.vectorstore.index):
+            self.vectorstore.index.remove_ids(np.asarray(rows, dtype=np.int64))
+
+    def delete_messages(self, message_ids):
+        """Remove from the vector store the chunks of the given Gmail messages.
+
+        Args:
+            message_ids (iterable): ids of the Gmail messages to remove.
+        """
+        message_ids = set(message_ids)
+        if not message_ids:
+            return
+        orphans = []
+        if self.deduplicator is not None:
+            orphans = self.deduplicator.remove_messages(list(message_ids))
+            if self.lexical_index is not None:
+                # the duplicates of the messages are only in the lexical index
+                self.lexical_index.delete_messages(list(message_ids))
+        nb_untrained = self.untrained.remove_messages(message_ids)
+        docstore_ids = []
+        if self.vectorstore is not None:
+            docstore_ids = self.docstore.get_message_chunks(list(message_ids))
+            if docstore_ids:
+                self.remove_vectors(docstore_ids)
+        nb_removed = len(docstore_ids) + nb_untrained
+        if nb_removed:
+            print(f"{nb_removed} chunks removed from the vector store.")
+        # the duplicates of the chunks removed are indexed in their place
+        self.add_chunks(orphans)
+
+    def add_chunks(self, chunks: list[Document]):
+        """Add chunks to the vector store, only embedding these chunks.
+
+        Args:
+            chunks (list[Document]): chunks to add, tagged with the id of their Gmail message.
+        """
+        ids = self.get_chunk_ids(chunks)
+        if self.deduplicator is not None:
+            originals = [self.deduplicator.add(id_, chunk) for chunk, id_ in zip(chunks, ids)]
+            duplicates = [position for position, original in enumerate(originals) if original is not None]
+            if duplicates and self.lexical_index is not None:
+                # the duplicates are not embedded, but their emails must still match the filters of the queries
+                self.lexical_index.add(
+                    [ids[position] for position in duplicates],
+                    [chunks[position] for position in duplicates],
+                    [originals[position] for position in duplicates],
+                )
+            increment("rag.chunks_deduplicated", len(duplicates))
+            chunks = [chunk for chunk, original in zip(chunks, originals) if original is None]
+            ids = [id_ for id_, original in zip(ids, originals) if original is None]
+        if not chunks:
+            return
+        texts = [chunk.page_content for chunk in chunks]
+        metadatas = [chunk.metadata for chunk in chunks]
+        with span("rag.embed"):
+            embeddings = self.embedding.embed_documents(texts)
+        increment("rag.chunks_embedded", len(texts))
+        if self.vectorstore is None:
+            # the indexes needing training are created at the end of the ingestion, trained on a sample of all of it
+            self.untrained.add(texts, embeddings, metadatas, ids)
+            self.full_save_needed = True
+            if not self.untrained.size:
+                self.create_vectorestore()
+        else:
+            self.add_vectors(texts, embeddings, metadatas, ids)
+
+    def replace_chunks(self, chunks: list[Document]):
+        """Replace the chunks of the Gmail messages the given chunks come from.
+
+        Args:
+            chunks (list[Document]): new chunks, tagged with the id of their Gmail message.
+        """
+        self.delete_messages({chunk.metadata["message_id"] for chunk in chunks if chunk.metadata.get("message_id")})
+        self.add_chunks(chunks)
+
+    def add_documents(self, documents) -> tuple[int, int]:
+        """Split, embed and add a stream of documents by batches, keeping memory bounded.
+
+        Documents of a Gmail message already in the vector store replace its previous chunks. The indexes
+        needing training are only created by `create_vectorestore`, once all the documents are added.
+
+        Args:
+            documents (iterable): documents to index, tagged with the id of their Gmail message.
+
+        Returns:
+            tuple[int, int]: the number of chunks and of emails added.
+        """
+        chunks = self.iter_chunks(documents)
+        ingested = set()
+        nb_chunks = 0
+        while True:
+            batch = list(islice(chunks, self.embedding_batch_size))
+            if not batch:
+                break
+            # a message split over several batches must only be replaced once
+            message_ids = {chunk.metadata.get("message_id") for chunk in batch} - ingested - {None}
+            self.delete_messages(message_ids)
+            ingested |= message_ids
+            self.add_chunks(batch)
+            nb_chunks += len(batch)
+        return nb_chunks, len(ingested)
+
+    def ingest(self, documents):
+        """Split, embed and index a stream of documents, then create the vector store if it is new.
+
+        Args:
+            documents (iterable): documents to index, tagged with the id of their Gmail message.
+        """
+        print("Start ingesting emails in the vector store.")
+        nb_chunks, nb_emails = self.add_documents(documents)
+        self.create_vectorestore()
+        print(f"{nb_chunks} chunks from {nb_emails} emails ingested in the vector store.")
+        if self.deduplicator is not None:
+            print(f"{self.deduplicator.get_nb_duplicates()} near-duplicate chunks are not embedded.")
+        if self.engine is not None:
+            stats = self.engine.get_stats()
+            print(f"Embedded {stats['chunks']} chunks at {stats['chunks_per_second']:.1f} chunks/s.")
+
+    def update_vectorestore(self, documents, deleted_message_ids):
+        """Update the loaded vector store with the changes of the mailbox, and only save these changes.
+
+        A memory-mapped index is read only: when there are changes, it is loaded in memory to apply them,
+        and memory-mapped again once they are saved.
+
+        Args:
+            documents (iterable): documents of the Gmail messages added since the last update.
+            deleted_message_ids (list): ids of the Gmail messages deleted since the last update.
+        """
+        documents = iter(documents)
+        first_document = next(documents, None)
+        if first_document is None and not deleted_message_ids:
+            return
+        if self.index_config.get("mmap"):
+            self.load_vectorestore(mmap=False)
+        self.delete_messages(deleted_message_ids)
+        if first_document is not None:
+            self.ingest(chain([first_document], documents))
+        self.save_vectorestore()
+        if self.index_config.get("mmap"):
+            self.load_vectorestore()
+
+    @timed("rag.save_vectorestore")
     def save_vectorestore(self):
-        """Save the vectore store."""
-        self.vectorstore.save_local(os.path.join(DATA_DIR, "faiss_index"))
+        """Save the vectore store.
 
-    def load_vectorestore(self):
-        """Load the vectorestore."""
-        vectorstore = FAISS.load_local(
-            os.path.join(DATA_DIR, "faiss_index"), self.embedding, allow_dangerous_deserialization=True
-        )
-        self.vectorstore = vectorstore
+        The chunks are committed to the docstore, and the changes of the index made since the last save are
+        appended to its journal. The whole index is only rewritten when it has been rebuilt or when the
+        journal is too long. Nothing is saved while no chunk has been indexed.
 
-    def query_vectorestore(self, query) -> list[tuple[Document, float]]:
-        """Query the vector store based on a query and retrieve the most relevant documents."""
-        result = self.vectorstore.similarity_search_with_score(  # type: ignore[attr-defined]
-            query, k=self.nb_docs_returned, fetch_k=self.fetch_k_docs
-        )
+        The index or the journal entry is written aside, then the docstore is committed with the id of the
+        save, and the files are only moved in place after: if the process stops in between, the save is
+        completed or discarded when loaded, depending on the id committed (see `recover_pending_save`).
+        """
+        if self.vectorstore is None:
+            print("No chunk indexed, the vector store is not saved.")
+            return
+        entries = self.get_journal_entries()
+        pending = None
+        if self.full_save_needed or len(entries) >= self.max_journal_entries:
+            pending = {"path": INDEX_FILE}
+            write_index(self.vectorstore.index, os.path.join(self.index_dir, INDEX_FILE + PENDING_SUFFIX))
+        elif self.journal:
+            pending = {"path": os.path.join(JOURNAL_DIR, f"{len(entries) + 1:06d}")}
+            entry_dir = os.path.join(self.index_dir, pending["path"] + PENDING_SUFFIX)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.makedirs(entry_dir)
+            if self.journal_vectors:
+                np.save(os.path.join(entry_dir, "vectors.npy"), np.concatenate(self.journal_vectors))
+            with open(os.path.join(entry_dir, "operations.json"), "w", encoding="utf-8") as f:
+                json.dump(self.journal, f)
+        if pending is not None:
+            pending["save_id"] = uuid.uuid4().hex
+            pending_path = os.path.join(self.index_dir, PENDING_SAVE_FILE)
+            with open(pending_path + PENDING_SUFFIX, "w", encoding="utf-8") as f:
+                json.dump(pending, f)
+            os.replace(pending_path + PENDING_SUFFIX, pending_path)
+            self.docstore.set_state("save_id", pending["save_id"])
+        self.docstore.commit()
+        if pending is not None:
+            self.publish_save(pending)
+            self.full_save_needed = False
+        if self.deduplicator is not None:
+            self.deduplicator.commit()
+        self.journal = []
+        self.journal_vectors = []
+
+    def get_journal_entries(self) -> list[str]:
+        """Get the names of the entries of the journal, in order."""
+        journal_dir = os.path.join(self.index_dir, JOURNAL_DIR)
+        entries = os.listdir(journal_dir) if os.path.isdir(journal_dir) else []
+        return sorted(entry for entry in entries if entry.isdigit())
+
+    def publish_save(self, pending: dict):
+        """Move in place the index or the journal entry of a save whose docstore is committed."""
+        path = os.path.join(self.index_dir, pending["path"])
+        if os.path.exists(path + PENDING_SUFFIX):
+            os.replace(path + PENDING_SUFFIX, path)
+        if pending["path"] == INDEX_FILE:
+            # the journal is included in the new index
+            shutil.rmtree(os.path.join(self.index_dir, JOURNAL_DIR), ignore_errors=True)
+        os.remove(os.path.join(self.index_dir, PENDING_SAVE_FILE))
+
+    def recover_pending_save(self):
+        """Complete the save interrupted after the commit of the docstore, or discard the one interrupted before."""
+        pending_path = os.path.join(self.index_dir, PENDING_SAVE_FILE)
+        if not os.path.exists(pending_path):
+            return
+        with open(pending_path, encoding="utf-8") as f:
+            pending = json.load(f)
+        self.open_docstore()
+        if self.docstore.get_state("save_id") == pending["save_id"]:
+            print("Completing the last save of the vector store, which was interrupted.")
+            self.publish_save(pending)
+            return
+        print("Discarding the last save of the vector store, which was interrupted.")
+        path = os.path.join(self.index_dir, pending["path"] + PENDING_SUFFIX)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        os.remove(pending_path)
+
+    def has_index(self) -> bool:
+        """Check if a vector store has been saved in the index folder."""
+        return os.path.exists(os.path.join(self.index_dir, INDEX_FILE))
+
+    @timed("rag.load_vectorestore")
+    def load_vectorestore(self, mmap: Optional[bool] = None):
+        """Load the vectorestore, and replay the changes saved in its journal.
+
+        The chunks are not read, they stay in the docstore until they are returned by a search.
+
+        Args:
+            mmap (bool): whether to memory-map the index instead of reading it in memory (read only),
+                defaults to the `mmap` parameter of the index configuration.
+        """
+        if mmap is None:
+            mmap = self.index_config.get("mmap", False)
+        if os.path.exists(os.path.join(self.index_dir, PICKLED_DOCSTORE_FILE)):
+            self.convert_pickled_vectorestore()
+        self.recover_pending_save()
+        journal_dir = os.path.join(self.index_dir, JOURNAL_DIR)
+        entries = self.get_journal_entries()
+        if mmap and entries:
+            # a memory-mapped index cannot be modified, apply the journal to the saved index first
+            self.load_vectorestore(mmap=False)
+            self.full_save_needed = True
+            self.save_vectorestore()
+            entries = []
+        index = read_index(os.path.join(self.index_dir, INDEX_FILE), mmap=mmap)
+        set_search_parameters(index, self.index_config)
+        self.open_docstore()
+        self.vectorstore = FAISS(self.embedding, index, self.docstore, RowMapping(self.docstore))
+        self.reset_training_buffer()
+        self.index_changed()
+        self.lexical_index = None
+        # the docstore is already up to date, only the index is replayed
+        for entry in entries:
+            entry_dir = os.path.join(journal_dir, entry)
+            vectors_path = os.path.join(entry_dir, "vectors.npy")
+            vectors = np.load(vectors_path) if os.path.exists(vectors_path) else None
+            with open(os.path.join(entry_dir, "operations.json"), encoding="utf-8") as f:
+                operations = json.load(f)
+            position = 0
+            for operation in operations:
+                if "delete" in operation:
+                    self.remove_from_index(operation["delete"])
+                else:
+                    self.add_to_index(vectors[position : position + operation["count"]], operation["add"])
+                    position += operation["count"]
+        self.set_lexical_index()
+        self.journal = []
+        self.journal_vectors = []
+        self.full_save_needed = False
+
+    def convert_pickled_vectorestore(self):
+        """Move the chunks of a vector store saved by a previous version (pickled docstore) to the docstore."""
+        print("Moving the chunks of the vector store to the SQLite docstore.")
+        index_path = os.path.join(self.index_dir, INDEX_FILE)
+        with open(os.path.join(self.index_dir, PICKLED_DOCSTORE_FILE), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        self.reset_vectorestore()
+        self.vectorstore = FAISS(self.embedding, read_index(index_path), self.docstore, RowMapping(self.docstore))
+        rows = list(index_to_docstore_id)
+        for start in range(0, len(rows), 1000):
+            batch = rows[start : start + 1000]
+            ids = [index_to_docstore_id[row] for row in batch]
+            self.docstore.add_rows(batch, ids, [docstore.search(docstore_id) for docstore_id in ids])
+        del docstore, index_to_docstore_id
+        # the journal entries saved the chunks added with the same format
+        journal_dir = os.path.join(self.index_dir, JOURNAL_DIR)
+        for entry in sorted(os.listdir(journal_dir)) if os.path.isdir(journal_dir) else []:
+            entry_dir = os.path.join(journal_dir, entry)
+            with open(os.path.join(entry_dir, "deleted.json"), encoding="utf-8") as f:
+                self.remove_vectors(json.load(f))
+            if os.path.exists(os.path.join(entry_dir, PICKLED_DOCSTORE_FILE)):
+                delta = FAISS.load_local(entry_dir, self.embedding, allow_dangerous_deserialization=True)
+                ids = [delta.index_to_docstore_id[row] for row in range(delta.index.ntotal)]
+                documents = [delta.docstore.search(docstore_id) for docstore_id in ids]
+                self.add_vectors(
+                    [doc.page_content for doc in documents],
+                    delta.index.reconstruct_n(0, delta.index.ntotal),
+                    [doc.metadata for doc in documents],
+                    ids,
+                )
+        self.save_vectorestore()
+        os.remove(os.path.join(self.index_dir, PICKLED_DOCSTORE_FILE))
+
+    def get_sample_vectors(self, size: int) -> np.ndarray:
+        """Get the embeddings of a random sample of the chunks of the vector store."""
+        texts = self.docstore.sample_texts(size)
+        return np.asarray(self.embedding.embed_documents(texts), dtype=np.float32)
+
+    def dense_search(
+        self, query, k: int, candidates: Optional[set[str]] = None, vector: Optional[list[float]] = None
+    ) -> list[tuple[str, float]]:
+        """Get the k chunks nearest to a query.
+
+        Args:
+            query (str): the query.
+            k (int): number of chunks returned.
+            candidates (set[str]): docstore ids of the chunks the search is restricted to (all when not given).
+            vector (list[float]): embedding of the query, when already computed.
+
+        Returns:
+            list[tuple[str, float]]: the docstore ids of the chunks and their distance to the query.
+        """
+        vector = np.asarray([self.embed_query(query) if vector is None else vector], dtype=np.float32)
+        params = None
+        if candidates is not None:
+            rows = np.asarray(self.docstore.get_rows(list(candidates)), dtype=np.int64)
+            params = get_search_parameters(self.vectorstore.index, self.index_config, rows)
+            k = min(k, len(rows))
+        return self.search_vectors(vector, k, params)[0]
+
+    def dense_search_batch(self, queries: list[str], k: int) -> list[list[tuple[str, float]]]:
+        """Get the k chunks nearest to each query of a batch, in a single search of the index.
+
+        Args:
+            queries (list[str]): the queries.
+            k (int): number of chunks returned per query.
+
+        Returns:
+            list[list[tuple[str, float]]]: for each query, the docstore ids of the chunks and their distance.
+        """
+        vectors = np.asarray(self.embed_queries(queries), dtype=np.float32)
+        return self.search_vectors(vectors, k)
+
+    def search_vectors(self, vectors: np.ndarray, k: int, params=None) -> list[list[tuple[str, float]]]:
+        """Search the index for the k chunks nearest to each vector (one per row)."""
+        if self.nb_removed is None:
+            self.nb_removed = self.vectorstore.index.ntotal - len(self.docstore)
+        # rows removed from an index not supporting removal are still returned by the search
+        nb_searched = k + min(self.nb_removed, self.fetch_k_docs)
+        scores, rows = self.vectorstore.index.search(vectors, nb_searched, params=params)
+        # only the ids of the rows found are read from the docstore
+        row_ids = self.docstore.get_ids(sorted({int(row) for row in rows.flat if row >= 0}))
+        results = []
+        for query_scores, query_rows in zip(scores, rows):
+            result = [
+                (row_ids[int(row)], float(score)) for score, row in zip(query_scores, query_rows) if int(row) in row_ids
+            ]
+            results.append(result[:k])
+        return results
+
+    def embed_query(self, query: str) -> list[float]:
+        """Embed a query, reusing the embedding of the same query if it has been cached."""
+        key = normalize_query(query)
+        embedding = self.query_embedding_cache.get(key)
+        if embedding is None:
+            with span("rag.embed_query"):
+                embedding = self.embedding.embed_query(query)
+            self.query_embedding_cache.put(key, embedding)
+        return embedding
+
+    def embed_queries(self, queries: list[str]) -> list[list[float]]:
+        """Embed a batch of queries in a single call to the model, reusing the embeddings cached."""
+        keys = [normalize_query(query) for query in queries]
+        embeddings = [self.query_embedding_cache.get(key) for key in keys]
+        missing = {key: query for key, query, embedding in zip(keys, queries, embeddings) if embedding is None}
+        if not missing:
+            return embeddings
+        with span("rag.embed_queries"):
+            if hasattr(self.embedding, "embed_queries"):
+                computed = dict(zip(missing, self.embedding.embed_queries(list(missing.values()))))
+            else:
+                computed = {key: self.embedding.embed_query(query) for key, query in missing.items()}
+        for key, embedding in computed.items():
+            self.query_embedding_cache.put(key, embedding)
+        return [computed[key] if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+
+    def get_document(self, docstore_id: str) -> Document:
+        """Read a chunk from the docstore, with the emails it was found in as duplicate (`duplicates`)."""
+        doc = self.vectorstore.docstore.search(docstore_id)
+        if self.deduplicator is not None and isinstance(doc, Document):
+            duplicates = self.deduplicator.get_duplicates(docstore_id)
+            if duplicates:
+                doc.metadata["duplicates"] = duplicates
+        return doc
+
+    def similarity_search_with_score(self, query, k: int) -> list[tuple[Document, float]]:
+        """Get the k chunks nearest to a query, with their distance."""
+        return [(self.get_document(docstore_id), score) for docstore_id, score in self.dense_search(query, k)]
+
+    @timed("rag.query")
+    def query_vectorestore(
+        self, query, filters: Optional[dict] = None, dense: Optional[list[tuple[str, float]]] = None
+    ) -> list[tuple[Document, float]]:
+        """Query the vector store based on a query and retrieve the most relevant documents.
+
+        Filters written in the query as Gmail operators (`from:`, `to:`, `after:`, `before:`, `label:`)
+        restrict the chunks searched. In hybrid mode, the chunks nearest to the query and the ones
+        best matching its terms (BM25) are merged with a reciprocal rank fusion.
+
+        Args:
+            query (str): the query.
+            filters (dict): filters added to the ones of the query (see `LexicalIndex.filter`).
+            dense (list[tuple[str, float]]): chunks nearest to the query, when already searched with the
+                other queries of a batch (see `query_vectorestore_batch`).
+
+        Returns:
+            list[tuple[Document, float]]: the documents, with their relevance score (see `rank`), the higher
+                the more relevant in both modes.
+        """
+        cache_key = (normalize_query(query), tuple(sorted((filters or {}).items())), self.index_version)
+        cached = self.retrieval_cache.get(cache_key)
+        if cached is not None:
+            increment("rag.retrieval_cache_hits")
+            return [(self.get_document(docstore_id), score) for docstore_id, score in cached]
+        query, query_filters = parse_query(query)
+        filters = {**query_filters, **(filters or {})}
+        dense, lexical = self.search(query, filters, dense)
+        ranked = self.rank(dense, lexical)
         print("Documents found: ")
         filtered_res: list[tuple[Document, float]] = []
-        for doc, score in result:
-            if score < self.threshold:
-                filtered_res.append((doc, score))
-                print(doc.page_content)
-                print(score)
-                print()
+        for docstore_id, score in ranked[: self.nb_docs_returned]:
+            doc = self.get_document(docstore_id)
+            filtered_res.append((doc, score))
+            print(doc.page_content)
+            print(score)
+            print()
+        self.retrieval_cache.put(cache_key, ranked[: self.nb_docs_returned])
         return filtered_res
 
-    def get_context(self, query) -> str:
-        """Get context for a query."""
-        context_docs = self.query_vectorestore(query)
-        context_text = "\n------\n".join([doc.page_content for doc, _ in context_docs])
+    def search(
+        self,
+        query: str,
+        filters: dict,
+        dense: Optional[list[tuple[str, float]]] = None,
+        vector: Optional[list[float]] = None,
+    ) -> tuple[list[tuple[str, float]], Optional[list[tuple[str, float]]]]:
+        """Search the chunks nearest to a query and, in hybrid mode, the ones best matching its terms.
+
+        Args:
+            query (str): the query, without its filters.
+            filters (dict): filters on the metadata of the chunks (see `LexicalIndex.filter`).
+            dense (list[tuple[str, float]]): chunks nearest to the query, when already searched.
+            vector (list[float]): embedding of the query, when already computed.
+
+        Returns:
+            tuple: the chunks nearer than the threshold with their distance, and the chunks matching the
+                terms of the query with their BM25 score (None when not in hybrid mode).
+        """
+        candidates = None
+        lexical = [] if self.hybrid and self.lexical_index is not None else None
+        if filters and self.lexical_index is not None:
+            candidates = self.lexical_index.filter(filters)
+            if not candidates:
+                return [], lexical
+        if dense is None or candidates is not None:
+            with span("rag.dense_search"):
+                dense = self.dense_search(query, self.get_nb_dense(), candidates, vector)
+        dense = [(docstore_id, score) for docstore_id, score in dense if score < self.threshold]
+        if lexical is not None:
+            with span("rag.lexical_search"):
+                lexical = self.lexical_index.search(query, self.fetch_k_docs, filters)
+        return dense, lexical
+
+    def rank(
+        self, dense: list[tuple[str, float]], lexical: Optional[list[tuple[str, float]]]
+    ) -> list[tuple[str, float]]:
+        """Rank the chunks found for a query with their reciprocal rank fusion score.
+
+        In hybrid mode, the vector and lexical results are merged. Otherwise the chunks keep the order of
+        their distance, with a score of the same scale, the higher the more relevant.
+        """
+        fused: dict = defaultdict(float)
+        for results in (dense, lexical or []):
+            for rank, (docstore_id, _) in enumerate(results):
+                fused[docstore_id] += 1 / (self.rrf_k + rank + 1)
+        return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+    def get_nb_dense(self) -> int:
+        """Get the number of chunks searched in the vector store for a query."""
+        return self.fetch_k_docs if self.hybrid else self.nb_docs_returned
+
+    def query_vectorestore_batch(self, queries: list[str]) -> list[list[tuple[Document, float]]]:
+        """Query the vector store for a batch of queries.
+
+        The queries are embedded in a single call to the model and the ones without filters are searched in
+        a single call to the index, then each query is ranked like in `query_vectorestore`.
+
+        Args:
+            queries (list[str]): the queries.
+
+        Returns:
+            list[list[tuple[Document, float]]]: the documents of each query, with their relevance score.
+        """
+        texts = [parse_query(query) for query in queries]
+        unfiltered = [position for position, (_, filters) in enumerate(texts) if not filters]
+        self.embed_queries([text for text, _ in texts])
+        dense: dict[int, list[tuple[str, float]]] = {}
+        if unfiltered:
+            with span("rag.dense_search_batch"):
+                results = self.dense_search_batch([texts[position][0] for position in unfiltered], self.get_nb_dense())
+            dense = dict(zip(unfiltered, results))
+        return [self.query_vectorestore(query, dense=dense.get(position)) for position, query in enumerate(queries)]
+
+    def format_document(self, doc: Document) -> str:
+        """Format a retrieved document with the headers of its email."""
+        headers = "".join(
+            f"{name.capitalize()}: {doc.metadata[name]} \n"
+            for name in ("from", "to", "date", "subject")
+            if doc.metadata.get(name)
+        )
+        if doc.metadata.get("attachments"):
+            filenames = ", ".join(attachment["filename"] for attachment in doc.metadata["attachments"])
+            headers += f"Attachments: {filenames} \n"
+        duplicates = doc.metadata.get("duplicates") or []
+        if duplicates:
+            emails = "; ".join(
+                " ".join(str(duplicate[name]) for name in ("date", "from") if duplicate.get(name))
+                or duplicate.get("message_id", "")
+                for duplicate in duplicates[:MAX_CITED_DUPLICATES]
+            )
+            if len(duplicates) > MAX_CITED_DUPLICATES:
+                emails += f" and {len(duplicates) - MAX_CITED_DUPLICATES} other emails"
+            headers += f"Also in: {emails} \n"
+        return headers + doc.page_content
+
+    def get_context(
+        self,
+        query,
+        count_tokens: Optional[Callable[[str], int]] = None,
+        truncate_tokens: Optional[Callable[[str, int], str]] = None,
+        max_tokens: Optional[int] = None,
+    ) -> str:
+        """Get context for a query.
+
+        Args:
+            query (str): the query.
+            count_tokens (Callable): function counting the tokens of a text with the tokenizer of the LLM,
+                used to fit the context in `context_tokens` (estimated when not given).
+            truncate_tokens (Callable): function cutting a text to a number of tokens of the LLM (estimated when
+                not given).
+            max_tokens (int): number of tokens left for the context in the prompt, when lower than `context_tokens`
+                (see `LLMHandler.get_context_budget`).
+
+        Returns:
+            str: the retrieved chunks, deduplicated and packed within the token budget.
+        """
+        return self.pack_documents(self.query_vectorestore(query), count_tokens, truncate_tokens, max_tokens)
+
+    def get_contexts(
+        self,
+        queries: list[str],
+        count_tokens: Optional[Callable[[str], int]] = None,
+        truncate_tokens: Optional[Callable[[str, int], str]] = None,
+        max_tokens: Optional[list[Optional[int]]] = None,
+    ) -> list[str]:
+        """Get the context of a batch of queries, retrieved together (see `query_vectorestore_batch`)."""
+        max_tokens = max_tokens or [None] * len(queries)
+        return [
+            self.pack_documents(docs, count_tokens, truncate_tokens, query_max_tokens)
+            for docs, query_max_tokens in zip(self.query_vectorestore_batch(queries), max_tokens)
+        ]
+
+    def pack_documents(
+        self,
+        context_docs: list[tuple[Document, float]],
+        count_tokens: Optional[Callable[[str], int]] = None,
+        truncate_tokens: Optional[Callable[[str, int], str]] = None,
+        max_tokens: Optional[int] = None,
+    ) -> str:
+        """Deduplicate and pack retrieved documents within the token budget of the context."""
+        token_budget = self.context_tokens if max_tokens is None else min(self.context_tokens, max_tokens)
+        with span("rag.pack_context"):
+            context_text = pack_context(
+                context_docs,
+                token_budget,
+                self.format_document,
+                count_tokens=count_tokens,
+                max_overlap=self.chunk_overlap,
+                truncate_tokens=truncate_tokens,
+            )
         return context_text
 
-    def initialise_set_up(self):
-        """Initialise the set up."""
-        self.load_documents()
-        self.split_documents()
-        self.set_vectorestore()
+    def initialise_set_up(self, documents=None):
+        """Initialise the set up.
+
+        Args:
+            documents (iterable): stream of documents to index. When not given, the emails saved in the
+                data folder are loaded instead.
+        """
+        if documents is None:
+            self.load_documents()
+            self.split_documents()
+            self.set_vectorestore()
+        else:
+            self.set_embeddings()
+            self.reset_vectorestore()
+            self.ingest(documents)
         self.save_vectorestore()
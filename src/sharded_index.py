@@ -0,0 +1,553 @@
+"""Index of several mailboxes, partitioned into shards per account and per period.
+
+Each shard is a vector store of its own (see `RAGHandler`), built, synchronised, saved and loaded
+independently: a shard can be rebuilt without touching the others, and only the shards used by the recent
+queries are kept in memory. A question is searched in all the shards in parallel (only the ones of the
+period of its `after:` and `before:` filters), and their results are merged by score.
+
+    python -m src.sharded_index --list
+    python -m src.sharded_index --rebuild personal 2023
+"""
+import argparse
+import contextlib
+import os
+import shutil
+import sqlite3
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+from src.email_handler import EmailHandler
+from src.metrics import increment, span
+from src.rag_handler import DATA_DIR, RAGHandler
+
+SHARDS_DIR = os.path.join(DATA_DIR, "shards")
+CATALOG_FILE = "catalog.sqlite"
+# period of the emails without a date
+UNDATED = "undated"
+# maximum number of parameters of a SQLite query
+BATCH_SIZE = 500
+
+
+def get_period(metadata: dict, period: str = "year") -> str:
+    """Get the period of the shard of an email, from its timestamp: `2024` by year, `2024-03` by month."""
+    if not metadata.get("timestamp"):
+        return UNDATED
+    date = datetime.fromtimestamp(float(metadata["timestamp"]), tz=timezone.utc)
+    return f"{date:%Y}" if period == "year" else f"{date:%Y-%m}"
+
+
+def get_period_range(name: str) -> Optional[tuple[float, float]]:
+    """Get the first and last (excluded) timestamps of a period, None for the undated emails."""
+    if name == UNDATED:
+        return None
+    year, _, month = name.partition("-")
+    if month:
+        start = datetime(int(year), int(month), 1, tzinfo=timezone.utc)
+        end = datetime(int(year) + int(month) // 12, int(month) % 12 + 1, 1, tzinfo=timezone.utc)
+    else:
+        start = datetime(int(year), 1, 1, tzinfo=timezone.utc)
+        end = datetime(int(year) + 1, 1, 1, tzinfo=timezone.utc)
+    return start.timestamp(), end.timestamp()
+
+
+def overlaps(name: str, filters: dict) -> bool:
+    """Check whether a period may contain emails matching the `after` and `before` filters of a query."""
+    period_range = get_period_range(name)
+    if period_range is None:
+        return True
+    start, end = period_range
+    if filters.get("after") is not None and end <= filters["after"]:
+        return False
+    return filters.get("before") is None or start < filters["before"]
+
+
+class ShardCatalog:
+    """SQLite catalog of the shards, and of the shard of each email to find the shards of the emails deleted."""
+
+    def __init__(self, path: str):
+        """Open the catalog, creating it if needed.
+
+        Args:
+            path (str): path of the SQLite database.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        has_shards = self.connection.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'shards'"
+        ).fetchone()[0]
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                message_id TEXT NOT NULL,
+                account TEXT NOT NULL,
+                period TEXT NOT NULL,
+                PRIMARY KEY (account, message_id)
+            );
+            CREATE INDEX IF NOT EXISTS messages_shard ON messages (account, period);
+            CREATE TABLE IF NOT EXISTS shards (
+                account TEXT NOT NULL,
+                period TEXT NOT NULL,
+                PRIMARY KEY (account, period)
+            );
+            """
+        )
+        if not has_shards:
+            # catalog created by a previous version, without the list of the shards
+            self.connection.execute("INSERT OR IGNORE INTO shards SELECT DISTINCT account, period FROM messages")
+        self.connection.commit()
+
+    def add(self, account: str, period: str, message_ids: list[str]):
+        """Record the shard of emails."""
+        with self.lock:
+            self.connection.execute("INSERT OR IGNORE INTO shards VALUES (?, ?)", (account, period))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?)",
+                ((message_id, account, period) for message_id in message_ids),
+            )
+
+    def locate(self, account: str, message_ids: list[str]) -> dict[str, list[str]]:
+        """Get the emails of an account indexed in each period, the unknown ones being skipped."""
+        periods: dict[str, list[str]] = {}
+        with self.lock:
+            for start in range(0, len(message_ids), BATCH_SIZE):
+                batch = message_ids[start : start + BATCH_SIZE]
+                for message_id, period in self.connection.execute(
+                    f"SELECT message_id, period FROM messages WHERE account = ? "
+                    f"AND message_id IN ({','.join('?' * len(batch))})",
+                    [account, *batch],
+                ):
+                    periods.setdefault(period, []).append(message_id)
+        return periods
+
+    def remove(self, account: str, message_ids: list[str]):
+        """Forget emails of an account, and the shards left empty."""
+        with self.lock:
+            self.connection.executemany(
+                "DELETE FROM messages WHERE account = ? AND message_id = ?",
+                ((account, message_id) for message_id in message_ids),
+            )
+            self.connection.execute(
+                "DELETE FROM shards WHERE account = ? AND NOT EXISTS "
+                "(SELECT 1 FROM messages WHERE messages.account = shards.account AND messages.period = shards.period)",
+                (account,),
+            )
+
+    def remove_shard(self, account: str, period: str):
+        """Forget the emails of a shard."""
+        with self.lock:
+            self.connection.execute("DELETE FROM messages WHERE account = ? AND period = ?", (account, period))
+            self.connection.execute("DELETE FROM shards WHERE account = ? AND period = ?", (account, period))
+
+    def list_shards(self) -> list[tuple[str, str]]:
+        """Get the account and the period of the shards having emails."""
+        with self.lock:
+            return [tuple(row) for row in self.connection.execute("SELECT account, period FROM shards")]
+
+    def get_shards(self) -> dict[tuple[str, str], int]:
+        """Get the number of emails of each shard, counting all the emails of the catalog."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT account, period, COUNT(*) FROM messages GROUP BY account, period ORDER BY account, period"
+            ).fetchall()
+        return {(account, period): count for account, period, count in rows}
+
+    def commit(self):
+        """Save the changes on disk."""
+        with self.lock:
+            self.connection.commit()
+
+    def rollback(self):
+        """Discard the changes made since the last commit."""
+        with self.lock:
+            self.connection.rollback()
+
+
+class ShardedIndex(RAGHandler):
+    """RAG over several mailboxes, its vector store being split into shards per account and per period.
+
+    The shards are vector stores sharing the embedding model of the index. The questions are embedded once
+    and searched in the shards in parallel, the nearest chunks and the chunks best matching the terms of
+    the question being merged by score before their fusion. The chunks are identified by their shard and
+    their id in its docstore.
+    """
+
+    def __init__(
+        self,
+        period: str = "year",
+        max_loaded_shards: int = 8,
+        max_workers: int = 4,
+        index_dir: str = SHARDS_DIR,
+        **rag_config,
+    ):
+        """Initialise the index.
+
+        Args:
+            period (str): period of the shards of an account, `year` or `month`.
+            max_loaded_shards (int): maximum number of shards in memory, the least recently searched ones
+                being evicted.
+            max_workers (int): number of shards searched at the same time.
+            index_dir (str): folder of the shards, in a folder per account and per period.
+            rag_config: parameters of the vector stores of the shards (see `RAGHandler`).
+        """
+        super().__init__(index_dir=index_dir, **rag_config)
+        self.period = period
+        self.max_loaded_shards = max_loaded_shards
+        self.rag_config = rag_config
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="shard")
+        self.catalog = ShardCatalog(os.path.join(index_dir, CATALOG_FILE))
+        self.shards: dict[tuple[str, str], RAGHandler] = {}
+        # shards in memory, from the least recently used one
+        self.loaded: OrderedDict = OrderedDict()
+        # shards modified since they were saved, and number of searches using each shard
+        self.dirty: set[tuple[str, str]] = set()
+        self.in_use: Counter = Counter()
+        self.shards_lock = threading.RLock()
+
+    def get_shard_dir(self, key: tuple[str, str]) -> str:
+        """Get the folder of a shard."""
+        return os.path.join(self.index_dir, *key)
+
+    def get_shard(self, key: tuple[str, str]) -> RAGHandler:
+        """Get a shard, loading it in memory if it has been saved.
+
+        Args:
+            key (tuple[str, str]): account and period of the shard.
+
+        Returns:
+            RAGHandler: the vector store of the shard, empty if the shard does not exist yet.
+        """
+        with self.shards_lock:
+            shard = self.shards.get(key)
+            if shard is None:
+                shard = RAGHandler(**self.rag_config, index_dir=self.get_shard_dir(key))
+                shard.engine = self.engine
+                shard.embedding = self.embedding
+                self.shards[key] = shard
+            if shard.vectorstore is None and shard.has_index():
+                with span("shards.load"):
+                    shard.load_vectorestore()
+                increment("shards.loaded")
+            self.loaded[key] = True
+            self.loaded.move_to_end(key)
+            self.evict(keep=key)
+            return shard
+
+    @contextlib.contextmanager
+    def use_shard(self, key: tuple[str, str]) -> Iterator[RAGHandler]:
+        """Get a shard, which is not evicted until it is released."""
+        with self.shards_lock:
+            shard = self.get_shard(key)
+            self.in_use[key] += 1
+        try:
+            yield shard
+        finally:
+            with self.shards_lock:
+                self.in_use[key] -= 1
+
+    def evict(self, keep: Optional[tuple[str, str]] = None):
+        """Unload the least recently used shards beyond `max_loaded_shards`, the modified ones being saved first.
+
+        Args:
+            keep (tuple[str, str]): shard not to evict, about to be used. The shards in use are not evicted either.
+        """
+        with self.shards_lock:
+            for key in list(self.loaded):
+                if len(self.loaded) <= self.max_loaded_shards:
+                    return
+                # the chunks of a shard waiting for its index to be trained are only kept in memory
+                if self.in_use[key] or key == keep or len(self.shards[key].untrained):
+                    continue
+                if key in self.dirty:
+                    self.save_shard(key)
+                shard = self.shards.pop(key)
+                del self.loaded[key]
+                if shard.docstore is not None:
+                    shard.docstore.close()
+                increment("shards.evicted")
+
+    def modify_shard(self, key: tuple[str, str]) -> RAGHandler:
+        """Get a shard to change its vector store, creating it if needed."""
+        shard = self.get_shard(key)
+        if key in self.dirty:
+            return shard
+        if shard.vectorstore is None:
+            shard.reset_vectorestore()
+        elif shard.index_config.get("mmap"):
+            # a memory-mapped index is read only
+            shard.load_vectorestore(mmap=False)
+        self.dirty.add(key)
+        return shard
+
+    def save_shard(self, key: tuple[str, str]):
+        """Save the changes of a shard."""
+        shard = self.shards[key]
+        if shard.vectorstore is not None:
+            shard.save_vectorestore()
+            if shard.index_config.get("mmap"):
+                shard.load_vectorestore()
+        self.dirty.discard(key)
+
+    def save_vectorestore(self):
+        """Save the shards modified, then the catalog of their emails."""
+        with self.shards_lock:
+            for key in list(self.dirty):
+                self.save_shard(key)
+            self.catalog.commit()
+
+    def load_vectorestore(self, mmap: Optional[bool] = None):
+        """Forget the changes not saved, the shards being loaded when they are first searched."""
+        with self.shards_lock:
+            self.catalog.rollback()
+            for shard in self.shards.values():
+                if shard.docstore is not None:
+                    shard.docstore.close()
+            self.shards.clear()
+            self.loaded.clear()
+            self.dirty.clear()
+            self.index_changed()
+
+    def list_shards(self) -> list[tuple[str, str]]:
+        """Get the account and the period of the shards, saved or not."""
+        return sorted(set(self.catalog.list_shards()) | set(self.shards))
+
+    def ingest_account(self, account: str, documents):
+        """Split, embed and index a stream of emails of an account in the shards of their period.
+
+        The index of a new shard is created once all the emails are added, trained on a sample of all of them.
+
+        Args:
+            account (str): name of the account.
+            documents (iterable): documents to index, tagged with the id of their Gmail message.
+        """
+        pending: dict[str, list[Document]] = {}
+        periods = set()
+        for document in documents:
+            document.metadata["account"] = account
+            period = get_period(document.metadata, self.period)
+            pending.setdefault(period, []).append(document)
+            periods.add(period)
+            # the emails are listed by date, so they are flushed by batches of the same shard
+            if len(pending[period]) >= self.embedding_batch_size:
+                self.add_to_shard((account, period), pending.pop(period))
+        for period, batch in pending.items():
+            self.add_to_shard((account, period), batch)
+        for period in sorted(periods):
+            self.create_shard_vectorestore((account, period))
+        self.index_changed()
+
+    def add_to_shard(self, key: tuple[str, str], documents: list[Document]):
+        """Index emails in a shard, replacing them if they were already indexed."""
+        with self.shards_lock:
+            shard = self.modify_shard(key)
+            self.in_use[key] += 1
+        try:
+            shard.add_documents(documents)
+            self.catalog.add(*key, [doc.metadata["message_id"] for doc in documents if doc.metadata.get("message_id")])
+        finally:
+            with self.shards_lock:
+                self.in_use[key] -= 1
+
+    def create_shard_vectorestore(self, key: tuple[str, str]):
+        """Create the vector store of a new shard from all the chunks added to it, which can then be evicted."""
+        with self.use_shard(key) as shard:
+            shard.create_vectorestore()
+        with self.shards_lock:
+            self.evict()
+
+    def delete_account_messages(self, account: str, message_ids):
+        """Remove emails of an account from the shards they are indexed in."""
+        for period, ids in self.catalog.locate(account, list(message_ids)).items():
+            with self.shards_lock:
+                shard = self.modify_shard((account, period))
+                shard.delete_messages(ids)
+            self.catalog.remove(account, ids)
+        self.index_changed()
+
+    def update_account(self, account: str, documents, deleted_message_ids):
+        """Apply the changes of the mailbox of an account to its shards, and save them.
+
+        Args:
+            account (str): name of the account.
+            documents (iterable): documents of the emails added since the last update.
+            deleted_message_ids (list): ids of the emails deleted since the last update.
+        """
+        self.delete_account_messages(account, deleted_message_ids)
+        self.ingest_account(account, documents)
+        self.save_vectorestore()
+
+    def rebuild_shard(self, account: str, period: str, email_handler: EmailHandler):
+        """Index again the emails of a shard, the other shards being untouched.
+
+        Args:
+            account (str): name of the account.
+            period (str): period of the shard.
+            email_handler (EmailHandler): handler of the mailbox of the account.
+        """
+        key = (account, period)
+        with self.shards_lock:
+            shard = self.shards.pop(key, None)
+            self.loaded.pop(key, None)
+            self.dirty.discard(key)
+            if shard is not None and shard.docstore is not None:
+                shard.docstore.close()
+        shutil.rmtree(self.get_shard_dir(key), ignore_errors=True)
+        self.catalog.remove_shard(account, period)
+        query = ""
+        period_range = get_period_range(period)
+        if period_range is not None:
+            # Gmail takes the dates as timestamps too
+            query = f"after:{period_range[0]:.0f} before:{period_range[1]:.0f}"
+        email_handler.set_service()
+        messages = email_handler.search_messages(query)
+        documents = (
+            document
+            for document in email_handler.iter_documents(messages)
+            if get_period(document.metadata, self.period) == period
+        )
+        self.ingest_account(account, documents)
+        self.save_vectorestore()
+
+    def select_shards(self, filters: dict) -> list[tuple[str, str]]:
+        """Get the shards which may contain emails matching the date filters of a query."""
+        return [key for key in self.list_shards() if overlaps(key[1], filters)]
+
+    def search_shard(self, key: tuple[str, str], query: str, filters: dict, dense: Optional[list], vector):
+        """Search a shard, the ids of its chunks being tagged with the shard."""
+        with self.use_shard(key) as shard:
+            if shard.vectorstore is None:
+                return [], None
+            with span("shards.search"):
+                shard_dense, shard_lexical = shard.search(query, filters, dense, vector)
+        shard_dense = [((key, docstore_id), score) for docstore_id, score in shard_dense]
+        if shard_lexical is not None:
+            shard_lexical = [((key, docstore_id), score) for docstore_id, score in shard_lexical]
+        return shard_dense, shard_lexical
+
+    def search(
+        self,
+        query: str,
+        filters: dict,
+        dense: Optional[list] = None,
+        vector: Optional[list[float]] = None,
+    ) -> tuple[list, Optional[list]]:
+        """Search the shards of the period of a query in parallel, and merge their results by score.
+
+        The distances to the query are comparable between the shards since they share the embedding model,
+        and so are the BM25 scores, up to the term frequencies of each shard.
+        """
+        keys = self.select_shards(filters)
+        if dense is None and vector is None:
+            vector = self.embed_query(query)
+        # the nearest chunks of all the shards are already searched when given
+        shard_dense = None if dense is None else []
+        results = list(self.executor.map(lambda key: self.search_shard(key, query, filters, shard_dense, vector), keys))
+        if dense is None:
+            dense = sorted((item for result, _ in results for item in result), key=lambda item: item[1])
+            dense = dense[: self.get_nb_dense()]
+        dense = [(docstore_id, score) for docstore_id, score in dense if score < self.threshold]
+        lexical = None
+        if self.hybrid:
+            lexical = sorted((item for _, result in results for item in result or []), key=lambda item: item[1])
+            lexical = lexical[: self.fetch_k_docs]
+        return dense, lexical
+
+    def dense_search_batch(self, queries: list[str], k: int) -> list[list]:
+        """Get the k chunks nearest to each query of a batch, in a single search of each shard."""
+        vectors = np.asarray(self.embed_queries(queries), dtype=np.float32)
+
+        def search_vectors(key):
+            with self.use_shard(key) as shard:
+                if shard.vectorstore is None:
+                    return [[] for _ in queries]
+                results = shard.search_vectors(vectors, k)
+            return [[((key, docstore_id), score) for docstore_id, score in result] for result in results]
+
+        merged: list[list] = [[] for _ in queries]
+        for results in self.executor.map(search_vectors, self.list_shards()):
+            for position, result in enumerate(results):
+                merged[position].extend(result)
+        return [sorted(result, key=lambda item: item[1])[:k] for result in merged]
+
+    def get_document(self, docstore_id) -> Document:
+        """Read a chunk from the docstore of its shard (`docstore_id` being the shard and the id in it)."""
+        key, shard_docstore_id = docstore_id
+        with self.use_shard(key) as shard:
+            return shard.get_document(shard_docstore_id)
+
+    def get_cache_stats(self) -> dict:
+        """Get the hit rates of the query caches, and the shards in memory."""
+        return {**super().get_cache_stats(), "shards": len(self.list_shards()), "loaded_shards": len(self.loaded)}
+
+
+def get_account_handler(config: dict, account: dict, index_dir: str = SHARDS_DIR) -> EmailHandler:
+    """Get the handler of the mailbox of an account, its synchronisation checkpoint being kept with its shards."""
+    parameters = {**config["email"], **{name: value for name, value in account.items() if name != "name"}}
+    parameters.setdefault("sync_state_path", os.path.join(index_dir, account["name"], "sync_state.json"))
+    os.makedirs(os.path.dirname(parameters["sync_state_path"]), exist_ok=True)
+    return EmailHandler(**parameters)
+
+
+def build_sharded_index(config: dict, sync: bool = True) -> ShardedIndex:
+    """Synchronise the shards of all the accounts of the configuration with their mailboxes.
+
+    The first time, all the emails of an account are indexed; then only the changes since its last
+    synchronisation. The shards of an account which cannot be synchronised are kept as saved.
+
+    Args:
+        config (dict): the configuration, with its `accounts`.
+        sync (bool): whether to synchronise the accounts already indexed, or only index the new ones.
+    """
+    index = ShardedIndex(**config.get("shards", {}), **config["rag"])
+    index.set_embeddings()
+    for account in config["accounts"]:
+        email_handler = get_account_handler(config, account, index.index_dir)
+        if not os.path.exists(email_handler.sync_state_path):
+            print(f"Indexing the account {account['name']}.")
+            index.update_account(account["name"], email_handler.initialise_set_up(), [])
+            email_handler.commit_sync()
+        elif sync:
+            print(f"Synchronising the account {account['name']}.")
+            try:
+                added_documents, deleted_message_ids = email_handler.update()
+                index.update_account(account["name"], added_documents, deleted_message_ids)
+                email_handler.commit_sync()
+            except Exception as e:
+                print(f"Could not synchronise the account {account['name']}, keeping its saved shards: {e}")
+                index.load_vectorestore()
+    return index
+
+
+def main(args: Optional[list] = None):
+    """Synchronise, list or rebuild the shards of the accounts."""
+    from src.utils import get_config
+
+    config = get_config()
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--list", action="store_true", help="list the shards and their number of emails")
+    parser.add_argument("--rebuild", nargs=2, metavar=("ACCOUNT", "PERIOD"), help="index again the emails of a shard")
+    args = parser.parse_args(args)
+    if args.list:
+        index = ShardedIndex(**config.get("shards", {}), **config["rag"])
+        for (account, period), count in index.catalog.get_shards().items():
+            print(f"{account}\t{period}\t{count} emails")
+    elif args.rebuild:
+        account_name, period = args.rebuild
+        accounts = {account["name"]: account for account in config.get("accounts") or []}
+        if account_name not in accounts:
+            parser.error(f"Unknown account {account_name}, the accounts are: {', '.join(accounts)}")
+        index = ShardedIndex(**config.get("shards", {}), **config["rag"])
+        index.set_embeddings()
+        index.rebuild_shard(account_name, period, get_account_handler(config, accounts[account_name], index.index_dir))
+    else:
+        build_sharded_index(config)
+
+
+if __name__ == "__main__":
+    main()
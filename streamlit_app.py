@@ -1,32 +1,32 @@
 """Main function to run the application."""
-import os
-
 import streamlit as st
 
-from src.email_handler import EmailHandler
-from src.llm_handler import LLMHandler
-from src.rag_handler import RAGHandler
+from src.query_client import QueryClient
 from src.utils import get_config
 
 st.title("em AI l")
 
 config = get_config()
+service_config = config.get("service", {})
+host = service_config.get("host", "127.0.0.1")
+port = service_config.get("port", 8765)
+
+
+@st.cache_resource
+def start_query_service():
+    """Start the query service in the app process once for all the sessions, unless it already runs."""
+    client = QueryClient(host, port)
+    if not client.is_ready() and service_config.get("embedded", True):
+        from src.query_service import build_service, start_in_thread
+
+        start_in_thread(build_service(config), host, port)
+    client.wait_ready()
+
+
+start_query_service()
 
-if "rag_service" not in st.session_state:
-    rag_service = RAGHandler(**config["rag"])
-    if "faiss_index" not in os.listdir("./data/"):
-        email_handler = EmailHandler(**config["email"])
-        email_handler.initialise_set_up()
-        rag_service.initialise_set_up()
-    else:
-        rag_service.set_embeddings()
-        rag_service.load_vectorestore()
-    st.session_state.rag_service = rag_service
-if "llm_handler" not in st.session_state:
-    llm_handler = LLMHandler(**config["llm"]["model"])
-    llm_handler.start_llamafile()
-    llm_handler.set_llm(**config["llm"]["model_config"])
-    st.session_state.llm_handler = llm_handler
+if "client" not in st.session_state:
+    st.session_state.client = QueryClient(host, port)
 
 
 def generate_response(input_text: str):
@@ -35,11 +35,16 @@ def generate_response(input_text: str):
     Args:
         input_text (str): input text from the user.
     """
-    rag_service = st.session_state.rag_service
-    llm_handler = st.session_state.llm_handler
-    context = rag_service.get_context(input_text)
-    prompt = llm_handler.prepare_prompt(input_text, context)
-    st.write_stream(llm_handler.llm_stream(prompt))
+    client = st.session_state.client
+    st.write_stream(client.stream(input_text))
+    with st.sidebar:
+        stats = client.get_stats()
+        metrics = stats.pop("metrics", None)
+        st.caption("Cache hit rates")
+        st.json(stats, expanded=False)
+        if metrics is not None:
+            st.caption("Metrics")
+            st.json(metrics, expanded=False)
 
 
 with st.form("my_form"):
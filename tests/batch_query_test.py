@@ -0,0 +1,68 @@
+import io
+import json
+from datetime import datetime
+
+import pytest
+from langchain_core.documents import Document
+
+from src.batch_query import run_batch
+from src.llm_handler import LLMHandler
+
+QUERIES = [
+    "budget of the project",
+    "meeting on Friday",
+    "budget after:2024/06/01",
+    "train tickets from:carol",
+    "unrelated question",
+    "budget of the project",
+]
+
+
+def get_email(number: int) -> Document:
+    topic = ["budget of the project", "meeting on Friday", "train tickets", "lunch menu"][number % 4]
+    metadata = {
+        "message_id": f"message-{number}",
+        "from": ["alice@acme.com", "bob@corp.com", "carol@example.org"][number % 3],
+        "timestamp": datetime(2024, 1 + number % 12, 1).timestamp(),
+        "subject": f"email {number}",
+    }
+    return Document(page_content=f"Email {number} about the {topic}, number{number}.", metadata=metadata)
+
+
+def get_single_results(rag, queries: list[str]) -> list[list[tuple[str, float]]]:
+    results = []
+    for query in queries:
+        rag.retrieval_cache.clear()
+        rag.query_embedding_cache.clear()
+        results.append([(doc.metadata["message_id"], score) for doc, score in rag.query_vectorestore(query)])
+    return results
+
+
+@pytest.mark.parametrize("hybrid", [False, True])
+def test_batch_retrieval_matches_single_queries(make_rag, hybrid):
+    rag = make_rag(hybrid=hybrid, threshold=0.9, nb_docs_returned=4, fetch_k_docs=10)
+    rag.reset_vectorestore()
+    rag.ingest([get_email(number) for number in range(40)])
+    expected = get_single_results(rag, QUERIES)
+    # some documents are beyond the distance threshold
+    assert any(len(documents) < 4 for documents in expected) and any(expected)
+    rag.retrieval_cache.clear()
+    rag.query_embedding_cache.clear()
+    batch = rag.query_vectorestore_batch(QUERIES)
+    assert [[(doc.metadata["message_id"], score) for doc, score in documents] for documents in batch] == expected
+
+
+def test_batch_query_answers_with_the_contexts_of_single_queries(make_rag, monkeypatch):
+    rag = make_rag(threshold=0.9, nb_docs_returned=4)
+    rag.reset_vectorestore()
+    rag.ingest([get_email(number) for number in range(40)])
+    llm_handler = LLMHandler("", "")
+    # the answer is the prompt, built with the context retrieved
+    monkeypatch.setattr(llm_handler, "llm_invoke", lambda prompt: prompt)
+    output = io.StringIO()
+    items = iter([{"id": number, "query": query} for number, query in enumerate(QUERIES)])
+    assert run_batch(rag, llm_handler, items, output, batch_size=4, concurrency=2) == len(QUERIES)
+    answers = {result["id"]: result["answer"] for result in map(json.loads, output.getvalue().splitlines())}
+    for number, query in enumerate(QUERIES):
+        rag.retrieval_cache.clear()
+        assert answers[number] == llm_handler.prepare_prompt(query, rag.get_context(query))
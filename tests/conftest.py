@@ -0,0 +1,21 @@
+from typing import Callable
+
+import pytest
+
+from benchmarks.run_benchmark import HashingEmbeddings
+from src.rag_handler import RAGHandler
+
+
+@pytest.fixture
+def make_rag(tmp_path) -> Callable[..., RAGHandler]:
+    """Get a factory of vector stores in a temporary folder, embedding the chunks without a model."""
+
+    def make(handler_class: type = RAGHandler, **config) -> RAGHandler:
+        config.setdefault("index_dir", str(tmp_path / "index"))
+        config.setdefault("hybrid", False)
+        rag = handler_class(**config)
+        rag.engine = HashingEmbeddings(dimension=64)
+        rag.set_embeddings()
+        return rag
+
+    return make
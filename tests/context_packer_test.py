@@ -0,0 +1,30 @@
+from langchain_core.documents import Document
+
+from src.context_packer import estimate_tokens, merge_texts, pack_context
+
+
+def test_merge_texts_removes_overlap():
+    merged = merge_texts("We will meet at the end of", "at the end of the week", 20)
+    assert merged == "We will meet at the end of the week"
+
+
+def test_merge_texts_does_not_glue_chunks_without_overlap():
+    assert merge_texts("We will meet at the", "end of the week", 20) == "We will meet at the end of the week"
+    assert merge_texts("approved.", ".Net", 20) == "approved. .Net"
+
+
+def test_merge_texts_requires_a_minimum_overlap():
+    assert merge_texts("we all agree", "agree to disagree", 20) == "we all agree agree to disagree"
+
+
+def test_pack_context_tokenizes_a_truncated_chunk_once():
+    calls = []
+
+    def truncate_tokens(text, max_tokens):
+        calls.append(max_tokens)
+        return text[: max_tokens * 4]
+
+    documents = [(Document(page_content="word " * 400, metadata={"id": "1"}), 0.1)]
+    context = pack_context(documents, 100, lambda doc: doc.page_content, truncate_tokens=truncate_tokens)
+    assert calls == [100]
+    assert estimate_tokens(context) <= 101
@@ -0,0 +1,41 @@
+from src.dedup import strip_quoted
+
+
+def test_strip_quoted_top_posted_reply():
+    text = "Sure, 4.2M\n\nOn Mon, 3 Jun 2024 at 10:00, Bob <bob@acme.com>\nwrote:\n> send the report?\n> thanks"
+    assert strip_quoted(text) == "Sure, 4.2M"
+
+
+def test_strip_quoted_keeps_bottom_posted_reply():
+    text = (
+        "Hi Bob,\n\nOn Mon, 3 Jun 2024 at 10:00, Bob <bob@acme.com> wrote:\n> send the report?\n\n"
+        "Sure, Q3 revenue was 4.2M"
+    )
+    assert strip_quoted(text) == "Hi Bob,\n\nSure, Q3 revenue was 4.2M"
+
+
+def test_strip_quoted_keeps_inline_replies():
+    text = "On Mon, Bob wrote:\n> first question?\nfirst answer\n> second question?\nsecond answer\n-- \nAlice"
+    assert strip_quoted(text) == "first answer\nsecond answer"
+
+
+def test_strip_quoted_keeps_forwarded_email():
+    text = (
+        "FYI\n\n---------- Forwarded message ---------\nFrom: Carol <carol@acme.com>\nDate: Mon, 3 Jun 2024\n"
+        "Subject: Contract\nTo: Alice <alice@acme.com>\n\nThe contract is signed."
+    )
+    assert strip_quoted(text) == text
+
+
+def test_strip_quoted_keeps_forwarded_email_after_signature():
+    text = "FYI\n-- \nAlice\nBegin forwarded message:\nFrom: Carol\nSubject: Contract\n\nSigned."
+    assert strip_quoted(text) == "FYI\nBegin forwarded message:\nFrom: Carol\nSubject: Contract\n\nSigned."
+
+
+def test_strip_quoted_outlook_headers():
+    text = "Ok for me\n\n-----Original Message-----\nFrom: Bob\nSent: Monday\nTo: Alice\nSubject: Re: report\n"
+    assert strip_quoted(text) == "Ok for me"
+
+
+def test_strip_quoted_mobile_signature():
+    assert strip_quoted("Ok\nSent from my iPhone") == "Ok"
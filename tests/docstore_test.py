@@ -0,0 +1,30 @@
+from langchain_core.documents import Document
+
+from src.docstore import RowMapping, SQLiteDocstore
+
+
+def get_docstore(tmp_path) -> SQLiteDocstore:
+    docstore = SQLiteDocstore(str(tmp_path / "docstore.sqlite"))
+    documents = [Document(page_content=f"chunk {row}", metadata={"message_id": f"m{row}"}) for row in range(4)]
+    docstore.add_rows(list(range(4)), [f"m{row}:0" for row in range(4)], documents)
+    return docstore
+
+
+def test_row_mapping_follows_the_shifted_rows(tmp_path):
+    docstore = get_docstore(tmp_path)
+    docstore.delete_rows([1], shift=True)
+    mapping = RowMapping(docstore)
+    assert list(mapping) == [0, 1, 2]
+    assert mapping[1] == "m2:0"
+    assert 3 not in mapping
+    assert len(mapping) == 3
+
+
+def test_state_is_only_saved_with_a_commit(tmp_path):
+    docstore = get_docstore(tmp_path)
+    docstore.set_state("save_id", "first")
+    docstore.commit()
+    docstore.set_state("save_id", "second")
+    docstore.rollback()
+    assert docstore.get_state("save_id") == "first"
+    assert docstore.get_state("unknown") is None
@@ -0,0 +1,124 @@
+import pytest
+
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.synthetic_mailbox import generate_mailbox
+from src import email_handler
+from src.email_handler import EmailHandler
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(email_handler, "get_backoff_delay", lambda attempt: 0)
+
+
+def get_handler(service: FakeGmailService, **kwargs) -> EmailHandler:
+    handler = EmailHandler("token.pickle", "credentials.json", [], **kwargs)
+    handler.service = service
+    return handler
+
+
+def test_search_messages_lists_all_pages():
+    messages = generate_mailbox(250, seed=1)
+    handler = get_handler(FakeGmailService(messages))
+    assert [message["id"] for message in handler.search_messages("")] == [message["id"] for message in messages]
+
+
+def test_fetch_messages_keeps_order():
+    messages = generate_mailbox(230, seed=1)
+    service = FakeGmailService(messages, latency=0.001)
+    handler = get_handler(service, batch_size=20, max_workers=4)
+    fetched = list(handler.fetch_messages(handler.search_messages("")))
+    assert [message["id"] for message in fetched] == [message["id"] for message in messages]
+    # one batch request per group of messages, instead of a request per message
+    assert service.calls["batch"] == 12
+
+
+def test_fetch_batch_retries_rate_limited_messages():
+    messages = generate_mailbox(100, seed=1)
+    service = FakeGmailService(messages, error_rate=0.3, seed=2)
+    handler = get_handler(service, batch_size=50, max_workers=2, max_retries=10)
+    fetched = list(handler.fetch_messages(handler.search_messages("")))
+    assert service.calls["errors"] > 0
+    assert [message["id"] for message in fetched] == [message["id"] for message in messages]
+
+
+def test_fetch_batch_skips_messages_not_found():
+    messages = generate_mailbox(30, seed=1)
+    listed = [{"id": message["id"]} for message in messages]
+    listed.insert(10, {"id": "deleted"})
+    handler = get_handler(FakeGmailService(messages), batch_size=100)
+    results = handler.fetch_batch(listed)
+    assert results[10] is None
+    assert [message["id"] for message in results if message is not None] == [message["id"] for message in messages]
+
+
+def test_fetch_batch_gives_up_after_max_retries():
+    messages = generate_mailbox(10, seed=1)
+    service = FakeGmailService(messages, error_rate=1.0)
+    handler = get_handler(service, max_retries=2)
+    assert handler.fetch_batch([{"id": message["id"]} for message in messages]) == [None] * 10
+    assert service.calls["batch"] == 3
+    assert list(handler.fetch_messages([{"id": message["id"]} for message in messages])) == []
+
+
+def get_synced_handler(service: FakeGmailService, tmp_path) -> EmailHandler:
+    handler = get_handler(service, sync_state_path=str(tmp_path / "sync_state.json"))
+    handler.set_service = lambda: None
+    list(handler.initialise_set_up())
+    handler.commit_sync()
+    return handler
+
+
+def get_changes(handler: EmailHandler) -> tuple[list, list]:
+    documents, deleted = handler.update()
+    return sorted({document.metadata["message_id"] for document in documents}), deleted
+
+
+def test_update_applies_the_history(tmp_path):
+    messages = generate_mailbox(12, seed=1)
+    service = FakeGmailService(messages[:10])
+    handler = get_synced_handler(service, tmp_path)
+    service.add_message(messages[10])
+    service.add_message(messages[11])
+    service.delete_message(messages[11]["id"])
+    service.delete_message(messages[0]["id"])
+    service.set_labels(messages[1]["id"], added=("TRASH",))
+    service.set_labels(messages[2]["id"], added=("TRASH",))
+    service.set_labels(messages[2]["id"], removed=("TRASH",))
+    assert get_changes(handler) == ([messages[10]["id"]], sorted([messages[0]["id"], messages[1]["id"]]))
+    handler.commit_sync()
+    # the restored message is indexed again
+    service.set_labels(messages[1]["id"], removed=("TRASH",))
+    assert get_changes(handler) == ([messages[1]["id"]], [])
+    assert service.calls["history"] == 2
+
+
+def test_update_falls_back_to_the_listing_when_the_history_expired(tmp_path):
+    messages = generate_mailbox(12, seed=1)
+    service = FakeGmailService(messages[:10])
+    handler = get_synced_handler(service, tmp_path)
+    service.add_message(messages[10])
+    service.delete_message(messages[3]["id"])
+    service.expire_history()
+    assert get_changes(handler) == ([messages[10]["id"]], [messages[3]["id"]])
+    handler.commit_sync()
+    assert handler.load_sync_state()["history_id"] == str(service.history_id)
+    # the new checkpoint is in the history again
+    service.add_message(messages[11])
+    assert get_changes(handler) == ([messages[11]["id"]], [])
+
+
+def test_checkpoint_only_moves_forward_once_the_changes_are_handled(tmp_path):
+    messages = generate_mailbox(12, seed=1)
+    service = FakeGmailService(messages[:10])
+    handler = get_synced_handler(service, tmp_path)
+    checkpoint = handler.load_sync_state()
+    service.add_message(messages[10])
+    assert get_changes(handler) == ([messages[10]["id"]], [])
+    # the indexing of the changes failed: the next update gets them again
+    assert handler.load_sync_state() == checkpoint
+    assert get_changes(handler) == ([messages[10]["id"]], [])
+    handler.commit_sync()
+    assert int(handler.load_sync_state()["history_id"]) > int(checkpoint["history_id"])
+    assert messages[10]["id"] in handler.load_sync_state()["message_ids"]
+    assert get_changes(handler) == ([], [])
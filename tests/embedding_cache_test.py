@@ -0,0 +1,20 @@
+from src.embedding_cache import EmbeddingCache
+from src.embedding_engine import get_embeddings_variant
+
+
+def test_put_and_get_more_texts_than_the_sqlite_parameters(tmp_path):
+    cache = EmbeddingCache("model", path=str(tmp_path))
+    texts = [f"text {number}" for number in range(40_000)]
+    cache.put(texts, [[float(number % 1000), 1.0] for number in range(40_000)])
+    # the texts already cached are not added again
+    cache.put(texts, [[0.0, 0.0]] * 40_000)
+    results = cache.get(texts)
+    assert results[123] == [123.0, 1.0]
+    assert results[39_999] == [999.0, 1.0]
+
+
+def test_variants_of_a_model_have_their_own_cache(tmp_path):
+    EmbeddingCache("model", path=str(tmp_path)).put(["text"], [[1.0, 0.0]])
+    assert EmbeddingCache("model", path=str(tmp_path), variant=get_embeddings_variant("int8")).get(["text"]) == [None]
+    assert get_embeddings_variant(normalize=True, batch_size=32) == "normalized"
+    assert get_embeddings_variant("torch") == ""
@@ -0,0 +1,42 @@
+import os
+
+from src import embedding_engine
+from src.embedding_engine import EmbeddingEngine
+
+
+class FakeModel:
+    def __init__(self, model_name: str, device: str = "cpu"):
+        self.pool_environment: dict = {}
+
+    def start_multi_process_pool(self, target_devices: list):
+        self.pool_environment = {name: os.environ.get(name) for name in embedding_engine.THREAD_VARIABLES}
+        return {"processes": len(target_devices)}
+
+    def encode_multi_process(self, texts, pool, **kwargs):
+        return FakeEmbeddings([[float(len(text))] for text in texts])
+
+
+class FakeEmbeddings(list):
+    def tolist(self):
+        return list(self)
+
+
+def test_processes_share_the_cores(monkeypatch):
+    monkeypatch.setattr(embedding_engine, "SentenceTransformer", FakeModel)
+    monkeypatch.setattr(embedding_engine.torch, "set_num_threads", lambda threads: None)
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+    for name in embedding_engine.THREAD_VARIABLES:
+        monkeypatch.delenv(name, raising=False)
+    engine = EmbeddingEngine("model", processes=4)
+    assert engine.threads == 2
+    assert engine.embed_documents(["a", "bb"]) == [[1.0], [2.0]]
+    # the processes are started with their number of threads, the environment of the app being unchanged
+    assert engine.model.pool_environment == {"OMP_NUM_THREADS": "2", "MKL_NUM_THREADS": "2"}
+    assert "OMP_NUM_THREADS" not in os.environ
+
+
+def test_threads_set_explicitly_are_kept(monkeypatch):
+    monkeypatch.setattr(embedding_engine, "SentenceTransformer", FakeModel)
+    monkeypatch.setattr(embedding_engine.torch, "set_num_threads", lambda threads: None)
+    assert EmbeddingEngine("model", processes=4, threads=3).threads == 3
+    assert EmbeddingEngine("model").threads == 0
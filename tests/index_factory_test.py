@@ -0,0 +1,41 @@
+import numpy as np
+
+from src.index_factory import TrainingBuffer
+
+
+def add_messages(buffer: TrainingBuffer, start: int, stop: int):
+    numbers = range(start, stop)
+    buffer.add(
+        [f"text {number}" for number in numbers],
+        [[float(number), 0.0] for number in numbers],
+        [{"message_id": f"m{number}"} for number in numbers],
+        [f"m{number}:0" for number in numbers],
+    )
+
+
+def test_training_sample_covers_all_the_chunks():
+    buffer = TrainingBuffer(100)
+    for start in range(0, 1000, 50):
+        add_messages(buffer, start, start + 50)
+    sample = buffer.get_sample()
+    assert len(sample) == 100
+    # a uniform sample, not the first vectors added
+    assert np.mean(sample[:, 0] >= 500) > 0.3
+
+
+def test_training_sample_of_few_chunks():
+    buffer = TrainingBuffer(100)
+    add_messages(buffer, 0, 10)
+    assert sorted(buffer.get_sample()[:, 0]) == list(range(10))
+
+
+def test_removed_messages_are_not_replayed():
+    buffer = TrainingBuffer(100)
+    add_messages(buffer, 0, 10)
+    assert buffer.remove_messages({"m1", "m2", "m42"}) == 2
+    # a message added again after its removal is kept
+    add_messages(buffer, 2, 3)
+    ids = [id_ for _, _, _, batch_ids in buffer for id_ in batch_ids]
+    assert ids == [f"m{number}:0" for number in (0, 3, 4, 5, 6, 7, 8, 9, 2)]
+    assert len(buffer) == 9
+    buffer.close()
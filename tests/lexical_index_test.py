@@ -0,0 +1,79 @@
+from datetime import datetime
+
+from langchain_core.documents import Document
+
+from src.lexical_index import LexicalIndex, parse_query
+
+
+def get_email(number: int, text: str, sender: str, date: str) -> Document:
+    metadata = {
+        "message_id": f"message-{number}",
+        "chunk": 0,
+        "from": sender,
+        "to": "me@example.com",
+        "timestamp": datetime.fromisoformat(date).timestamp(),
+        "subject": f"email {number}",
+    }
+    return Document(page_content=text, metadata=metadata)
+
+
+EMAILS = [
+    get_email(0, "The budget of the project is approved.", "Alice <alice@acme.com>", "2023-11-20"),
+    get_email(1, "Can we discuss the budget on Monday?", "Alice <alice@acme.com>", "2024-02-05"),
+    get_email(2, "The budget report (draft) is attached.", "Bob <bob@corp.com>", "2024-02-12"),
+    get_email(3, "Lunch on Friday with the whole team.", "Alice <alice@acme.com>", "2024-03-01"),
+]
+
+
+def get_index(tmp_path) -> LexicalIndex:
+    index = LexicalIndex(str(tmp_path / "lexical.sqlite"))
+    index.add([f"message-{number}:0" for number in range(len(EMAILS))], EMAILS)
+    return index
+
+
+def test_search_ignores_the_full_text_search_syntax(tmp_path):
+    index = get_index(tmp_path)
+    results = index.search('budget AND "report" (draft* OR NEAR) -lunch: ^subject', 10)
+    assert results[0][0] == "message-2:0"
+    # the operators are searched as terms
+    assert {docstore_id for docstore_id, _ in results} == {f"message-{number}:0" for number in range(4)}
+    assert index.search('"*" ()', 10) == []
+
+
+def test_query_filters(tmp_path):
+    query, filters = parse_query("budget from:alice after:2024/01/01 before:2024-03-01")
+    assert query == "budget"
+    assert filters == {
+        "sender": "alice",
+        "after": datetime(2024, 1, 1).timestamp(),
+        "before": datetime(2024, 3, 1).timestamp(),
+    }
+    index = get_index(tmp_path)
+    assert index.filter(filters) == {"message-1:0"}
+    assert index.filter({"sender": "ACME"}) == {"message-0:0", "message-1:0", "message-3:0"}
+    assert index.filter({"after": datetime(2024, 2, 10).timestamp()}) == {"message-2:0", "message-3:0"}
+    assert [docstore_id for docstore_id, _ in index.search("budget", 10, {"before": filters["after"]})] == [
+        "message-0:0"
+    ]
+
+
+def test_rank_fuses_the_dense_and_lexical_results(make_rag):
+    rag = make_rag(rrf_k=60)
+    dense = [("a", 0.1), ("b", 0.2), ("c", 0.3)]
+    lexical = [("c", -2.0), ("a", -1.0), ("d", -0.5)]
+    ranked = rag.rank(dense, lexical)
+    assert [docstore_id for docstore_id, _ in ranked] == ["a", "c", "b", "d"]
+    assert ranked[0][1] == 1 / 61 + 1 / 62
+    # without lexical results, the chunks keep the order of their distance
+    assert [docstore_id for docstore_id, _ in rag.rank(dense, None)] == ["a", "b", "c"]
+
+
+def test_hybrid_search_applies_the_filters(make_rag):
+    rag = make_rag(hybrid=True, threshold=5.0, nb_docs_returned=5)
+    rag.reset_vectorestore()
+    rag.ingest(EMAILS)
+    found = [doc.metadata["message_id"] for doc, _ in rag.query_vectorestore("budget from:alice after:2024/01/01")]
+    assert found == ["message-1", "message-3"]
+    found = [doc.metadata["message_id"] for doc, _ in rag.query_vectorestore("budget before:2024/01/01")]
+    assert found == ["message-0"]
+    assert rag.query_vectorestore("budget from:nobody") == []
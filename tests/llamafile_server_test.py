@@ -0,0 +1,134 @@
+import os
+import socket
+import sys
+import textwrap
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from benchmarks.stub_llamafile import StubLlamafileServer
+from src import llamafile_server
+from src.llamafile_server import LlamafileServer, get_server
+from src.llm_handler import LLMHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def stub_server():
+    server = StubLlamafileServer(token_latency=0)
+    server.start()
+    yield server
+    server.stop()
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_llamafile(tmp_path, exit_code=None) -> str:
+    """Write an executable starting the stub server on the port given like to a llamafile."""
+    path = tmp_path / "model.llamafile"
+    if exit_code is not None:
+        body = f"sys.exit({exit_code})"
+    else:
+        body = """
+            from benchmarks.stub_llamafile import StubLlamafileServer
+
+            port = int(sys.argv[sys.argv.index("--port") + 1])
+            StubLlamafileServer(port=port).serve_forever()
+        """
+    path.write_text(
+        f"#!{sys.executable}\nimport sys\nsys.path.insert(0, {ROOT!r})\n" + textwrap.dedent(body).strip() + "\n"
+    )
+    path.chmod(0o755)
+    return str(path)
+
+
+def test_is_ready(stub_server):
+    assert LlamafileServer("model", port=stub_server.server_address[1]).is_ready()
+
+
+def test_is_not_ready_without_server():
+    assert not LlamafileServer("model", port=get_free_port()).is_ready()
+
+
+def test_is_not_ready_with_other_server():
+    class TextHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.end_headers()
+            self.wfile.write(b"<html>not a llamafile</html>")
+
+    other = HTTPServer(("127.0.0.1", 0), TextHandler)
+    threading.Thread(target=other.serve_forever, daemon=True).start()
+    try:
+        assert not LlamafileServer("model", port=other.server_address[1]).is_ready()
+    finally:
+        other.shutdown()
+        other.server_close()
+
+
+def test_start_reuses_running_server(stub_server):
+    server = LlamafileServer("missing.llamafile", port=stub_server.server_address[1])
+    server.start()
+    assert server.process is None
+    assert server.timings["reused"]
+
+
+def test_start_waits_for_server_and_stops_it(tmp_path):
+    server = LlamafileServer(write_llamafile(tmp_path), port=get_free_port(), startup_timeout=30)
+    server.start()
+    try:
+        assert server.is_ready()
+        assert not server.timings["reused"]
+        server.warm_up("You are an assistant.")
+        assert server.timings["first_token"] >= server.timings["ready"]
+        assert server.count_tokens("a few words") > 0
+    finally:
+        server.stop()
+    assert server.process.poll() is not None
+
+
+def test_start_fails_when_process_exits(tmp_path):
+    server = LlamafileServer(write_llamafile(tmp_path, exit_code=1), port=get_free_port(), startup_timeout=30)
+    with pytest.raises(RuntimeError):
+        server.start()
+
+
+def test_wait_ready_times_out():
+    server = LlamafileServer("model", port=get_free_port(), startup_timeout=0.1)
+    with pytest.raises(TimeoutError):
+        server.wait_ready()
+
+
+def test_get_server_is_shared(stub_server, monkeypatch):
+    monkeypatch.setattr(llamafile_server, "SERVERS", {})
+    port = stub_server.server_address[1]
+    assert get_server("model", port=port) is get_server("model", port=port)
+
+
+def test_context_budget_fits_the_slot(stub_server):
+    host, port = stub_server.server_address[:2]
+    llm_handler = LLMHandler("", "")
+    llm_handler.server = LlamafileServer("", host=host, port=port, ctx_size=4096, parallel=2)
+    llm_handler.set_llm(n_predict=256)
+    query = "When is the meeting?"
+    prompt_tokens = llm_handler.count_tokens(llm_handler.prepare_prompt(query, ""))
+    assert llm_handler.get_context_budget(query) == 2048 - prompt_tokens - 256
+
+
+def test_truncate_tokens_cuts_at_the_token_offset(stub_server):
+    host, port = stub_server.server_address[:2]
+    llm_handler = LLMHandler("", "")
+    llm_handler.server = LlamafileServer("", host=host, port=port)
+    text = "The budget of the project was approved."
+    assert llm_handler.truncate_tokens(text, 3) == text[:12]
+    assert llm_handler.truncate_tokens(text, 100) == text
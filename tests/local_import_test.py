@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from src import local_import
+from src.local_import import get_id, iter_local_documents, iter_mbox
+
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources")
+TAKEOUT = os.path.join(RESOURCES, "takeout.mbox")
+MAILDIR = os.path.join(RESOURCES, "maildir")
+
+
+def get_documents(*paths: str) -> dict:
+    return {document.metadata["message_id"]: document for document in iter_local_documents(list(paths))}
+
+
+def test_mbox_is_split_on_the_from_lines():
+    with open(TAKEOUT, "rb") as f:
+        content = f.read()
+    locations = list(iter_mbox(TAKEOUT))
+    assert len(locations) == 3
+    assert all(content[start:end].startswith(b"From ") for _, start, end, _ in locations)
+    assert locations[-1][2] == len(content)
+    # the escaped `From ` line of the body does not start a message
+    assert b">From now on" in content[locations[0][1] : locations[0][2]]
+
+
+def test_takeout_messages_keep_their_gmail_ids():
+    documents = get_documents(TAKEOUT)
+    # the trash is not imported
+    assert list(documents) == ["181900cb1a5932a2", "181953a7b64bf1c7"]
+    first, reply = documents.values()
+    assert first.metadata["thread_id"] == reply.metadata["thread_id"] == "181900cb1a593280"
+    assert first.metadata["subject"] == "Réunion budget"
+    assert first.metadata["labels"] == ["INBOX", "IMPORTANT"]
+    assert first.metadata["timestamp"] == 1736416800
+    assert "From now on, the reports are due on Thursday." in first.page_content
+    assert reply.metadata["labels"] == ["INBOX", "CATEGORY_UPDATES"]
+    assert reply.page_content.count("Friday works for me") == 1
+    assert reply.metadata["attachments"] == [
+        {"filename": "budget.xls", "mime_type": "application/vnd.ms-excel", "size": 10}
+    ]
+
+
+def test_maildir_messages_are_labelled_with_their_folder():
+    documents = get_documents(MAILDIR)
+    assert sorted(document.metadata["subject"] for document in documents.values()) == [
+        "Budget figures",
+        "Lunch",
+        "Train tickets",
+    ]
+    labels = {document.metadata["subject"]: document.metadata["labels"] for document in documents.values()}
+    assert labels == {"Lunch": ["INBOX"], "Train tickets": ["INBOX"], "Budget figures": ["PROJECTS_BUDGET"]}
+    figures = documents[get_id("<figures@acme.com>")]
+    # the thread of an email without Gmail ids is the first email it references
+    assert figures.metadata["thread_id"] == get_id("<budget-1@acme.com>")
+
+
+@pytest.fixture
+def import_config(monkeypatch, tmp_path, make_rag):
+    config = {
+        "email": {"token_path": "", "credentials_path": "", "scopes": [], "sync_state_path": str(tmp_path / "sync")},
+        "rag": {"index_dir": str(tmp_path / "index")},
+    }
+    monkeypatch.setattr(local_import, "get_config", lambda: config)
+    monkeypatch.setattr(local_import, "RAGHandler", lambda **rag_config: make_rag(**rag_config))
+    synced = []
+    monkeypatch.setattr(
+        local_import, "sync_imported", lambda email_handler, imported: synced.append(imported) or (iter([]), [])
+    )
+    return synced
+
+
+def test_sync_is_refused_for_emails_without_gmail_ids(import_config, capsys):
+    local_import.main([TAKEOUT, MAILDIR, "--sync", "--processes", "0"])
+    assert import_config == []
+    assert "Not synchronising with Gmail: 3 emails imported are not from a Google Takeout export" in (
+        capsys.readouterr().out
+    )
+
+
+def test_takeout_export_is_synchronised(import_config):
+    local_import.main([TAKEOUT, "--sync", "--processes", "0"])
+    assert import_config == [{"181900cb1a5932a2", "181953a7b64bf1c7"}]
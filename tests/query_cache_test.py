@@ -0,0 +1,6 @@
+from src.query_cache import normalize_query
+
+
+def test_normalize_query_keeps_the_case():
+    assert normalize_query("  Invoice   from ACME\n") == "Invoice from ACME"
+    assert normalize_query("Apple pie") != normalize_query("apple pie")
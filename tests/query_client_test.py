@@ -0,0 +1,13 @@
+import requests
+
+from src.query_client import QueryClient
+
+
+def test_is_ready_is_false_when_the_service_times_out(monkeypatch):
+    client = QueryClient()
+
+    def get(*args, **kwargs):
+        raise requests.Timeout("the service is loading")
+
+    monkeypatch.setattr(client.session, "get", get)
+    assert not client.is_ready()
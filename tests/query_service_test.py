@@ -0,0 +1,55 @@
+import httplib2
+from googleapiclient.errors import HttpError
+from langchain_core.documents import Document
+
+from src.query_service import synchronise
+
+
+class OfflineEmailHandler:
+    def __init__(self, error: Exception, added: int = 0):
+        self.error = error
+        self.added = added
+        self.committed = False
+
+    def update(self):
+        if not self.added:
+            raise self.error
+
+        def documents():
+            # the emails are downloaded while they are indexed, the connection may be lost in between
+            yield get_email(100)
+            raise self.error
+
+        return documents(), ["m1"]
+
+    def commit_sync(self):
+        self.committed = True
+
+
+def get_email(number: int) -> Document:
+    return Document(page_content=f"email {number} word{number}", metadata={"message_id": f"m{number}"})
+
+
+def get_saved_rag(make_rag):
+    rag = make_rag()
+    rag.reset_vectorestore()
+    rag.ingest([get_email(number) for number in range(10)])
+    rag.save_vectorestore()
+    return rag
+
+
+def test_index_is_served_when_the_mailbox_cannot_be_reached(make_rag):
+    rag = get_saved_rag(make_rag)
+    email_handler = OfflineEmailHandler(HttpError(httplib2.Response({"status": 401}), b"Invalid Credentials"))
+    assert not synchronise(rag, email_handler)
+    assert not email_handler.committed
+    assert len(rag.docstore) == 10
+
+
+def test_changes_of_a_failed_synchronisation_are_discarded(make_rag):
+    rag = get_saved_rag(make_rag)
+    email_handler = OfflineEmailHandler(OSError("Network is unreachable"), added=1)
+    assert not synchronise(rag, email_handler)
+    assert not email_handler.committed
+    assert sorted(rag.docstore.get_message_chunks(["m1", "m100"])) == ["m1:0"]
+    assert rag.vectorstore.index.ntotal == 10
@@ -0,0 +1,80 @@
+from langchain_core.documents import Document
+
+
+def get_email(number: int, text: str = "") -> Document:
+    text = text or f"email {number} about topic{number % 5} word{number}"
+    return Document(page_content=text, metadata={"message_id": f"message-{number}", "subject": f"email {number}"})
+
+
+def get_chunk(number: int, text: str = "") -> Document:
+    chunk = get_email(number, text)
+    chunk.metadata["chunk"] = 0
+    return chunk
+
+
+def get_message_ids(rag) -> set[str]:
+    return {doc.metadata["message_id"] for _, docs in rag.docstore.iter_documents() for doc in docs}
+
+
+def search(rag, query: str) -> str:
+    return rag.query_vectorestore(query)[0][0].metadata["message_id"]
+
+
+def test_add_chunks_and_remove_vectors(make_rag):
+    rag = make_rag(nb_docs_returned=1, threshold=2.0)
+    rag.reset_vectorestore()
+    rag.add_chunks([get_chunk(number) for number in range(10)])
+    assert rag.vectorstore.index.ntotal == len(rag.docstore) == 10
+    assert search(rag, "email 4 about topic4 word4") == "message-4"
+    rag.remove_vectors(["message-4:0", "message-7:0"])
+    assert rag.vectorstore.index.ntotal == len(rag.docstore) == 8
+    assert "message-4" not in get_message_ids(rag)
+    # the rows following the removed ones are shifted, the vectors still map to their chunk
+    assert search(rag, "email 9 about topic4 word9") == "message-9"
+
+
+def test_delete_messages(make_rag):
+    rag = make_rag(nb_docs_returned=1, threshold=2.0, chunk_size=40, chunk_overlap=0)
+    rag.reset_vectorestore()
+    rag.ingest(
+        [get_email(number, " ".join(f"email {number} part {part}." for part in range(5))) for number in range(6)]
+    )
+    nb_chunks = len(rag.docstore)
+    assert nb_chunks > 6
+    rag.delete_messages(["message-2", "message-unknown"])
+    assert "message-2" not in get_message_ids(rag)
+    assert rag.vectorstore.index.ntotal == len(rag.docstore) < nb_chunks
+    assert search(rag, "email 3 part 1.") == "message-3"
+
+
+def test_journal_is_replayed_and_unsaved_changes_are_discarded(make_rag):
+    rag = make_rag(nb_docs_returned=1, threshold=2.0)
+    rag.reset_vectorestore()
+    rag.ingest([get_email(number) for number in range(10)])
+    rag.save_vectorestore()
+    rag.update_vectorestore([get_email(10)], ["message-3"])
+    assert rag.get_journal_entries() == ["000001"]
+    # the process stops before the changes are saved
+    rag.add_chunks([get_chunk(11)])
+    rag.delete_messages(["message-5"])
+    rag.docstore.close()
+
+    reloaded = make_rag(nb_docs_returned=1, threshold=2.0)
+    reloaded.load_vectorestore()
+    assert get_message_ids(reloaded) == {f"message-{number}" for number in range(11)} - {"message-3"}
+    assert reloaded.vectorstore.index.ntotal == len(reloaded.docstore) == 10
+    assert search(reloaded, "email 10 about topic0 word10") == "message-10"
+    assert search(reloaded, "email 5 about topic0 word5") == "message-5"
+
+
+def test_update_vectorestore_replaces_an_edited_message(make_rag):
+    rag = make_rag(nb_docs_returned=1, threshold=2.0)
+    rag.reset_vectorestore()
+    rag.ingest([get_email(number) for number in range(5)])
+    rag.save_vectorestore()
+    rag.update_vectorestore([get_email(2, "the draft was edited with a new budget")], [])
+    documents = [doc for _, docs in rag.docstore.iter_documents() for doc in docs]
+    assert len(documents) == rag.vectorstore.index.ntotal == 5
+    edited = [doc.page_content for doc in documents if doc.metadata["message_id"] == "message-2"]
+    assert edited == ["the draft was edited with a new budget"]
+    assert search(rag, "the draft was edited with a new budget") == "message-2"
@@ -0,0 +1,58 @@
+from datetime import datetime, timezone
+
+import faiss
+from langchain_core.documents import Document
+
+from src.sharded_index import ShardedIndex
+
+
+def get_email(account: str, number: int, year: int) -> Document:
+    timestamp = datetime(year, 1 + number % 12, 1 + number % 28, tzinfo=timezone.utc).timestamp()
+    metadata = {"message_id": f"{account}-{number}", "timestamp": timestamp, "subject": f"email {number}"}
+    return Document(page_content=f"{account} email {number} about topic{number % 9} word{number}", metadata=metadata)
+
+
+def test_ivf_shard_is_trained_on_all_its_batches(make_rag):
+    index = make_rag(ShardedIndex, index={"type": "ivf", "nlist": 8}, embedding_batch_size=16, max_loaded_shards=1)
+    # the batches of the two shards alternate, both waiting for their training at the same time
+    emails = [get_email("personal", number, 2023 + number // 16 % 2) for number in range(800)]
+    index.update_account("personal", emails, [])
+    for period in ("2023", "2024"):
+        with index.use_shard(("personal", period)) as shard:
+            ivf = faiss.extract_index_ivf(shard.vectorstore.index)
+            assert ivf.nlist == 8
+            assert ivf.ntotal == 400
+
+
+def test_emails_are_routed_by_account_and_period(make_rag):
+    index = make_rag(ShardedIndex)
+    index.update_account("personal", [get_email("personal", number, 2023 + number % 2) for number in range(20)], [])
+    index.update_account("work", [get_email("work", number, 2024) for number in range(10)], [])
+    assert index.list_shards() == [("personal", "2023"), ("personal", "2024"), ("work", "2024")]
+    assert index.catalog.locate("personal", ["personal-3"]) == {"2024": ["personal-3"]}
+    with index.use_shard(("work", "2024")) as shard:
+        assert len(shard.docstore) == 10
+
+
+def test_search_merges_the_shards(make_rag):
+    index = make_rag(ShardedIndex, nb_docs_returned=4, threshold=2.0)
+    index.update_account("personal", [get_email("personal", number, 2023) for number in range(20)], [])
+    index.update_account("work", [get_email("work", number, 2024) for number in range(20)], [])
+    found = {doc.metadata["message_id"] for doc, _ in index.query_vectorestore("email 5 word5")}
+    assert {"personal-5", "work-5"} <= found
+    # the date filters only search the shards of their period
+    found = {doc.metadata["message_id"] for doc, _ in index.query_vectorestore("email 5 word5 after:2024/01/01")}
+    assert "work-5" in found and "personal-5" not in found
+
+
+def test_evicted_shards_are_saved_and_reloaded(make_rag):
+    index = make_rag(ShardedIndex, max_loaded_shards=1, nb_docs_returned=1, threshold=2.0)
+    index.update_account("personal", [get_email("personal", number, 2023) for number in range(10)], [])
+    index.update_account("work", [get_email("work", number, 2024) for number in range(10)], [])
+    assert len(index.loaded) == 1
+    results = index.query_vectorestore("personal email 7 word7")
+    assert results[0][0].metadata["message_id"] == "personal-7"
+    assert list(index.loaded) == [("personal", "2023")]
+    results = index.query_vectorestore("work email 3 word3")
+    assert results[0][0].metadata["message_id"] == "work-3"
+    assert list(index.loaded) == [("work", "2024")]